@@ -0,0 +1,284 @@
+"""
+Benchmark the insert pipeline (file read, analysis file write and database insert) across data sizes.
+
+The benchmarks run against either an in-process fake of the spyglass tables used by the insert scripts (see
+fake_spyglass.py, the default) or a real spyglass database, e.g. a local MySQL container configured through the
+datajoint config in DJ_LOCAL_CONF_PATH. Synthetic NWB files of each size are generated with
+mock/synthetic_nwbfile.py, and the results are written to a JSON file so that they can be compared between versions.
+
+Example:
+    python benchmarks/bench_insert.py --sizes small medium --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import h5py
+from pynwb import NWBHDF5IO
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / "insert"))
+sys.path.insert(0, str(REPO_DIR / "mock"))
+
+from instrumentation import JsonLinesSink, tracing
+from synthetic_nwbfile import generate_nwbfile
+
+# the data sizes benchmarked: LFP channels and duration, and units and spikes of the units table
+SIZES = {
+    "small": dict(num_shanks=1, channels_per_shank=16, duration=60.0, num_units=50, spikes_per_unit=1_000),
+    "medium": dict(num_shanks=4, channels_per_shank=16, duration=600.0, num_units=200, spikes_per_unit=10_000),
+    "large": dict(num_shanks=8, channels_per_shank=32, duration=3_600.0, num_units=1_000, spikes_per_unit=50_000),
+}
+
+# the variants of insert_lfp benchmarked for the analysis file write
+LFP_VARIANTS = {
+    "copy": dict(),
+    "stream": dict(copy_mode="stream"),
+    "pipelined": dict(copy_mode="pipelined"),
+    "link": dict(copy_mode="link"),
+    "zarr": dict(copy_mode="zarr"),
+}
+
+ANNOTATION_TO_TYPE = {"custom_label": "label", "custom_quantification": "quantification"}
+
+
+def generate_fixtures(data_dir: Path, sizes: list) -> dict:
+    """Generate (or reuse) one synthetic NWB file with LFP data and a units table per size."""
+    nwbfile_paths = {}
+    for size in sizes:
+        nwbfile_path = data_dir / f"bench_{size}.nwb"
+        if not nwbfile_path.exists():
+            print(f"Generating {nwbfile_path}")
+            generate_nwbfile(nwbfile_path, raw=False, lfp=True, **SIZES[size])
+        nwbfile_paths[size] = nwbfile_path
+    return nwbfile_paths
+
+
+def timed(function, *args, **kwargs) -> float:
+    """Return the wall time of a function call in seconds."""
+    start_time = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start_time
+
+
+def run_stage(function, stage_name: str, **kwargs) -> dict:
+    """Run an insert function and return the record of one of its stages (see instrumentation.stage)."""
+    records = []
+    with tracing(records.append):
+        function(**kwargs)
+    return next(record for record in records if record["stage"] == stage_name)
+
+
+def read_lfp(nwbfile_path: Path, block_samples: int = 100_000):
+    """Read the NWB file and all of its LFP data, block by block."""
+    with NWBHDF5IO(nwbfile_path, "r") as io:
+        nwbfile = io.read()
+        data = nwbfile.processing["ecephys"]["LFP"].electrical_series["ElectricalSeriesLFP"].data
+        for start in range(0, data.shape[0], block_samples):
+            data[start : start + block_samples]
+
+
+def get_lfp_stats(nwbfile_path: Path) -> tuple:
+    """Return the size of the LFP data in bytes and the number of units of an NWB file."""
+    with h5py.File(nwbfile_path, "r") as file:
+        data = file["processing/ecephys/LFP/ElectricalSeriesLFP/data"]
+        num_units = len(file["units/id"]) if "units" in file else 0
+        return data.size * data.dtype.itemsize, num_units
+
+
+def make_result(benchmark: str, stage: str, size: str, params: dict, seconds: float, num_bytes=None, rows=None):
+    result = dict(
+        benchmark=benchmark, stage=stage, size=size, params=params, seconds=seconds, bytes=num_bytes, rows=rows
+    )
+    if num_bytes is not None:
+        result["throughput"] = num_bytes / 1e6 / max(seconds, 1e-9)
+        result["throughput_unit"] = "MB/s"
+    elif rows is not None:
+        result["throughput"] = rows / max(seconds, 1e-9)
+        result["throughput_unit"] = "rows/s"
+    return result
+
+
+def run_benchmarks(nwbfile_paths: dict, backend, repeats: int = 3, lfp_variants: list = None) -> list:
+    """
+    Run the file read, analysis file write and database insert benchmarks on each NWB file.
+
+    The analysis file write and database insert are timed by the "analysis_write" stage of insert_lfp and the
+    "db_insert" stage of insert_sorting (see instrumentation.stage), excluding the other stages of the inserts.
+
+    Parameters
+    ----------
+    nwbfile_paths : dict
+        The NWB file of each size.
+    backend : FakeBackend or DatabaseBackend
+        The spyglass database the sessions are inserted into.
+    repeats : int, default: 3
+        The number of runs of each benchmark. Each run is reported; the summary uses their median.
+    lfp_variants : list of str, optional
+        The insert_lfp variants to benchmark (see LFP_VARIANTS). Defaults to all of them.
+
+    Returns
+    -------
+    list of dict
+        One result per run, with the benchmark, stage, size, params, seconds, bytes, rows and throughput.
+    """
+    # imported here so that the fake spyglass modules are installed first
+    from insert_lfp import insert_lfp
+    from insert_sorting import insert_sorting
+
+    results = []
+    for size, nwbfile_path in nwbfile_paths.items():
+        num_bytes, num_units = get_lfp_stats(nwbfile_path)
+        for _ in range(repeats):
+            seconds = timed(read_lfp, nwbfile_path)
+            results.append(make_result("read_lfp", "file_read", size, {}, seconds, num_bytes=num_bytes))
+        for variant in lfp_variants or LFP_VARIANTS:
+            for _ in range(repeats):
+                backend.insert_session(nwbfile_path)
+                record = run_stage(
+                    insert_lfp, "insert_lfp/analysis_write", nwbfile_path=nwbfile_path, **LFP_VARIANTS[variant]
+                )
+                seconds = record["duration"]
+                params = dict(variant=variant, **LFP_VARIANTS[variant])
+                results.append(make_result("insert_lfp", "analysis_write", size, params, seconds, num_bytes=num_bytes))
+        if num_units == 0:
+            continue
+        for _ in range(repeats):
+            backend.insert_session(nwbfile_path)
+            record = run_stage(
+                insert_sorting,
+                "insert_sorting/db_insert",
+                nwbfile_path=nwbfile_path,
+                annotation_to_type=ANNOTATION_TO_TYPE,
+            )
+            seconds, num_rows = record["duration"], record["rows"]
+            results.append(make_result("insert_sorting", "db_insert", size, {}, seconds, rows=num_rows))
+    return results
+
+
+class FakeBackend:
+    """The in-process fake of the spyglass tables, in a temporary directory."""
+
+    name = "fake"
+
+    def __init__(self, base_dir: Path):
+        import fake_spyglass
+
+        self.fake = fake_spyglass.install(base_dir)
+
+    def insert_session(self, nwbfile_path: Path):
+        self.fake.close()
+        for table in self.fake.tables.values():
+            table.rows.clear()
+        self.fake.insert_sessions(str(nwbfile_path))
+
+
+class DatabaseBackend:
+    """A real spyglass database, e.g. a local MySQL container."""
+
+    name = "mysql"
+
+    def __init__(self, dj_local_conf_path: str = None):
+        from spyglass_setup import load_dj_config
+
+        load_dj_config(dj_local_conf_path)
+
+    def insert_session(self, nwbfile_path: Path):
+        import spyglass.common as sgc
+        import spyglass.data_import as sgi
+        from batch_insert import delete_session
+        from spyglass.utils.nwb_helper_fn import get_nwb_copy_filename
+
+        delete_session(get_nwb_copy_filename(nwbfile_path.name))
+        # the files of every size share the probe type of add_probe with different shanks, and spyglass would reuse
+        # the probe of the previous size
+        if sgc.ProbeType & {"probe_type": "my_probe_type"}:
+            (sgc.ProbeType & {"probe_type": "my_probe_type"}).delete(safemode=False)
+        sgi.insert_sessions(str(nwbfile_path), rollback_on_fail=True, raise_err=True)
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results: list):
+    """Print the median time and throughput of each benchmark."""
+    groups = {}
+    for result in results:
+        key = (result["benchmark"], result["size"], json.dumps(result["params"], sort_keys=True, default=str))
+        groups.setdefault(key, []).append(result)
+    for (benchmark, size, params), group in groups.items():
+        seconds = statistics.median(result["seconds"] for result in group)
+        throughput = statistics.median(result["throughput"] for result in group)
+        print(
+            f"{benchmark:<16} {size:<8} {params:<60} {seconds:8.3f} s {throughput:12.1f} {group[0]['throughput_unit']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the insert pipeline across data sizes.")
+    parser.add_argument("--sizes", nargs="+", default=["small"], choices=list(SIZES))
+    parser.add_argument("--lfp-variants", nargs="+", default=list(LFP_VARIANTS), choices=list(LFP_VARIANTS))
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs of each benchmark.")
+    parser.add_argument("--backend", default="fake", choices=["fake", "mysql"])
+    parser.add_argument("--dj-config", default=None, help="Datajoint config of the mysql backend.")
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="Directory of the generated NWB files (default: a temporary directory for the fake backend, the "
+        "spyglass raw directory for the mysql backend).",
+    )
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--trace", type=Path, default=None, help="JSON lines file of the per-stage records.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.backend == "fake":
+            backend = FakeBackend(Path(temp_dir) / "spyglass")
+            data_dir = args.data_dir or Path(temp_dir)
+        else:
+            backend = DatabaseBackend(args.dj_config)
+            from spyglass.settings import raw_dir
+
+            data_dir = args.data_dir or Path(raw_dir)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        nwbfile_paths = generate_fixtures(data_dir, args.sizes)
+        sinks = [] if args.trace is None else [JsonLinesSink(args.trace)]
+        with tracing(*sinks):
+            results = run_benchmarks(nwbfile_paths, backend, repeats=args.repeats, lfp_variants=args.lfp_variants)
+        if args.backend == "fake":
+            backend.fake.close()
+
+    output = dict(
+        metadata=dict(
+            git_commit=get_git_commit(),
+            timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            backend=args.backend,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            repeats=args.repeats,
+            sizes={size: SIZES[size] for size in args.sizes},
+        ),
+        results=results,
+    )
+    args.output.write_text(json.dumps(output, indent=2, default=str))
+    print_summary(results)
+    print(f"Benchmark results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
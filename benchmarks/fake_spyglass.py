@@ -0,0 +1,371 @@
+"""
+In-process stand-in for the spyglass tables used by the insert scripts.
+
+install() registers fake spyglass modules in sys.modules, so that the lazily imported spyglass modules of the insert
+scripts (see insert/spyglass_setup.py) resolve to in-memory tables backed by a temporary directory instead of a
+database. Only the interfaces the insert scripts use are implemented, with the same call signatures, so that the
+benchmarks measure the file I/O and the Python work of the scripts themselves rather than database latency.
+"""
+
+import copy
+import sys
+import types
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pynwb
+from pynwb import NWBHDF5IO
+
+# the fields of the raw NWB file kept in a new analysis file, as in spyglass
+NWB_KEEP_FIELDS = (
+    "devices",
+    "electrode_groups",
+    "electrodes",
+    "experiment_description",
+    "experimenter",
+    "file_create_date",
+    "identifier",
+    "intervals",
+    "institution",
+    "lab",
+    "session_description",
+    "session_id",
+    "session_start_time",
+    "subject",
+    "timestamps_reference_time",
+)
+
+
+class FakeConnection:
+    """A connection whose transactions only count how often they are opened."""
+
+    def __init__(self):
+        self.num_transactions = 0
+
+    @property
+    @contextmanager
+    def transaction(self):
+        self.num_transactions += 1
+        yield self
+
+
+class FakeTable:
+    """
+    A table held in memory as a list of row dicts.
+
+    Like a datajoint table, it can be used as a class or an instance (`Table.insert1(...)` and `Table().insert1(...)`)
+    and restricted with `&` by a dict. Restrictions are views on the rows of the table they restrict.
+    """
+
+    def __init__(self, name: str, connection: FakeConnection):
+        self.name = name
+        self.connection = connection
+        self.rows = []
+        self._restriction = {}
+        self._parent = self
+
+    def __call__(self):
+        return self
+
+    def __and__(self, restriction: dict):
+        view = copy.copy(self)
+        view._restriction = {**self._restriction, **restriction}
+        view._parent = self._parent
+        return view
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __len__(self):
+        return len(self._restricted_rows())
+
+    def _restricted_rows(self):
+        rows = self._parent.rows
+        if not self._restriction:
+            return rows
+        return [row for row in rows if all(row.get(key) == value for key, value in self._restriction.items())]
+
+    def insert1(self, row: dict, **kwargs):
+        self.insert([row], **kwargs)
+
+    def insert(self, rows, skip_duplicates: bool = False, **kwargs):
+        rows = [dict(row) for row in rows]
+        if skip_duplicates:
+            existing = {_row_key(row) for row in self._parent.rows}
+            rows = [row for row in rows if _row_key(row) not in existing]
+        self._parent.rows.extend(rows)
+
+    def fetch(self, *attrs, as_dict: bool = False):
+        rows = self._restricted_rows()
+        if as_dict or not attrs:
+            return [dict(row) for row in rows]
+        if len(attrs) == 1:
+            return np.asarray([row[attrs[0]] for row in rows])
+        return tuple(np.asarray([row[attr] for row in rows]) for attr in attrs)
+
+    def fetch1(self, *attrs):
+        rows = self._restricted_rows()
+        if len(rows) != 1:
+            raise ValueError(f"fetch1 on {self.name} expected one row, got {len(rows)}")
+        if not attrs or attrs == ("KEY",):
+            return dict(rows[0])
+        if len(attrs) == 1:
+            return rows[0][attrs[0]]
+        return tuple(rows[0][attr] for attr in attrs)
+
+    def delete(self, **kwargs):
+        deleted = {id(row) for row in self._restricted_rows()}
+        self._parent.rows[:] = [row for row in self._parent.rows if id(row) not in deleted]
+
+    delete_quick = delete
+
+    def merge_delete(self, restriction: dict, **kwargs):
+        (self & restriction).delete()
+
+
+class FakeImportedLFP(FakeTable):
+    """The ImportedLFP table, whose fetch_nwb opens the analysis files of its (restricted) rows."""
+
+    def __init__(self, name: str, connection: FakeConnection, fake: "FakeSpyglass"):
+        super().__init__(name, connection)
+        self.fake = fake
+
+    def fetch_nwb(self):
+        return self.fake.fetch_lfp_nwb(self)
+
+
+class FakeLFPElectrodeGroup(FakeTable):
+    """The LFPElectrodeGroup table, whose delete cascades to its electrodes and LFP, as in spyglass."""
+
+    def __init__(self, name: str, connection: FakeConnection, fake: "FakeSpyglass"):
+        super().__init__(name, connection)
+        self.fake = fake
+
+    def delete(self, **kwargs):
+        groups = {(row["nwb_file_name"], row["lfp_electrode_group_name"]) for row in self._restricted_rows()}
+        super().delete(**kwargs)
+        for name in ("LFPElectrode", "ImportedLFP"):
+            table = self.fake.tables[name]
+            table.rows[:] = [
+                row for row in table.rows if (row["nwb_file_name"], row["lfp_electrode_group_name"]) not in groups
+            ]
+
+
+class FakeSessionTable(FakeTable):
+    """The Nwbfile or Session table, whose delete cascades to every row of the deleted sessions, as in spyglass."""
+
+    def __init__(self, name: str, connection: FakeConnection, fake: "FakeSpyglass"):
+        super().__init__(name, connection)
+        self.fake = fake
+
+    def delete(self, **kwargs):
+        nwb_file_names = {row["nwb_file_name"] for row in self._restricted_rows()}
+        merge_ids = {
+            row["merge_id"]
+            for row in self.fake.tables["ImportedSpikeSorting"].rows
+            if row["nwb_file_name"] in nwb_file_names
+        }
+        for table in self.fake.tables.values():
+            table.rows[:] = [
+                row
+                for row in table.rows
+                if row.get("nwb_file_name") not in nwb_file_names and row.get("spikesorting_merge_id") not in merge_ids
+            ]
+
+
+def _row_key(row: dict):
+    return tuple(sorted((key, str(value)) for key, value in row.items()))
+
+
+class FakeSpyglass:
+    """The state of a fake spyglass database: its directories and tables."""
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = Path(base_dir)
+        self.raw_dir = self.base_dir / "raw"
+        self.analysis_dir = self.base_dir / "analysis"
+        self.raw_dir.mkdir(parents=True, exist_ok=True)
+        self.analysis_dir.mkdir(parents=True, exist_ok=True)
+        self.connection = FakeConnection()
+        self._open_ios = []
+
+        table_names = (
+            "ProbeType",
+            "AnalysisNwbfile",
+            "LFPElectrode",
+            "LFPOutput",
+            "ImportedSpikeSorting",
+            "SortedSpikesGroup",
+            "SortedSpikesGroupUnits",
+            "UnitSelectionParams",
+            "UnitAnnotation",
+            "UnitAnnotationAnnotation",
+        )
+        self.tables = {name: FakeTable(name, self.connection) for name in table_names}
+        self.tables["ImportedLFP"] = FakeImportedLFP("ImportedLFP", self.connection, self)
+        self.tables["LFPElectrodeGroup"] = FakeLFPElectrodeGroup("LFPElectrodeGroup", self.connection, self)
+        self.tables["Nwbfile"] = FakeSessionTable("Nwbfile", self.connection, self)
+        self.tables["Session"] = FakeSessionTable("Session", self.connection, self)
+
+        tables = self.tables
+        tables["Nwbfile"].get_abs_path = self.get_raw_abs_path
+        tables["AnalysisNwbfile"].create = self.create_analysis_file
+        tables["AnalysisNwbfile"].get_abs_path = self.get_analysis_abs_path
+        tables["AnalysisNwbfile"].add = self.add_analysis_file
+        tables["LFPElectrodeGroup"].create_lfp_electrode_group = self.create_lfp_electrode_group
+        tables["LFPElectrodeGroup"].LFPElectrode = tables["LFPElectrode"]
+        tables["SortedSpikesGroup"].create_group = self.create_sorted_spikes_group
+        tables["SortedSpikesGroup"].fetch_spike_data = self.fetch_spike_data
+        tables["SortedSpikesGroup"].Units = tables["SortedSpikesGroupUnits"]
+        tables["UnitSelectionParams"].insert_default = self.insert_default_unit_selection_params
+        tables["UnitAnnotation"].Annotation = tables["UnitAnnotationAnnotation"]
+
+    @staticmethod
+    def get_nwb_copy_filename(nwb_file_name: str) -> str:
+        return f"{Path(nwb_file_name).stem}_.nwb"
+
+    def get_raw_abs_path(self, nwb_file_name: str) -> str:
+        return str(self.raw_dir / nwb_file_name)
+
+    def get_analysis_abs_path(self, analysis_file_name: str) -> str:
+        return str(self.analysis_dir / analysis_file_name)
+
+    def insert_sessions(self, nwb_file_names, rollback_on_fail: bool = False, raise_err: bool = False):
+        """Register NWB files as sessions; the spyglass copy of each file is a symlink to it."""
+        if isinstance(nwb_file_names, (str, Path)):
+            nwb_file_names = [nwb_file_names]
+        for nwb_file_name in nwb_file_names:
+            nwbfile_path = Path(nwb_file_name).resolve()
+            nwb_copy_file_name = self.get_nwb_copy_filename(nwbfile_path.name)
+            copy_path = self.raw_dir / nwb_copy_file_name
+            if copy_path.is_symlink() or copy_path.exists():
+                copy_path.unlink()
+            copy_path.symlink_to(nwbfile_path)
+            key = dict(nwb_file_name=nwb_copy_file_name)
+            self.tables["Nwbfile"].insert1(dict(key, nwb_file_abs_path=str(copy_path)))
+            self.tables["Session"].insert1(key)
+            with h5py.File(nwbfile_path, "r") as file:
+                if "units" in file:
+                    object_id = file["units"].attrs["object_id"]
+                    self.tables["ImportedSpikeSorting"].insert1(
+                        dict(key, merge_id=str(uuid.uuid4()), object_id=object_id)
+                    )
+
+    def create_analysis_file(self, nwb_file_name: str) -> str:
+        """Create an analysis file holding the metadata of the spyglass copy of an NWB file, as spyglass does."""
+        analysis_file_name = f"{Path(nwb_file_name).stem}{uuid.uuid4().hex[:10].upper()}.nwb"
+        with NWBHDF5IO(self.get_raw_abs_path(nwb_file_name), "r", load_namespaces=True) as io:
+            nwbfile = io.read()
+            for field in nwbfile.fields:
+                nwb_object = getattr(nwbfile, field)
+                if field not in NWB_KEEP_FIELDS and isinstance(nwb_object, pynwb.core.LabelledDict):
+                    for module in list(nwb_object.keys()):
+                        nwb_object.pop(module)
+            with NWBHDF5IO(self.get_analysis_abs_path(analysis_file_name), "w") as export_io:
+                export_io.export(io, nwbfile)
+        return analysis_file_name
+
+    def add_analysis_file(self, nwb_file_name: str, analysis_file_name: str):
+        self.tables["AnalysisNwbfile"].insert1(dict(nwb_file_name=nwb_file_name, analysis_file_name=analysis_file_name))
+
+    def insert_default_unit_selection_params(self):
+        self.tables["UnitSelectionParams"].insert1(dict(unit_filter_params_name="all_units"), skip_duplicates=True)
+
+    def create_lfp_electrode_group(self, nwb_file_name: str, group_name: str, electrode_list: list):
+        key = dict(nwb_file_name=nwb_file_name, lfp_electrode_group_name=group_name)
+        self.tables["LFPElectrodeGroup"].insert1(key, skip_duplicates=True)
+        self.tables["LFPElectrode"].insert(
+            [dict(key, electrode_id=int(electrode_id)) for electrode_id in electrode_list], skip_duplicates=True
+        )
+
+    def fetch_lfp_nwb(self, table: FakeTable):
+        """Open the analysis files of the rows of a (restricted) ImportedLFP table and return their LFP series."""
+        results = []
+        for row in table.fetch(as_dict=True):
+            io = NWBHDF5IO(self.get_analysis_abs_path(row["analysis_file_name"]), "r", load_namespaces=True)
+            self._open_ios.append(io)  # spyglass keeps fetched files open too
+            results.append(dict(row, lfp=io.read().objects[row["lfp_object_id"]]))
+        return results
+
+    def create_sorted_spikes_group(self, group_name: str, nwb_file_name: str, keys: list, **kwargs):
+        group_key = dict(nwb_file_name=nwb_file_name, sorted_spikes_group_name=group_name)
+        self.tables["SortedSpikesGroup"].insert1(group_key, skip_duplicates=True)
+        self.tables["SortedSpikesGroupUnits"].insert(
+            [dict(group_key, spikesorting_merge_id=key["spikesorting_merge_id"]) for key in keys],
+            skip_duplicates=True,
+        )
+
+    def fetch_spike_data(self, key: dict, return_unit_ids: bool = False):
+        """Read the spike trains of the units of a sorted spikes group from the units tables of the sorted files."""
+        group_key = {name: key[name] for name in ("nwb_file_name", "sorted_spikes_group_name")}
+        merge_ids = (self.tables["SortedSpikesGroupUnits"] & group_key).fetch("spikesorting_merge_id")
+        spike_trains, unit_ids = [], []
+        for merge_id in merge_ids:
+            nwb_file_name = (self.tables["ImportedSpikeSorting"] & {"merge_id": merge_id}).fetch1("nwb_file_name")
+            with h5py.File(self.get_raw_abs_path(nwb_file_name), "r") as file:
+                spike_times = file["units/spike_times"][:]
+                spike_times_index = file["units/spike_times_index"][:]
+                ids = file["units/id"][:]
+            spike_trains.extend(np.split(spike_times, spike_times_index[:-1]))
+            # spyglass numbers the units of a sorting by their row in its units table
+            unit_ids.extend(dict(spikesorting_merge_id=merge_id, unit_id=unit_id) for unit_id in range(len(ids)))
+        if return_unit_ids:
+            return spike_trains, unit_ids
+        return spike_trains
+
+    def close(self):
+        for io in self._open_ios:
+            io.close()
+        self._open_ios.clear()
+
+
+def install(base_dir: Path) -> FakeSpyglass:
+    """
+    Register the fake spyglass modules in sys.modules, backed by a FakeSpyglass in `base_dir`.
+
+    Must be called before the spyglass modules of the insert scripts are first used.
+
+    Returns
+    -------
+    FakeSpyglass
+        The fake database, for inspecting its tables.
+    """
+    fake = FakeSpyglass(base_dir)
+    tables = fake.tables
+    modules = {
+        "spyglass": {},
+        "spyglass.common": dict(
+            Nwbfile=tables["Nwbfile"],
+            Session=tables["Session"],
+            ProbeType=tables["ProbeType"],
+            AnalysisNwbfile=tables["AnalysisNwbfile"],
+        ),
+        "spyglass.data_import": dict(insert_sessions=fake.insert_sessions),
+        "spyglass.utils": {},
+        "spyglass.utils.nwb_helper_fn": dict(get_nwb_copy_filename=fake.get_nwb_copy_filename),
+        "spyglass.lfp": dict(ImportedLFP=tables["ImportedLFP"]),
+        "spyglass.lfp.lfp_electrode": dict(LFPElectrodeGroup=tables["LFPElectrodeGroup"]),
+        "spyglass.lfp.lfp_merge": dict(LFPOutput=tables["LFPOutput"]),
+        "spyglass.spikesorting": {},
+        "spyglass.spikesorting.spikesorting_merge": dict(
+            SpikeSortingOutput=types.SimpleNamespace(ImportedSpikeSorting=tables["ImportedSpikeSorting"])
+        ),
+        "spyglass.spikesorting.analysis": {},
+        "spyglass.spikesorting.analysis.v1": {},
+        "spyglass.spikesorting.analysis.v1.group": dict(
+            SortedSpikesGroup=tables["SortedSpikesGroup"], UnitSelectionParams=tables["UnitSelectionParams"]
+        ),
+        "spyglass.spikesorting.analysis.v1.unit_annotation": dict(UnitAnnotation=tables["UnitAnnotation"]),
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+    for name in modules:
+        parent_name, _, child_name = name.rpartition(".")
+        if parent_name:
+            setattr(sys.modules[parent_name], child_name, sys.modules[name])
+    return fake
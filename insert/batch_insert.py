@@ -0,0 +1,419 @@
+"""Insert many NWB files into a spyglass database in parallel, one session per worker process at a time."""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import datajoint as dj
+from tqdm import tqdm
+
+import ingestion_cache
+from batch_planner import check_disk_space, load_rates, plan_batch, print_plan, schedule_largest_first
+from insert_lfp import COPY_MODES, delete_lfp, insert_lfp
+from insert_sorting import delete_annotations, get_inserted_annotations, insert_sorting
+from instrumentation import JsonLinesSink, add_sink
+from spyglass_setup import lazy_import, load_dj_config
+
+sgc = lazy_import("spyglass.common")
+sgi = lazy_import("spyglass.data_import")
+nwb_helper_fn = lazy_import("spyglass.utils.nwb_helper_fn")
+sglfp = lazy_import("spyglass.lfp")
+
+
+def get_nwbfile_paths(paths_or_patterns: list) -> list:
+    """
+    Expand a list of NWB file paths and glob patterns into a sorted list of unique NWB file paths.
+
+    Parameters
+    ----------
+    paths_or_patterns : list of str or Path
+        Paths to NWB files and/or glob patterns (e.g. "/data/raw/*.nwb", "/data/**/*.nwb").
+
+    Returns
+    -------
+    list of Path
+        The matching NWB file paths.
+    """
+    nwbfile_paths = set()
+    for path_or_pattern in paths_or_patterns:
+        matches = glob.glob(str(path_or_pattern), recursive=True)
+        if not matches:
+            raise FileNotFoundError(f"No NWB files match {path_or_pattern}.")
+        nwbfile_paths.update(Path(match).resolve() for match in matches)
+    return sorted(nwbfile_paths)
+
+
+def delete_session(nwb_copy_file_name: str):
+    """Delete a session and its NWB file entry (and everything downstream of them) from the database."""
+    if sgc.Session & {"nwb_file_name": nwb_copy_file_name}:
+        (sgc.Session & {"nwb_file_name": nwb_copy_file_name}).delete(safemode=False)
+    if sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}:
+        (sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}).delete(safemode=False)
+
+
+def insert_session_incrementally(
+    nwbfile_path: Path,
+    cache_dir: Path,
+    lfp: bool = False,
+    lfp_kwargs: dict = None,
+    annotation_to_type: dict = None,
+) -> set:
+    """
+    Insert the parts of one NWB file that changed since it was last inserted.
+
+    The session, LFP series and unit annotation columns of the file are fingerprinted (see ingestion_cache) and
+    compared with the fingerprints cached in `cache_dir` when they were last inserted. If the session changed (or is
+    not in the database) it is deleted and reinserted along with everything downstream of it. Otherwise only a changed
+    LFP series is deleted and reinserted, and only changed annotations are deleted and reinserted. The cache entry is
+    saved after each part, so a rerun after a failure resumes with the parts that were not inserted, and the LFP is
+    inserted with a checkpoint journal in `cache_dir`/journal, so a rerun after a failed database insert of the LFP
+    reuses its analysis file.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the NWB file to insert.
+    cache_dir : Path
+        The directory of the ingestion cache, with one entry per session.
+    lfp : bool, default: False
+        Whether to insert the LFP data of the file with insert_lfp.
+    lfp_kwargs : dict, optional
+        Extra keyword arguments passed to insert_lfp. Changing them reinserts the LFP data.
+    annotation_to_type : dict, optional
+        A dictionary mapping annotation names to their types (label or quantification). If given, the unit
+        annotations of the file are inserted with insert_sorting.
+
+    Returns
+    -------
+    set of str
+        The parts that were (re)inserted: "session", "lfp" and/or "annotation/<name>".
+    """
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    annotation_to_type = annotation_to_type or {}
+    cached = ingestion_cache.load_cache_entry(cache_dir, nwb_copy_file_name)
+    fingerprint = ingestion_cache.fingerprint_nwbfile(
+        nwbfile_path,
+        annotation_names=list(annotation_to_type),
+        settings={ingestion_cache.LFP: lfp_kwargs or {}},
+        cached=cached,
+    )
+    changed = ingestion_cache.get_changed_objects(cached, fingerprint)
+    # the entry only records the parts whose insertion completed
+    entry = dict(
+        file=fingerprint["file"], content=fingerprint["content"], objects=dict((cached or {}).get("objects", {}))
+    )
+    inserted = set()
+
+    if ingestion_cache.SESSION in changed or not sgc.Session & {"nwb_file_name": nwb_copy_file_name}:
+        delete_session(nwb_copy_file_name)
+        # a stale spyglass copy of the file would be reused by insert_sessions
+        Path(sgc.Nwbfile.get_abs_path(nwb_copy_file_name)).unlink(missing_ok=True)
+        entry["objects"] = {}
+        ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+        sgi.insert_sessions(str(nwbfile_path), rollback_on_fail=True, raise_err=True)
+        entry["objects"][ingestion_cache.SESSION] = fingerprint["objects"][ingestion_cache.SESSION]
+        ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+        inserted.add(ingestion_cache.SESSION)
+        changed = set(fingerprint["objects"])
+
+    if lfp and (ingestion_cache.LFP in changed or not sglfp.ImportedLFP & {"nwb_file_name": nwb_copy_file_name}):
+        entry["objects"].pop(ingestion_cache.LFP, None)
+        ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+        delete_lfp(nwb_copy_file_name)
+        # a failed insert_lfp resumes from its journal rather than writing the analysis file again
+        insert_lfp(nwbfile_path=nwbfile_path, **{"journal_dir": Path(cache_dir) / "journal", **(lfp_kwargs or {})})
+        entry["objects"][ingestion_cache.LFP] = fingerprint["objects"][ingestion_cache.LFP]
+        ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+        inserted.add(ingestion_cache.LFP)
+
+    if annotation_to_type:
+        inserted_annotations = get_inserted_annotations(nwb_copy_file_name)
+        changed_annotations = {
+            annotation: annotation_type
+            for annotation, annotation_type in annotation_to_type.items()
+            if ingestion_cache.annotation_object(annotation) in changed or annotation not in inserted_annotations
+        }
+        if changed_annotations:
+            objects = [ingestion_cache.annotation_object(annotation) for annotation in changed_annotations]
+            for name in objects:
+                entry["objects"].pop(name, None)
+            ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+            delete_annotations(nwb_copy_file_name, list(changed_annotations))
+            insert_sorting(nwbfile_path=nwbfile_path, annotation_to_type=changed_annotations)
+            entry["objects"].update({name: fingerprint["objects"][name] for name in objects})
+            ingestion_cache.save_cache_entry(cache_dir, nwb_copy_file_name, entry)
+            inserted.update(objects)
+    return inserted
+
+
+def insert_session(
+    nwbfile_path: Path,
+    lfp: bool = False,
+    lfp_kwargs: dict = None,
+    annotation_to_type: dict = None,
+    max_retries: int = 1,
+    cache_dir: Path = None,
+) -> dict:
+    """
+    Insert one NWB file into the database, retrying from a clean state on failure.
+
+    Any existing entry of the session is deleted first, then the session is inserted with sgi.insert_sessions followed
+    by insert_lfp and/or insert_sorting. If an attempt fails, the partially inserted session is deleted before the
+    next attempt. Errors are returned rather than raised so that one bad file does not stop a batch.
+
+    With a `cache_dir`, the file is instead inserted with insert_session_incrementally: only the parts of the file that
+    changed since it was last inserted are reinserted, and the parts inserted by a failed attempt are kept.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the NWB file to insert.
+    lfp : bool, default: False
+        Whether to insert the LFP data of the file with insert_lfp.
+    lfp_kwargs : dict, optional
+        Extra keyword arguments passed to insert_lfp.
+    annotation_to_type : dict, optional
+        A dictionary mapping annotation names to their types (label or quantification). If given, the unit
+        annotations of the file are inserted with insert_sorting.
+    max_retries : int, default: 1
+        The number of times a failed file is retried.
+    cache_dir : Path, optional
+        The directory of the ingestion cache of incremental insertion.
+
+    Returns
+    -------
+    dict
+        The outcome of the insertion with keys nwbfile_path, status ("success" or "failed"), attempts, duration (s)
+        and error (the traceback of the last failure, or None). Incremental insertion adds the inserted
+        parts (see insert_session_incrementally).
+    """
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    result = dict(nwbfile_path=str(nwbfile_path), status="failed", attempts=0, duration=0.0, error=None)
+    start_time = time.perf_counter()
+    for attempt in range(1, max_retries + 2):
+        result["attempts"] = attempt
+        try:
+            if cache_dir is not None:
+                inserted = insert_session_incrementally(
+                    nwbfile_path,
+                    cache_dir=cache_dir,
+                    lfp=lfp,
+                    lfp_kwargs=lfp_kwargs,
+                    annotation_to_type=annotation_to_type,
+                )
+                result["inserted"] = sorted(inserted)
+            else:
+                delete_session(nwb_copy_file_name)
+                sgi.insert_sessions(str(nwbfile_path), rollback_on_fail=True, raise_err=True)
+                if lfp:
+                    insert_lfp(nwbfile_path=nwbfile_path, **(lfp_kwargs or {}))
+                if annotation_to_type is not None:
+                    insert_sorting(nwbfile_path=nwbfile_path, annotation_to_type=annotation_to_type)
+        except Exception:
+            result["error"] = traceback.format_exc()
+            continue
+        result["status"] = "success"
+        result["error"] = None
+        break
+    if result["status"] == "failed" and cache_dir is None:
+        try:
+            delete_session(nwb_copy_file_name)
+        except Exception:
+            pass  # the original error is the one worth reporting
+    result["duration"] = time.perf_counter() - start_time
+    return result
+
+
+def _init_worker(dj_local_conf_path: str = None, trace_path: str = None):
+    # every worker process needs its own database connection
+    load_dj_config(dj_local_conf_path)
+    dj.conn(reset=True)
+    if trace_path is not None:
+        add_sink(JsonLinesSink(trace_path))
+
+
+def batch_insert(
+    nwbfile_paths: list,
+    num_workers: int = None,
+    lfp: bool = False,
+    lfp_kwargs: dict = None,
+    annotation_to_type: dict = None,
+    max_retries: int = 1,
+    dj_local_conf_path: str = None,
+    trace_path: str = None,
+    cache_dir: Path = None,
+    rates: dict = None,
+    disk_dir: Path = None,
+    dry_run: bool = False,
+) -> list:
+    """
+    Insert many NWB files into the database with a pool of worker processes.
+
+    Each worker opens its own database connection and inserts one file at a time with insert_session, so a failing
+    file only affects itself. A progress bar tracks completed files and a summary is printed at the end.
+
+    Before inserting, the bytes, rows and duration of each file are estimated from its structure (see
+    batch_planner.estimate_insert) and the plan is printed. The files are submitted largest first, so that the workers
+    do not end the batch waiting for one large session submitted last.
+
+    Parameters
+    ----------
+    nwbfile_paths : list of str or Path
+        Paths to NWB files and/or glob patterns.
+    num_workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    lfp : bool, default: False
+        Whether to insert the LFP data of each file with insert_lfp.
+    lfp_kwargs : dict, optional
+        Extra keyword arguments passed to insert_lfp.
+    annotation_to_type : dict, optional
+        A dictionary mapping annotation names to their types (label or quantification). If given, the unit
+        annotations of each file are inserted with insert_sorting.
+    max_retries : int, default: 1
+        The number of times a failed file is retried.
+    dj_local_conf_path : str, optional
+        The datajoint config loaded by each worker (see spyglass_setup.load_dj_config). Defaults to the config in
+        the DJ_LOCAL_CONF_PATH environment variable.
+    trace_path : str, optional
+        A JSON lines file to which every worker appends the record of each insert stage (see instrumentation.stage).
+    cache_dir : Path, optional
+        The directory of the ingestion cache. If given, only the parts of each file that changed since it was last
+        inserted are reinserted (see insert_session_incrementally).
+    rates : dict, optional
+        The throughput of each insert stage used for the estimates (see batch_planner.load_rates). Defaults to
+        batch_planner.DEFAULT_RATES.
+    disk_dir : Path, optional
+        The directory where the spyglass copies and analysis files are written. If given, the batch is not started
+        when its estimated disk space exceeds the free space of that directory, or of the `zarr_staging_dir` of
+        `lfp_kwargs` for its Zarr staging stores.
+    dry_run : bool, default: False
+        Whether to only print the plan of the batch, without inserting anything.
+
+    Returns
+    -------
+    list of dict
+        The outcome of each file (see insert_session), in the order the files finished, or with `dry_run=True` the
+        estimate of each file (see batch_planner.estimate_insert), in the order they would be submitted.
+    """
+    nwbfile_paths = get_nwbfile_paths(nwbfile_paths)
+    num_workers = min(num_workers or os.cpu_count(), len(nwbfile_paths))
+    estimates = schedule_largest_first(plan_batch(nwbfile_paths, lfp, lfp_kwargs, annotation_to_type, rates))
+    print_plan(estimates, num_workers)
+    if disk_dir is not None:
+        check_disk_space(
+            estimates, disk_dir, staging_dir=(lfp_kwargs or {}).get("zarr_staging_dir"), num_workers=num_workers
+        )
+    if dry_run:
+        return estimates
+    start_time = time.perf_counter()
+    results = []
+    # spawn rather than fork so that workers never share the parent's database socket
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(dj_local_conf_path, trace_path),
+    ) as executor:
+        futures = [
+            executor.submit(
+                insert_session,
+                nwbfile_path=nwbfile_path,
+                lfp=lfp,
+                lfp_kwargs=lfp_kwargs,
+                annotation_to_type=annotation_to_type,
+                max_retries=max_retries,
+                cache_dir=cache_dir,
+            )
+            for nwbfile_path in [Path(estimate["nwbfile_path"]) for estimate in estimates]
+        ]
+        with tqdm(total=len(futures), desc="Inserting sessions") as progress_bar:
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                progress_bar.update()
+                progress_bar.set_postfix(failed=sum(r["status"] == "failed" for r in results))
+    print_summary(results, total_duration=time.perf_counter() - start_time, num_workers=num_workers)
+    return results
+
+
+def print_summary(results: list, total_duration: float, num_workers: int):
+    """Print an aggregate report of a batch insertion."""
+    failures = [result for result in results if result["status"] == "failed"]
+    retried = [result for result in results if result["status"] == "success" and result["attempts"] > 1]
+    busy_time = sum(result["duration"] for result in results)
+    print(
+        f"Inserted {len(results) - len(failures)}/{len(results)} sessions in {total_duration:.1f} s "
+        f"with {num_workers} workers ({busy_time:.1f} s of worker time, {len(retried)} succeeded after a retry)"
+    )
+    for result in failures:
+        last_error_line = result["error"].strip().splitlines()[-1]
+        print(f"FAILED {result['nwbfile_path']} after {result['attempts']} attempts: {last_error_line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Insert many NWB files into a spyglass database in parallel.")
+    parser.add_argument("nwbfile_paths", nargs="+", help="NWB file paths and/or glob patterns.")
+    parser.add_argument("--num-workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--lfp", action="store_true", help="Insert the LFP data of each file.")
+    parser.add_argument(
+        "--annotation",
+        action="append",
+        default=None,
+        metavar="NAME=TYPE",
+        help="Insert the units table column NAME as a UnitAnnotation of TYPE (label or quantification).",
+    )
+    parser.add_argument("--max-retries", type=int, default=1, help="Number of retries of a failed file.")
+    parser.add_argument("--dj-config", default=None, help="Path to the datajoint config (default: $DJ_LOCAL_CONF_PATH)")
+    parser.add_argument(
+        "--trace", default=None, help="JSON lines file to record the duration, I/O and rows of each stage."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Ingestion cache directory: only reinsert the parts of each file that changed since its last insertion.",
+    )
+    parser.add_argument(
+        "--rates", default=None, help="Benchmark results (see benchmarks/bench_insert.py) calibrating the estimates."
+    )
+    parser.add_argument(
+        "--disk-dir", default=None, help="Do not start the batch if its estimated size exceeds the free space here."
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Only print the estimated cost of each file.")
+    parser.add_argument("--copy-mode", choices=COPY_MODES, default=None, help="How insert_lfp writes the LFP data.")
+    parser.add_argument(
+        "--zarr-staging-dir",
+        default=None,
+        help="Local directory of the Zarr stores of --copy-mode zarr (default: the directory of the analysis files).",
+    )
+    args = parser.parse_args()
+
+    annotation_to_type = None
+    if args.annotation is not None:
+        annotation_to_type = dict(annotation.split("=", maxsplit=1) for annotation in args.annotation)
+    lfp_kwargs = dict(copy_mode=args.copy_mode, zarr_staging_dir=args.zarr_staging_dir)
+    results = batch_insert(
+        nwbfile_paths=args.nwbfile_paths,
+        num_workers=args.num_workers,
+        lfp=args.lfp,
+        lfp_kwargs={name: value for name, value in lfp_kwargs.items() if value is not None},
+        annotation_to_type=annotation_to_type,
+        max_retries=args.max_retries,
+        dj_local_conf_path=args.dj_config,
+        trace_path=args.trace,
+        cache_dir=args.cache_dir,
+        rates=None if args.rates is None else load_rates(args.rates),
+        disk_dir=args.disk_dir,
+        dry_run=args.dry_run,
+    )
+    if not args.dry_run and any(result["status"] == "failed" for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Pre-flight cost estimates of the inserts of NWB files, and a largest-first schedule of a batch.
+
+The cost of inserting a file is estimated from its structural index (see nwb_index) without reading any data, except
+the first and last timestamps of raw series to decimate (see get_series_rate): the bytes read, written and left on
+disk, the database rows inserted and the expected duration, from the throughput of each stage measured by
+benchmarks/bench_insert.py (see load_rates):
+
+- the session: sgi.insert_sessions copies the whole file into the spyglass raw directory (the "file_read" rate),
+- the LFP: insert_lfp copies the data of each LFP series into an analysis file (the "analysis_write" rate of the
+  insert_lfp variant used, e.g. "stream" or "link"),
+- the rows: the LFP and unit annotation rows (the "db_insert" rate).
+
+The estimates are upper bounds where the index cannot tell: every channel of the LFP series is counted even when
+electrodes are selected, and everything is counted for a file inserted incrementally.
+
+Files are then scheduled largest first: workers that take the next file as soon as they are free then finish within
+4/3 of the optimal makespan, rather than idling while one large session submitted last runs alone.
+"""
+
+import heapq
+import json
+import os
+import shutil
+import statistics
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from decimation import get_decimation_factor
+from ingestion_cache import LFP_CONTAINER_TYPES
+from nwb_index import find_objects, load_index
+
+# conservative throughputs used for the stages that were not benchmarked: MB/s for the file read and the analysis
+# write of each insert_lfp variant, rows/s for the database inserts
+DEFAULT_RATES = {
+    "file_read": 100.0,
+    "analysis_write": {"copy": 50.0, "stream": 30.0, "pipelined": 80.0, "link": 1000.0, "zarr": 80.0},
+    "db_insert": 500.0,
+}
+
+
+def load_rates(benchmark_results_path: Path) -> dict:
+    """
+    Return the throughput of each stage measured by benchmarks/bench_insert.py.
+
+    The rate of a stage (and insert_lfp variant) is the median throughput of its runs on the largest benchmarked
+    file, where fixed costs weigh the least. Stages missing from the results keep their DEFAULT_RATES.
+
+    Parameters
+    ----------
+    benchmark_results_path : Path
+        The JSON results written by bench_insert.py (its `--output`).
+
+    Returns
+    -------
+    dict
+        The rates, structured as DEFAULT_RATES.
+    """
+    results = json.loads(Path(benchmark_results_path).read_text())["results"]
+    runs = {}
+    for result in results:
+        key = (result["stage"], result["params"].get("variant"))
+        runs.setdefault(key, []).append(result)
+    rates = dict(DEFAULT_RATES, analysis_write=dict(DEFAULT_RATES["analysis_write"]))
+    for (stage, variant), stage_runs in runs.items():
+        largest = max(run["bytes"] or run["rows"] or 0 for run in stage_runs)
+        throughput = statistics.median(
+            run["throughput"] for run in stage_runs if (run["bytes"] or run["rows"] or 0) == largest
+        )
+        if stage == "analysis_write":
+            rates["analysis_write"][variant] = throughput
+        elif stage in rates:
+            rates[stage] = throughput
+    return rates
+
+
+def get_lfp_variant(lfp_kwargs: dict = None) -> str:
+    """Return the bench_insert.py variant of insert_lfp (its copy mode) that an insert with these arguments runs."""
+    lfp_kwargs = lfp_kwargs or {}
+    copy_mode = lfp_kwargs.get("copy_mode", "copy")
+    # selected electrodes and decimated LFP are streamed rather than copied by HDF5
+    if copy_mode == "copy" and (lfp_kwargs.get("electrodes") is not None or lfp_kwargs.get("lfp_rate") is not None):
+        return "stream"
+    return copy_mode
+
+
+def get_series_rate(nwbfile_path: Path, index: dict, path: str) -> float:
+    """
+    Return the sampling rate of a TimeSeries of an NWB file: the rate of its starting time, or else the rate of its
+    timestamps from the first and last of them (two scalar reads).
+    """
+    rate = index["objects"].get(f"{path}/starting_time", {}).get("attributes", {}).get("rate")
+    if rate is not None:
+        return rate
+    with h5py.File(nwbfile_path, "r") as file:
+        timestamps = file[f"{path}/timestamps"]
+        num_samples = timestamps.shape[0]
+        if num_samples < 2:
+            raise ValueError(f"{path} has too few timestamps to estimate its sampling rate.")
+        return (num_samples - 1) / float(timestamps[num_samples - 1] - timestamps[0])
+
+
+def estimate_insert(
+    nwbfile_path: Path,
+    lfp: bool = False,
+    lfp_kwargs: dict = None,
+    annotation_to_type: dict = None,
+    rates: dict = None,
+) -> dict:
+    """
+    Estimate the cost of inserting an NWB file with batch_insert.insert_session, from its structure only.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the NWB file.
+    lfp : bool, default: False
+        Whether the LFP data of the file is inserted with insert_lfp.
+    lfp_kwargs : dict, optional
+        The keyword arguments of insert_lfp.
+    annotation_to_type : dict, optional
+        The unit annotations inserted with insert_sorting, if any.
+    rates : dict, optional
+        The throughput of each stage (see load_rates). Defaults to DEFAULT_RATES.
+
+    Returns
+    -------
+    dict
+        The estimate with keys nwbfile_path, bytes_read, bytes_written (the bytes copied, uncompressed), disk_bytes
+        (the bytes the new files take on disk), staging_bytes (the largest Zarr staging store of the "zarr" copy mode,
+        deleted after its copy), rows and seconds.
+    """
+    lfp_kwargs = lfp_kwargs or {}
+    rates = rates or DEFAULT_RATES
+    index = load_index(nwbfile_path)
+    objects = index["objects"]
+
+    # the spyglass copy of the file made by insert_sessions
+    file_bytes = index["file"]["size"]
+    estimate = dict(
+        nwbfile_path=str(nwbfile_path),
+        bytes_read=file_bytes,
+        bytes_written=file_bytes,
+        disk_bytes=file_bytes,
+        staging_bytes=0,
+        rows=0,
+        seconds=file_bytes / 1e6 / rates["file_read"],
+    )
+
+    if lfp:
+        lfp_rate = lfp_kwargs.get("lfp_rate")
+        if lfp_rate is None:
+            series_paths = find_objects(index, "ElectricalSeries", parent_types=LFP_CONTAINER_TYPES)
+        else:
+            series_paths = find_objects(index, "ElectricalSeries", parent="acquisition")
+        compressed = lfp_kwargs.get("compression", "gzip") is not None
+        variant = get_lfp_variant(lfp_kwargs)
+        write_rate = rates["analysis_write"][variant]
+        lfp_rows = 1 if series_paths else 0  # the AnalysisNwbfile entry
+        for path in series_paths:
+            data = objects[f"{path}/data"]
+            data_bytes = int(np.prod(data["shape"])) * data["itemsize"]
+            timestamps = objects.get(f"{path}/timestamps")
+            timestamps_bytes = 0 if timestamps is None else int(np.prod(timestamps["shape"])) * timestamps["itemsize"]
+            # an ImportedLFP and an LFPOutput entry, and an LFPElectrodeGroup and its electrodes
+            num_channels = data["shape"][1] if len(data["shape"]) > 1 else 1
+            lfp_rows += 3 + num_channels
+            estimate["seconds"] += data_bytes / 1e6 / write_rate
+            if variant == "link":
+                continue
+            # decimated LFP is 1/factor of the raw data
+            factor = (
+                1 if lfp_rate is None else get_decimation_factor(get_series_rate(nwbfile_path, index, path), lfp_rate)
+            )
+            # copies compressed like their source take the space of the source
+            ratio = data["storage_size"] / max(data_bytes, 1) if compressed and data["compression"] else 1.0
+            estimate["bytes_read"] += data_bytes + timestamps_bytes
+            estimate["bytes_written"] += (data_bytes + timestamps_bytes) // factor
+            estimate["disk_bytes"] += int((data_bytes * ratio + timestamps_bytes) / factor)
+            if variant == "zarr":
+                estimate["staging_bytes"] = max(estimate["staging_bytes"], int(data_bytes * ratio))
+        estimate["rows"] += lfp_rows
+        estimate["seconds"] += lfp_rows / rates["db_insert"]
+
+    units_paths = find_objects(index, "Units", parent="")
+    if annotation_to_type and units_paths:
+        num_units = objects[f"{units_paths[0]}/id"]["shape"][0]
+        # a UnitAnnotation entry per unit and an Annotation entry per unit and annotation
+        annotation_rows = num_units * (1 + len(annotation_to_type))
+        estimate["rows"] += annotation_rows
+        estimate["seconds"] += annotation_rows / rates["db_insert"]
+    return estimate
+
+
+def plan_batch(
+    nwbfile_paths: list, lfp: bool = False, lfp_kwargs: dict = None, annotation_to_type: dict = None, rates=None
+) -> list:
+    """
+    Estimate the cost of inserting each NWB file of a batch (see estimate_insert).
+
+    A file that cannot be estimated (e.g. a corrupt file) gets an estimate of 0 s with its "error", so that it is
+    scheduled last and fails in the batch like any other failing file.
+    """
+    estimates = []
+    for nwbfile_path in nwbfile_paths:
+        try:
+            estimates.append(estimate_insert(nwbfile_path, lfp, lfp_kwargs, annotation_to_type, rates))
+        except Exception as error:
+            estimates.append(
+                dict(
+                    nwbfile_path=str(nwbfile_path),
+                    bytes_read=0,
+                    bytes_written=0,
+                    disk_bytes=0,
+                    staging_bytes=0,
+                    rows=0,
+                    seconds=0.0,
+                    error=repr(error),
+                )
+            )
+    return estimates
+
+
+def get_makespan(durations: list, num_workers: int) -> float:
+    """Return the duration of running jobs in order on `num_workers` workers, each taking the next job when free."""
+    finish_times = [0.0] * max(min(num_workers, len(durations)), 1)
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+
+def schedule_largest_first(estimates: list) -> list:
+    """Return the estimates ordered by decreasing expected duration, the order in which to submit their files."""
+    return sorted(estimates, key=lambda estimate: estimate["seconds"], reverse=True)
+
+
+def check_disk_space(estimates: list, directory: Path, staging_dir: Path = None, num_workers: int = 1):
+    """
+    Check that the files of a batch fit in the free space of a directory, e.g. the spyglass base directory.
+
+    The Zarr staging stores of the "zarr" copy mode of insert_lfp are written to `staging_dir` (by default
+    `directory`, where the analysis files are written), up to one per worker at a time.
+
+    Raises
+    ------
+    ValueError
+        If the estimated disk space of the batch exceeds the free space of `directory` or `staging_dir`.
+    """
+    staging_dir = directory if staging_dir is None else staging_dir
+    staging_bytes = sum(sorted((estimate["staging_bytes"] for estimate in estimates), reverse=True)[:num_workers])
+    needed_bytes = {directory: sum(estimate["disk_bytes"] for estimate in estimates)}
+    # the directories share their free space if they are on the same device
+    if os.stat(staging_dir).st_dev == os.stat(directory).st_dev:
+        needed_bytes[directory] += staging_bytes
+    else:
+        needed_bytes[staging_dir] = staging_bytes
+    for needed_directory, disk_bytes in needed_bytes.items():
+        free_bytes = shutil.disk_usage(needed_directory).free
+        if disk_bytes > free_bytes:
+            raise ValueError(
+                f"The batch needs about {disk_bytes / 1e9:.1f} GB but {needed_directory} has {free_bytes / 1e9:.1f} GB "
+                "free."
+            )
+
+
+def print_plan(estimates: list, num_workers: int):
+    """Print the estimates of a batch in order, its totals and its expected duration on `num_workers` workers."""
+    for estimate in estimates:
+        line = (
+            f"{Path(estimate['nwbfile_path']).name:<40} {estimate['bytes_read'] / 1e9:8.2f} GB read "
+            f"{estimate['bytes_written'] / 1e9:8.2f} GB written {estimate['rows']:>9} rows {estimate['seconds']:9.1f} s"
+        )
+        if "error" in estimate:
+            line += f" (not estimated: {estimate['error']})"
+        print(line)
+    durations = [estimate["seconds"] for estimate in estimates]
+    print(
+        f"Planned {len(estimates)} sessions: {sum(estimate['bytes_read'] for estimate in estimates) / 1e9:.2f} GB "
+        f"read, {sum(estimate['disk_bytes'] for estimate in estimates) / 1e9:.2f} GB on disk, "
+        f"{sum(estimate['rows'] for estimate in estimates)} rows, about {get_makespan(durations, num_workers):.0f} s "
+        f"with {num_workers} workers ({sum(durations):.0f} s of worker time)"
+    )
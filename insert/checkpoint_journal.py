@@ -0,0 +1,68 @@
+"""
+Checkpoint journals of the inserts of a session, so that a failed insert resumes from its last completed stage.
+
+An insert records each completed stage in its journal together with the artifacts the later stages need (e.g. the
+name of the analysis file written and the object ids of its series). The journal is saved atomically after each
+stage. When the insert is run again, the stages in the journal are skipped and their artifacts reused, provided the
+journal was written for the same source file (same size and modification time) and the same insert settings; a
+journal of another file or other settings is ignored. The journal is deleted when the insert completes.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+from ingestion_cache import describe_setting, get_file_stat
+from json_files import atomic_write_json, load_json
+
+
+def fingerprint_insert(nwbfile_path: Path, settings: dict) -> dict:
+    """
+    Return the fingerprint of an insert: the size and modification time of its source file and a digest of its
+    settings (see ingestion_cache.describe_setting).
+    """
+    digest = hashlib.blake2b(json.dumps(settings, sort_keys=True, default=describe_setting).encode()).hexdigest()
+    return dict(file=get_file_stat(nwbfile_path), settings=digest)
+
+
+class CheckpointJournal:
+    """
+    The completed stages of an insert of a session and their artifacts.
+
+    Parameters
+    ----------
+    journal_dir : Path or None
+        The directory of the journals. With None the journal is kept in memory only, i.e. nothing is resumed.
+    nwb_copy_file_name : str
+        The name of the spyglass copy of the NWB file of the session.
+    task : str
+        The name of the insert, e.g. "insert_lfp".
+    fingerprint : dict
+        The fingerprint of the insert (see fingerprint_insert). The stages of a journal with another fingerprint are
+        discarded.
+    """
+
+    def __init__(self, journal_dir: Path, nwb_copy_file_name: str, task: str, fingerprint: dict):
+        self.path = None if journal_dir is None else Path(journal_dir) / f"{nwb_copy_file_name}.{task}.json"
+        self.fingerprint = fingerprint
+        self.stages = {}
+        entry = None if self.path is None else load_json(self.path)
+        if entry is not None and entry.get("fingerprint") == fingerprint:
+            self.stages = entry["stages"]
+
+    def get(self, stage: str) -> dict:
+        """Return the artifacts of a completed stage, or None if the stage was not completed."""
+        return self.stages.get(stage)
+
+    def record(self, stage: str, **artifacts):
+        """Record a completed stage and its JSON-serializable artifacts, and save the journal atomically."""
+        self.stages[stage] = artifacts
+        if self.path is None:
+            return
+        atomic_write_json(self.path, dict(fingerprint=self.fingerprint, stages=self.stages), indent=2)
+
+    def clear(self):
+        """Delete the journal, once the insert has completed."""
+        self.stages = {}
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
@@ -0,0 +1,75 @@
+"""Data chunk iterators used to stream large datasets into spyglass analysis files with bounded memory."""
+
+import numpy as np
+from hdmf.data_utils import GenericDataChunkIterator
+
+
+class DatasetChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over an HDF5 dataset (or any sliceable array) one buffer at a time.
+
+    Only one buffer of at most `buffer_gb` is held in memory at once, so the peak memory of a copy does not depend on
+    the size of the dataset. The chunk shape recommended to the writer is either `chunk_shape` or one derived from
+    `chunk_mb` by hdmf.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        The dataset to iterate over.
+    **kwargs
+        Passed to hdmf.data_utils.GenericDataChunkIterator (buffer_gb, buffer_shape, chunk_mb, chunk_shape,
+        display_progress, ...).
+    """
+
+    def __init__(self, dataset, **kwargs):
+        self.dataset = dataset
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        return self.dataset[selection]
+
+    def _get_maxshape(self):
+        return self.dataset.shape
+
+    def _get_dtype(self):
+        return self.dataset.dtype
+
+
+class ChannelSelection:
+    """
+    A read-only view of a subset of the channels (columns) of a 2D dataset.
+
+    Only the selected channels are read: each run of consecutive selected channels is read as one hyperslab, so
+    selecting whole tetrodes or shanks costs one read per tetrode or shank rather than one per channel or a read of
+    every channel. The view can be wrapped in a DatasetChunkIterator or compared with
+    verification.assert_datasets_equal.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        The 2D dataset (time x channels).
+    channels : array-like of int
+        The selected channels, in the order of the columns of the view.
+    """
+
+    def __init__(self, dataset, channels):
+        self.dataset = dataset
+        self.channels = np.asarray(channels, dtype="int64")
+        self.shape = (dataset.shape[0], len(self.channels))
+        self.dtype = dataset.dtype
+        self.ndim = 2
+        chunks = getattr(dataset, "chunks", None)
+        self.chunks = (chunks[0], len(self.channels)) if chunks else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, selection):
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        rows = selection[0]
+        channels = self.channels[selection[1]] if len(selection) > 1 else self.channels
+        if np.ndim(channels) == 0:
+            return self.dataset[rows, int(channels)]
+        runs = np.split(channels, np.flatnonzero(np.diff(channels) != 1) + 1)
+        return np.concatenate([self.dataset[rows, run[0] : run[-1] + 1] for run in runs if len(run)], axis=-1)
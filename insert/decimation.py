@@ -0,0 +1,174 @@
+"""
+Streaming low-pass filtering and decimation of raw-rate ephys data into LFP.
+
+DecimatedView is a read-only view of a (time x channels) dataset filtered by a linear-phase FIR low-pass filter and
+decimated by an integer factor. Any block of rows of the view can be read: each block is computed from the block of
+input rows it depends on with scipy's polyphase upfirdn, which only computes the kept samples. The `num_taps - 1`
+input rows shared by consecutive blocks (the filter state) are kept from the previous read, so reading the view from
+start to end (e.g. through a DatasetChunkIterator or copy_dataset_pipelined) reads every input row once, and the
+result equals filtering the whole recording at once. Sample `i` of the view is aligned with input sample
+`i * factor` (the delay of the filter is compensated), so the timestamps of the view are every `factor`-th input
+timestamp (see StridedView).
+"""
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+
+def get_decimation_factor(sampling_rate: float, lfp_rate: float, tolerance: float = 1e-3) -> int:
+    """
+    Return the integer decimation factor from `sampling_rate` to `lfp_rate`.
+
+    Raises
+    ------
+    ValueError
+        If `sampling_rate` is not an integer multiple of `lfp_rate` (to within `tolerance`, relative).
+    """
+    factor = int(round(sampling_rate / lfp_rate))
+    if factor < 1 or abs(sampling_rate / factor - lfp_rate) > tolerance * lfp_rate:
+        raise ValueError(f"The sampling rate {sampling_rate} Hz is not an integer multiple of {lfp_rate} Hz.")
+    return factor
+
+
+def design_lowpass(factor: int, num_taps: int = None, cutoff: float = 0.8) -> np.ndarray:
+    """
+    Design the anti-aliasing FIR low-pass filter of a decimation by `factor`.
+
+    Parameters
+    ----------
+    factor : int
+        The decimation factor.
+    num_taps : int, optional
+        The length of the filter, made odd so that its delay is a whole number of samples. Defaults to
+        `10 * factor + 1`.
+    cutoff : float, default: 0.8
+        The cutoff frequency as a fraction of the Nyquist frequency of the decimated signal, e.g. 400 Hz for a 1 kHz
+        LFP.
+
+    Returns
+    -------
+    np.ndarray
+        The float32 filter coefficients, with unit gain at 0 Hz.
+    """
+    num_taps = num_taps or 10 * factor + 1
+    num_taps += 1 - num_taps % 2
+    return firwin(num_taps, cutoff / factor).astype("float32")
+
+
+class DecimatedView:
+    """
+    A read-only view of a dataset low-pass filtered and decimated along its first axis.
+
+    Integer data is filtered as float32 and rounded back to its type. Beyond the first and last input rows, the input
+    is extended with copies of those rows, which avoids the step a zero extension would filter into the edges.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        The 1D or 2D (time x channels) raw data. Anything that supports slicing rows works, e.g. a ChannelSelection.
+    factor : int
+        The decimation factor.
+    taps : np.ndarray, optional
+        The odd-length FIR filter. Defaults to design_lowpass(factor).
+    """
+
+    def __init__(self, dataset, factor: int, taps: np.ndarray = None):
+        self.dataset = dataset
+        self.factor = int(factor)
+        self.taps = design_lowpass(self.factor) if taps is None else np.asarray(taps, dtype="float32")
+        if len(self.taps) % 2 == 0:
+            raise ValueError("The filter must have an odd number of taps.")
+        self.delay = (len(self.taps) - 1) // 2
+        self.num_input_rows = dataset.shape[0]
+        self.shape = (-(-self.num_input_rows // self.factor), *dataset.shape[1:])
+        self.dtype = np.dtype(dataset.dtype)
+        self.ndim = len(self.shape)
+        self.chunks = None
+        # the first row and the rows of the last input read, so that the next block in order only reads its new rows;
+        # one attribute, so that threads reading the view concurrently always see a consistent pair
+        self._cache = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, selection):
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        rows, columns = selection[0], selection[1:]
+        if isinstance(rows, (int, np.integer)):
+            return self[(slice(rows, rows + 1), *columns)][0]
+        start, stop, step = rows.indices(self.shape[0])
+        if step != 1:
+            raise ValueError("DecimatedView only supports contiguous row selections.")
+        if stop <= start:
+            return np.empty((0, *self.shape[1:]), dtype=self.dtype)[(slice(None), *columns)]
+        # output row i is sum_k taps[k] * input[i * factor + delay - k]; the input is read from an earlier row so that
+        # the first output row is a whole number of decimated samples into the full convolution of the input block
+        lead = -(len(self.taps) - 1) % self.factor
+        input_start = start * self.factor - self.delay - lead
+        input_stop = (stop - 1) * self.factor + self.delay + 1
+        block = self._read_rows(input_start, input_stop).astype("float32", copy=False)
+        filtered = upfirdn(self.taps, block, down=self.factor, axis=0)
+        first = (len(self.taps) - 1 + lead) // self.factor
+        decimated = filtered[first : first + stop - start]
+        if self.dtype.kind in "iu":
+            info = np.iinfo(self.dtype)
+            decimated = np.clip(np.rint(decimated), info.min, info.max)
+        return decimated.astype(self.dtype, copy=False)[(slice(None), *columns)]
+
+    def _read_rows(self, start: int, stop: int) -> np.ndarray:
+        # read input rows [start, stop), extending the edges, and reusing the rows of the previous read
+        read_start, read_stop = max(start, 0), min(stop, self.num_input_rows)
+        parts = []
+        cache = self._cache
+        if cache is not None:
+            cached_start, cached_rows = cache
+            cached_stop = cached_start + len(cached_rows)
+            if cached_start <= read_start < cached_stop:
+                parts.append(cached_rows[read_start - cached_start : read_stop - cached_start])
+                read_start = min(cached_stop, read_stop)
+        if read_start < read_stop:
+            parts.append(np.asarray(self.dataset[read_start:read_stop]))
+        rows = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        self._cache = (max(start, 0), rows)
+        padding = [(max(-start, 0), max(stop - self.num_input_rows, 0))] + [(0, 0)] * (rows.ndim - 1)
+        if padding[0] != (0, 0):
+            rows = np.pad(rows, padding, mode="edge")
+        return rows
+
+
+class StridedView:
+    """
+    A read-only view of every `step`-th row of a dataset, e.g. the timestamps of a DecimatedView.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        The dataset.
+    step : int
+        The stride between the rows of the view.
+    """
+
+    def __init__(self, dataset, step: int):
+        self.dataset = dataset
+        self.step = int(step)
+        self.shape = (-(-dataset.shape[0] // self.step), *dataset.shape[1:])
+        self.dtype = np.dtype(dataset.dtype)
+        self.ndim = len(self.shape)
+        self.chunks = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, selection):
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        rows, columns = selection[0], selection[1:]
+        if isinstance(rows, (int, np.integer)):
+            return self.dataset[(int(rows) % self.shape[0] * self.step, *columns)]
+        start, stop, step = rows.indices(self.shape[0])
+        if stop <= start:
+            return np.asarray(self.dataset[(slice(0, 0), *columns)])
+        return np.asarray(
+            self.dataset[(slice(start * self.step, (stop - 1) * self.step + 1, step * self.step), *columns)]
+        )
@@ -0,0 +1,251 @@
+"""
+Content fingerprints of NWB files for incremental re-ingestion.
+
+An NWB file is split into the objects that are inserted separately: the LFP containers (insert_lfp), each unit
+annotation column (insert_sorting) and the session, i.e. everything else (sgi.insert_sessions). Each object gets a
+fingerprint hashed from the metadata, attributes and a strided sample of the data of its HDF5 datasets, so that
+fingerprinting a file takes well under a second regardless of its size. After an object is inserted, its fingerprint
+is saved in a cache entry per session; on the next ingestion only the objects whose fingerprint changed are
+re-inserted. If the size and modification time of the file did not change, the cached fingerprints are reused without
+opening the file at all.
+
+The sampled fingerprint is a trade-off: a change confined to data between the sampled blocks of a large dataset is
+not detected. Use `sample_mb=None` to hash all of the data.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import types
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from json_files import atomic_write_json, load_json
+from memmap_reader import memmap_dataset
+
+# the containers of the LFP series inserted by insert_lfp
+LFP_CONTAINER_TYPES = ("LFP", "FilteredEphys")
+SESSION = "session"
+LFP = "lfp"
+
+
+def annotation_object(annotation: str) -> str:
+    """Return the name of the object of a unit annotation column."""
+    return f"annotation/{annotation}"
+
+
+def get_file_stat(nwbfile_path: Path) -> dict:
+    """Return the size and modification time of a file, which change whenever its content does."""
+    stat = os.stat(nwbfile_path)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def describe_setting(value) -> str:
+    """
+    Describe an insert setting that is not JSON-serializable, for hashing it.
+
+    Functions (e.g. an electrode selection function) are described by their code and constants, and by the values of
+    their closure variables and of the globals they use, rather than by their repr, which holds their address in
+    memory and changes with every run.
+
+    Raises
+    ------
+    TypeError
+        If the setting, or a value used by a function, is an object whose repr holds its address, so that it cannot
+        be described from one run to the next.
+    """
+    return _describe_value(value, set())
+
+
+def _describe_value(value, seen: set) -> str:
+    # `seen` holds the ids of the functions being described, so that recursive functions are described once
+    if getattr(value, "__code__", None) is not None:
+        return _describe_function(value, seen)
+    if isinstance(value, types.ModuleType):
+        return f"<module {value.__name__}>"
+    if isinstance(value, functools.partial):
+        arguments = [_describe_value(argument, seen) for argument in value.args]
+        keywords = {name: _describe_value(argument, seen) for name, argument in sorted(value.keywords.items())}
+        return f"partial({_describe_value(value.func, seen)}, {arguments!r}, {keywords!r})"
+    if isinstance(value, np.ndarray):
+        return (
+            f"array({value.dtype}, {value.shape}, {hashlib.blake2b(np.ascontiguousarray(value).tobytes()).hexdigest()})"
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_describe_value(item, seen) for item in value]
+        return f"{type(value).__name__}({sorted(items) if isinstance(value, (set, frozenset)) else items!r})"
+    if isinstance(value, dict):
+        return repr({_describe_value(key, seen): _describe_value(item, seen) for key, item in value.items()})
+    description = repr(value)
+    if " at 0x" in description:
+        raise TypeError(f"The insert setting {description} cannot be fingerprinted: its repr holds its address.")
+    return description
+
+
+def _describe_function(function, seen: set) -> str:
+    name = f"{function.__module__}.{function.__qualname__}"
+    if id(function) in seen:
+        return name
+    seen = seen | {id(function)}
+    # the code and constants of the function and of the functions and lambdas defined in it; constants are described
+    # rather than repr'd, as the repr of a frozenset (e.g. of `x in {"a", "b"}`) changes with the hash seed
+    code_objects = [function.__code__]
+    code = []
+    names = set()
+    for code_object in code_objects:
+        constants = []
+        for constant in code_object.co_consts:
+            if isinstance(constant, types.CodeType):
+                code_objects.append(constant)
+            else:
+                constants.append(_describe_value(constant, seen))
+        code.append((code_object.co_code.hex(), constants))
+        names.update(code_object.co_names)
+    closure = []
+    for cell in function.__closure__ or ():
+        try:
+            closure.append(_describe_value(cell.cell_contents, seen))
+        except ValueError:  # a cell that is not assigned yet
+            closure.append(None)
+    global_values = function.__globals__
+    used_globals = {name: _describe_value(global_values[name], seen) for name in sorted(names) if name in global_values}
+    defaults = _describe_value(function.__defaults__ or (), seen)
+    return f"{name}:{code!r}:{closure!r}:{used_globals!r}:{defaults}"
+
+
+def fingerprint_nwbfile(
+    nwbfile_path: Path,
+    annotation_names: list = (),
+    settings: dict = None,
+    cached: dict = None,
+    sample_mb: float = 1.0,
+    num_blocks: int = 16,
+) -> dict:
+    """
+    Fingerprint the session, the LFP series and the unit annotation columns of an NWB file.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the NWB file.
+    annotation_names : list of str
+        The unit annotation columns fingerprinted as separate objects.
+    settings : dict, optional
+        The insert settings of each object, e.g. {"lfp": lfp_kwargs}, folded into its fingerprint so that changing
+        them re-inserts the object.
+    cached : dict, optional
+        A previous fingerprint of the file (see load_cache_entry). Its content fingerprints are reused if the size and
+        modification time of the file are unchanged.
+    sample_mb : float, default: 1.0
+        The size in MB of each of the `num_blocks` evenly spaced blocks of a dataset that are hashed. Datasets smaller
+        than all the blocks together are hashed in full. None hashes every dataset in full.
+    num_blocks : int, default: 16
+        The number of blocks hashed per dataset.
+
+    Returns
+    -------
+    dict
+        The fingerprint with keys "file" (size and modification time), "content" (a hex digest of the content of
+        each object) and "objects" (a hex digest of the content and settings of each object).
+    """
+    settings = settings or {}
+    file_stat = get_file_stat(nwbfile_path)
+    objects = [SESSION, LFP] + [annotation_object(name) for name in annotation_names]
+    cached_content = (cached or {}).get("content", {})
+    if (cached or {}).get("file") == file_stat and all(name in cached_content for name in objects):
+        content = {name: cached_content[name] for name in objects}
+    else:
+        content = _fingerprint_content(nwbfile_path, objects, annotation_names, sample_mb, num_blocks)
+    object_digests = {}
+    for name in objects:
+        hasher = hashlib.blake2b(content[name].encode())
+        hasher.update(json.dumps(settings.get(name), sort_keys=True, default=describe_setting).encode())
+        object_digests[name] = hasher.hexdigest()
+    return dict(file=file_stat, content=content, objects=object_digests)
+
+
+def _fingerprint_content(nwbfile_path: Path, objects: list, annotation_names: list, sample_mb: float, num_blocks: int):
+    hashers = {name: hashlib.blake2b() for name in objects}
+    annotation_paths = {}
+    for name in annotation_names:
+        annotation_paths[f"units/{name}"] = annotation_object(name)
+        annotation_paths[f"units/{name}_index"] = annotation_object(name)
+
+    lfp_paths = []
+
+    def get_object(path: str) -> str:
+        if any(path == lfp_path or path.startswith(lfp_path + "/") for lfp_path in lfp_paths):
+            return LFP
+        return annotation_paths.get(path, SESSION)
+
+    def visit(path: str, h5_object):
+        # groups are visited before their members
+        neurodata_type = h5_object.attrs.get("neurodata_type")
+        if isinstance(neurodata_type, bytes):
+            neurodata_type = neurodata_type.decode()
+        if isinstance(h5_object, h5py.Group) and neurodata_type in LFP_CONTAINER_TYPES:
+            lfp_paths.append(path)
+        hasher = hashers[get_object(path)]
+        hasher.update(path.encode())
+        for key in sorted(h5_object.attrs):
+            hasher.update(key.encode())
+            _hash_value(hasher, h5_object.attrs[key])
+        if isinstance(h5_object, h5py.Dataset):
+            _hash_dataset(hasher, h5_object, sample_mb=sample_mb, num_blocks=num_blocks)
+
+    with h5py.File(nwbfile_path, "r") as file:
+        visit("", file)
+        file.visititems(visit)
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def _hash_dataset(hasher, dataset: h5py.Dataset, sample_mb: float, num_blocks: int):
+    hasher.update(f"{dataset.shape}{dataset.dtype}".encode())
+    if dataset.shape is None or dataset.size == 0:
+        return
+    if dataset.ndim == 0:
+        _hash_value(hasher, dataset[()])
+        return
+    row_bytes = max(dataset.size // dataset.shape[0] * dataset.dtype.itemsize, 1)
+    num_rows = dataset.shape[0]
+    block_rows = num_rows if sample_mb is None else max(int(sample_mb * 1e6 // row_bytes), 1)
+    if block_rows * num_blocks >= num_rows:
+        starts = range(0, num_rows, block_rows)
+    else:
+        starts = np.linspace(0, num_rows - block_rows, num_blocks).astype(int)
+    dataset = memmap_dataset(dataset)
+    for start in starts:
+        _hash_value(hasher, dataset[start : start + block_rows])
+
+
+def _hash_value(hasher, value):
+    if isinstance(value, np.ndarray) and value.dtype.kind != "O":
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.ndarray):  # strings and references; repr would elide the middle of large arrays
+        hasher.update(repr(value.tolist()).encode())
+    else:
+        hasher.update(repr(value).encode())
+
+
+def get_changed_objects(cached: dict, fingerprint: dict) -> set:
+    """Return the objects of `fingerprint` that are not in the cached fingerprint or whose fingerprint differs."""
+    cached_objects = (cached or {}).get("objects", {})
+    return {name for name, digest in fingerprint["objects"].items() if cached_objects.get(name) != digest}
+
+
+def get_cache_path(cache_dir: Path, nwb_copy_file_name: str) -> Path:
+    """Return the path of the cache entry of a session."""
+    return Path(cache_dir) / f"{nwb_copy_file_name}.json"
+
+
+def load_cache_entry(cache_dir: Path, nwb_copy_file_name: str) -> dict:
+    """Return the cached fingerprint of the inserted objects of a session, or None if there is none."""
+    return load_json(get_cache_path(cache_dir, nwb_copy_file_name))
+
+
+def save_cache_entry(cache_dir: Path, nwb_copy_file_name: str, entry: dict):
+    """Atomically save the fingerprint of the inserted objects of a session."""
+    atomic_write_json(get_cache_path(cache_dir, nwb_copy_file_name), entry, indent=2)
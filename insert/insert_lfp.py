@@ -1,111 +1,562 @@
-import datajoint as dj
+from functools import partial
 from pathlib import Path
+import h5py
 import numpy as np
-
-dj_local_conf_path = "/Users/pauladkisson/Documents/CatalystNeuro/JadhavConv/jadhav-lab-to-nwb/src/jadhav_lab_to_nwb/spyglass_mock/dj_local_conf.json"
-dj.config.load(dj_local_conf_path)  # load config for database connection info
-
-import spyglass.common as sgc  # this import connects to the database
-import spyglass.data_import as sgi
-from spyglass.utils.nwb_helper_fn import get_nwb_copy_filename
+import time
 from pynwb import NWBHDF5IO
 
 # LFP Imports
-import spyglass.lfp as sglfp
-from spyglass.utils.nwb_helper_fn import estimate_sampling_rate
 from pynwb.ecephys import ElectricalSeries, LFP
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+
+from spyglass_setup import lazy_import
+
+sgc = lazy_import("spyglass.common")
+nwb_helper_fn = lazy_import("spyglass.utils.nwb_helper_fn")
+sglfp = lazy_import("spyglass.lfp")
 
+from checkpoint_journal import CheckpointJournal, fingerprint_insert
+from data_iterators import ChannelSelection, DatasetChunkIterator
+from decimation import DecimatedView, StridedView, design_lowpass, get_decimation_factor
+from ingestion_cache import LFP_CONTAINER_TYPES
+from instrumentation import get_peak_rss_mb, stage
+from memmap_reader import memmap_dataset
+from nwb_index import TimeSeriesView, find_objects, get_index_size, load_index, read_table
+from pipelined_copy import copy_dataset_pipelined, get_chunk_shape
+from timestamps import check_regular_timestamps, get_sampling_rate
+from verification import assert_datasets_equal
 
-def insert_lfp(nwbfile_path: Path):
+# the path of the electrodes table in an NWB file
+ELECTRODES_PATH = "general/extracellular_ephys/electrodes"
+# the ways insert_lfp writes the LFP data to the analysis file
+COPY_MODES = ("copy", "stream", "pipelined", "zarr", "link")
+
+
+def insert_lfp(
+    nwbfile_path: Path,
+    copy_mode: str = "copy",
+    buffer_gb: float = None,
+    chunk_shape: tuple = None,
+    compression: str = "gzip",
+    compression_opts: int = 4,
+    compact_timestamps: bool = False,
+    electrodes=None,
+    lfp_electrode_group_name: str = "lfp_electrode_group",
+    queue_depth: int = 4,
+    num_workers: int = None,
+    lfp_rate: float = None,
+    num_taps: int = None,
+    zarr_staging_dir: Path = None,
+    journal_dir: Path = None,
+):
     """
-    Insert LFP data from an NWB file into a spyglass database.
+    Insert the LFP series of an NWB file into a spyglass database, as one analysis file.
 
     Parameters
     ----------
     nwbfile_path : Path
         The path to the NWB file to insert.
+    copy_mode : str, default: "copy"
+        How the LFP data is written to the analysis file, one of COPY_MODES:
+
+        - "copy": copied as-is by HDF5 (selected electrodes and decimated LFP are streamed),
+        - "stream": read through a DatasetChunkIterator, holding at most `buffer_gb` in memory,
+        - "pipelined": copied by copy_dataset_pipelined, which overlaps the reads, compression and writes,
+        - "zarr": compressed in parallel into a temporary Zarr store by copy_dataset_zarr (needs zarr<3), then moved in,
+        - "link": not copied but linked from the spyglass copy of the NWB file, which must then stay in place.
+    buffer_gb : float, optional
+        The maximum size of the in-memory read buffer in GB when streaming. Defaults to the hdmf default (1 GB).
+    chunk_shape : tuple, optional
+        The HDF5 chunk shape of the copied LFP data when streaming. Defaults to ~10 MB chunks chosen by hdmf.
+    compression : str, default: "gzip"
+        The HDF5 compression filter of the copied LFP data when streaming. Use None to disable compression. The
+        "pipelined" and "zarr" modes only support gzip or no compression.
+    compression_opts : int, default: 4
+        The options (e.g. gzip level) of the compression filter when streaming.
+    compact_timestamps : bool, default: False
+        Whether to store a regularly sampled LFP series with `starting_time` and `rate` instead of timestamps.
+        Note that some spyglass pipelines downstream of LFPOutput expect explicit timestamps.
+    electrodes : list of int or callable, optional
+        The electrodes whose LFP is inserted: a list of electrode ids, or a function taking the electrodes table of
+        the NWB file (a DataFrame indexed by electrode id) and returning a boolean mask of the electrodes to insert,
+        e.g. `lambda electrodes: electrodes["group_name"].isin(["shank0", "shank1"])`. Defaults to every electrode
+        recorded by the LFP series. Cannot be combined with the "link" mode.
+    lfp_electrode_group_name : str, default: "lfp_electrode_group"
+        The name of the LFPElectrodeGroup of the inserted electrodes, suffixed by the series name if there are several.
+    queue_depth : int, default: 4
+        The number of chunk-high bands of LFP data read ahead of the writer in the "pipelined" mode.
+    num_workers : int, optional
+        The number of compression threads in the "pipelined" mode, or processes in the "zarr" mode. Defaults to the
+        number of CPUs.
+    lfp_rate : float, optional
+        The sampling rate in Hz of the LFP computed from the raw ElectricalSeries, which must be an integer divisor of
+        their sampling rate. Defaults to inserting the LFP series of the NWB file. Cannot be combined with the "link"
+        or "zarr" modes.
+    num_taps : int, optional
+        The length of the anti-aliasing filter of the decimation. Defaults to 10 times the decimation factor plus 1
+        (see decimation.design_lowpass).
+    zarr_staging_dir : Path, optional
+        The directory of the temporary Zarr stores in the "zarr" mode, on a local disk with room for the compressed
+        LFP data of a series. Defaults to the directory of the analysis file.
+    journal_dir : Path, optional
+        The directory of the checkpoint journals from which a failed insert resumes. Defaults to no journal.
     """
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-    lfp_file_name = sgc.AnalysisNwbfile().create(nwb_copy_file_name)
-    analysis_file_abspath = sgc.AnalysisNwbfile().get_abs_path(lfp_file_name)
-
-    raw_io = NWBHDF5IO(nwbfile_path, "r")
-    raw_nwbfile = raw_io.read()
-    lfp_eseries = raw_nwbfile.processing["ecephys"]["LFP"].electrical_series["ElectricalSeriesLFP"]
-    eseries_kwargs = {
-        "data": lfp_eseries.data,
-        "timestamps": lfp_eseries.timestamps,
-        "description": lfp_eseries.description,
-    }
-
-    # Create dynamic table region and electrode series, write/close file
-    analysis_io = NWBHDF5IO(path=analysis_file_abspath, mode="a", load_namespaces=True)
-    analysis_nwbfile = analysis_io.read()
-
-    # get the indices of the electrodes in the electrode table
-    electrodes_table = analysis_nwbfile.electrodes.to_dataframe()
-    lfp_electrode_indices = electrodes_table.index.tolist()
-
-    electrode_table_region = analysis_nwbfile.create_electrode_table_region(
-        lfp_electrode_indices, "filtered electrode table"
+    if copy_mode not in COPY_MODES:
+        raise ValueError(f"copy_mode must be one of {COPY_MODES}, got {copy_mode!r}.")
+    if copy_mode in ("pipelined", "zarr") and compression not in ("gzip", None):
+        raise ValueError(f"copy_mode={copy_mode!r} only supports gzip compression or none, got {compression!r}.")
+    if copy_mode == "pipelined" and queue_depth < 1:
+        raise ValueError(f"queue_depth must be at least 1, got {queue_depth}.")
+    if copy_mode == "link" and electrodes is not None:
+        raise ValueError("copy_mode='link' cannot select electrodes: linked LFP data always has every channel.")
+    if copy_mode in ("link", "zarr") and lfp_rate is not None:
+        raise ValueError(f"copy_mode={copy_mode!r} cannot decimate raw data.")
+    if compression is None:
+        compression_opts = None  # h5py rejects options without a filter
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    settings = dict(
+        copy_mode=copy_mode,
+        buffer_gb=buffer_gb,
+        chunk_shape=chunk_shape,
+        compression=compression,
+        compression_opts=compression_opts,
+        compact_timestamps=compact_timestamps,
+        electrodes=electrodes,
+        lfp_electrode_group_name=lfp_electrode_group_name,
+        queue_depth=queue_depth,
+        num_workers=num_workers,
+        lfp_rate=lfp_rate,
+        num_taps=num_taps,
+        zarr_staging_dir=zarr_staging_dir,
     )
-    eseries_kwargs["name"] = "filtered data"
-    eseries_kwargs["electrodes"] = electrode_table_region
-    es = ElectricalSeries(**eseries_kwargs)
-    lfp_object_id = es.object_id
-    ecephys_module = analysis_nwbfile.create_processing_module(name="ecephys", description="ecephys module")
-    ecephys_module.add(LFP(electrical_series=es))
-    analysis_io.write(analysis_nwbfile, link_data=False)
-    analysis_io.close()
-
-    sgc.AnalysisNwbfile().add(nwb_copy_file_name, lfp_file_name)
-
-    lfp_electrode_group_name = "lfp_electrode_group"
-    sglfp.lfp_electrode.LFPElectrodeGroup.create_lfp_electrode_group(
-        nwb_file_name=nwb_copy_file_name,
-        group_name=lfp_electrode_group_name,
-        electrode_list=lfp_electrode_indices,
+    journal = CheckpointJournal(
+        journal_dir, nwb_copy_file_name, "insert_lfp", fingerprint_insert(nwbfile_path, settings)
     )
-    lfp_sampling_rate = estimate_sampling_rate(eseries_kwargs["timestamps"][:1_000_000])
-    key = {
-        "nwb_file_name": nwb_copy_file_name,
-        "lfp_electrode_group_name": lfp_electrode_group_name,
-        "interval_list_name": "raw data valid times",
-        "lfp_sampling_rate": lfp_sampling_rate,
-        "lfp_object_id": lfp_object_id,
-        "analysis_file_name": lfp_file_name,
-    }
-    sglfp.ImportedLFP.insert1(key, allow_direct_insert=True)
-    sglfp.lfp_merge.LFPOutput.insert1(key, allow_direct_insert=True)
-
-    raw_io.close()
-
-
-def test_lfp(nwbfile_path: Path):
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-    lfp_electrical_series = (sglfp.ImportedLFP & {"nwb_file_name": nwb_copy_file_name}).fetch_nwb()[0]["lfp"]
-    spyglass_lfp_data = np.asarray(lfp_electrical_series.data[:100])
-    with NWBHDF5IO(nwbfile_path, "r") as io:
-        nwbfile = io.read()
-        nwb_lfp_data = np.asarray(
-            nwbfile.processing["ecephys"]["LFP"].electrical_series["ElectricalSeriesLFP"].data[:100]
-        )
-    np.testing.assert_array_equal(spyglass_lfp_data, nwb_lfp_data)
+    with stage("insert_lfp", nwb_file_name=nwb_copy_file_name):
+        written = journal.get("analysis_write")
+        if written is not None and not Path(sgc.AnalysisNwbfile().get_abs_path(written["analysis_file_name"])).exists():
+            written = None  # the analysis file was deleted since
+        if written is None:
+            lfp_file_name, keys, group_of_electrodes = _write_analysis_file(
+                nwbfile_path, nwb_copy_file_name, **settings
+            )
+            journal.record(
+                "analysis_write",
+                analysis_file_name=lfp_file_name,
+                keys=keys,
+                groups=[[group_name, list(ids)] for ids, group_name in group_of_electrodes.items()],
+            )
+        else:
+            lfp_file_name, keys = written["analysis_file_name"], written["keys"]
+            group_of_electrodes = {tuple(ids): group_name for group_name, ids in written["groups"]}
+            print(f"Resuming the insert of {len(keys)} LFP series from {lfp_file_name} (see {journal.path})")
+
+        # create_lfp_electrode_group runs its own transaction and skips existing groups, so it runs before the
+        # transaction of the other rows and again on resume
+        with stage("lfp_electrode_group", rows=sum(len(ids) + 1 for ids in group_of_electrodes)):
+            for lfp_electrode_ids, group_name in group_of_electrodes.items():
+                sglfp.lfp_electrode.LFPElectrodeGroup.create_lfp_electrode_group(
+                    nwb_file_name=nwb_copy_file_name,
+                    group_name=group_name,
+                    electrode_list=list(lfp_electrode_ids),
+                )
+        # the analysis file and the LFP rows are inserted all at once or not at all; if a previous run committed them
+        # but failed before clearing its journal, they are not inserted again
+        with stage("db_insert", rows=1 + 2 * len(keys)):
+            if not (sglfp.ImportedLFP & {"analysis_file_name": lfp_file_name}):
+                with sgc.AnalysisNwbfile.connection.transaction:
+                    sgc.AnalysisNwbfile().add(nwb_copy_file_name, lfp_file_name)
+                    sglfp.ImportedLFP.insert(keys, allow_direct_insert=True)
+                    sglfp.lfp_merge.LFPOutput.insert(keys, allow_direct_insert=True)
+        journal.clear()
+
+
+def _write_analysis_file(
+    nwbfile_path: Path,
+    nwb_copy_file_name: str,
+    copy_mode: str,
+    buffer_gb: float,
+    chunk_shape: tuple,
+    compression: str,
+    compression_opts: int,
+    compact_timestamps: bool,
+    electrodes,
+    lfp_electrode_group_name: str,
+    queue_depth: int,
+    num_workers: int,
+    lfp_rate: float,
+    num_taps: int,
+    zarr_staging_dir: Path,
+) -> tuple:
+    # create and write the analysis file of insert_lfp; returns its name, the ImportedLFP keys of its series and the
+    # name of the LFPElectrodeGroup of each tuple of electrode ids
+    with stage("analysis_create"):
+        lfp_file_name = sgc.AnalysisNwbfile().create(nwb_copy_file_name)
+        analysis_file_abspath = sgc.AnalysisNwbfile().get_abs_path(lfp_file_name)
+
+    raw_file = analysis_io = None
+    try:
+        with stage("nwb_read") as record:
+            # linked data must point at the copy managed by spyglass rather than at the file the user ingested
+            source_path = sgc.Nwbfile.get_abs_path(nwb_copy_file_name) if copy_mode == "link" else nwbfile_path
+            index = load_index(source_path)
+            raw_file = h5py.File(source_path, "r")
+            if lfp_rate is None:
+                lfp_series = get_lfp_series_names(find_lfp_series(raw_file, index))
+            else:
+                lfp_series = get_lfp_series_names(find_raw_series(raw_file, index))
+            # the index and the electrodes of each series, read by TimeSeriesView
+            record["bytes_read"] = get_index_size(source_path) + sum(
+                eseries.electrodes.nbytes for eseries in lfp_series.values()
+            )
+        if not lfp_series and lfp_rate is None:
+            raise ValueError(f"{nwbfile_path.name} has no ElectricalSeries in an LFP or FilteredEphys container.")
+        if not lfp_series:
+            raise ValueError(f"{nwbfile_path.name} has no raw ElectricalSeries in its acquisition to decimate.")
+
+        # the electrode id of each row of the electrodes table, and the ids of the selected electrodes
+        with stage("electrode_selection"):
+            electrode_ids = np.asarray(raw_file[ELECTRODES_PATH]["id"][:])
+            selected_ids = get_selected_electrode_ids(raw_file[ELECTRODES_PATH], electrodes)
+            if selected_ids is not None:
+                recorded_ids = np.concatenate([electrode_ids[eseries.electrodes] for eseries in lfp_series.values()])
+                missing_ids = np.setdiff1d(selected_ids, recorded_ids)
+                if len(missing_ids):
+                    raise ValueError(f"Electrodes {missing_ids.tolist()} are not recorded by any LFP series.")
+
+        # Create dynamic table region and electrode series, write/close file
+        with stage("analysis_read"):
+            analysis_io = NWBHDF5IO(path=analysis_file_abspath, mode="a", load_namespaces=True)
+            analysis_nwbfile = analysis_io.read()
+        lfp_container = LFP()
+        # the analysis series of each source timestamps dataset, so that series sharing timestamps share them again
+        series_of_timestamps = {}
+        group_of_electrodes = {}
+        keys = []
+        # the copies of the series written empty and filled after the analysis file is closed
+        deferred_copies = {}
+        num_bytes = num_bytes_read = 0
+        for name, lfp_eseries in lfp_series.items():
+            # the rows of the electrodes table recorded by each channel of the series
+            electrode_rows = lfp_eseries.electrodes
+            channels = get_lfp_channels(electrode_ids[electrode_rows], selected_ids)
+            if not len(channels):
+                continue
+            lfp_data = lfp_eseries.data
+            lfp_timestamps = lfp_eseries.timestamps
+            subset = len(channels) < len(electrode_rows)
+            stream_series = copy_mode in ("stream", "pipelined", "zarr") or subset or lfp_rate is not None
+            if stream_series:
+                # read contiguous uncompressed data through a memmap; a plain copy is done by HDF5 itself
+                lfp_data = memmap_dataset(lfp_eseries.data)
+                lfp_timestamps = memmap_dataset(lfp_eseries.timestamps)
+            if subset:
+                lfp_data = ChannelSelection(lfp_data, channels)
+            num_bytes_read += int(np.prod(lfp_data.shape)) * lfp_data.dtype.itemsize
+
+            with stage("sampling_rate", series=name):
+                lfp_sampling_rate, is_regular = get_sampling_rate(
+                    timestamps=memmap_dataset(lfp_eseries.timestamps), rate=lfp_eseries.rate
+                )
+            if lfp_rate is not None:
+                factor = get_decimation_factor(lfp_sampling_rate, lfp_rate)
+                lfp_data = DecimatedView(lfp_data, factor, taps=design_lowpass(factor, num_taps))
+                if lfp_timestamps is not None:
+                    lfp_timestamps = StridedView(lfp_timestamps, factor)
+                lfp_sampling_rate /= factor
+            num_bytes += int(np.prod(lfp_data.shape)) * lfp_data.dtype.itemsize
+            eseries_kwargs = {
+                "data": lfp_data,
+                "description": lfp_eseries.description,
+            }
+            # h5py datasets are equal if they are the same HDF5 object, e.g. timestamps linked from another series
+            timestamps_key = lfp_eseries.timestamps
+            if lfp_eseries.timestamps is None:
+                eseries_kwargs["starting_time"] = lfp_eseries.starting_time
+                eseries_kwargs["rate"] = lfp_sampling_rate
+            elif (
+                compact_timestamps
+                and is_regular
+                and check_regular_timestamps(memmap_dataset(lfp_timestamps), lfp_sampling_rate)
+            ):
+                eseries_kwargs["starting_time"] = float(lfp_timestamps[0])
+                eseries_kwargs["rate"] = lfp_sampling_rate
+            elif timestamps_key in series_of_timestamps:
+                eseries_kwargs["timestamps"] = series_of_timestamps[timestamps_key]
+            elif stream_series:
+                eseries_kwargs["timestamps"] = H5DataIO(
+                    DatasetChunkIterator(lfp_timestamps, buffer_gb=buffer_gb),
+                    compression=compression,
+                    compression_opts=compression_opts,
+                )
+            else:
+                eseries_kwargs["timestamps"] = lfp_eseries.timestamps
+            if copy_mode in ("pipelined", "zarr"):
+                # written empty, then filled by copy_dataset_pipelined or copy_dataset_zarr
+                eseries_kwargs["data"] = H5DataIO(
+                    shape=lfp_data.shape,
+                    dtype=np.dtype(lfp_data.dtype),
+                    chunks=chunk_shape or get_chunk_shape(lfp_data.shape, lfp_data.dtype),
+                    compression=compression,
+                    compression_opts=compression_opts,
+                )
+                if copy_mode == "pipelined":
+                    deferred_copies[name] = partial(
+                        copy_dataset_pipelined, lfp_data, queue_depth=queue_depth, num_workers=num_workers
+                    )
+                else:
+                    # imported here so that zarr is only needed for staged copies
+                    from zarr_staging import copy_dataset_zarr
+
+                    staging_dir = Path(zarr_staging_dir or Path(analysis_file_abspath).parent)
+                    deferred_copies[name] = partial(
+                        copy_dataset_zarr,
+                        lfp_eseries.data,
+                        staging_path=staging_dir / f"{lfp_file_name}_{name.replace(' ', '_')}.zarr",
+                        channels=channels if subset else None,
+                        num_workers=num_workers,
+                    )
+            elif stream_series:
+                data_iterator = DatasetChunkIterator(lfp_data, buffer_gb=buffer_gb, chunk_shape=chunk_shape)
+                eseries_kwargs["data"] = H5DataIO(
+                    data_iterator, compression=compression, compression_opts=compression_opts
+                )
+
+            # the analysis file has a copy of the electrodes table of the NWB file, so the rows are the same
+            eseries_kwargs["electrodes"] = analysis_nwbfile.create_electrode_table_region(
+                electrode_rows[channels].tolist(), f"{name} electrode table"
+            )
+            es = ElectricalSeries(name=name, **eseries_kwargs)
+            lfp_container.add_electrical_series(es)
+            if timestamps_key is not None and "timestamps" in eseries_kwargs:
+                series_of_timestamps.setdefault(timestamps_key, es)
+
+            # series recording the same electrodes (e.g. several bands of one probe) share an LFPElectrodeGroup
+            lfp_electrode_ids = tuple(electrode_ids[electrode_rows[channels]].tolist())
+            if lfp_electrode_ids not in group_of_electrodes:
+                group_name = lfp_electrode_group_name
+                if len(lfp_series) > 1:
+                    group_name = f"{lfp_electrode_group_name}_{name.replace(' ', '_')}"
+                group_of_electrodes[lfp_electrode_ids] = group_name
+            keys.append(
+                {
+                    "nwb_file_name": nwb_copy_file_name,
+                    "lfp_electrode_group_name": group_of_electrodes[lfp_electrode_ids],
+                    "interval_list_name": "raw data valid times",
+                    "lfp_sampling_rate": lfp_sampling_rate,
+                    "lfp_object_id": es.object_id,
+                    "analysis_file_name": lfp_file_name,
+                }
+            )
+
+        ecephys_module = analysis_nwbfile.create_processing_module(name="ecephys", description="ecephys module")
+        ecephys_module.add(lfp_container)
+        with stage("analysis_write", copy_mode=copy_mode, num_series=len(keys)) as record:
+            start_time = time.perf_counter()
+            analysis_io.write(analysis_nwbfile, link_data=copy_mode == "link")
+            analysis_io.close()
+            if deferred_copies:
+                with h5py.File(analysis_file_abspath, "a") as analysis_file:
+                    for name, copy_data in deferred_copies.items():
+                        copy_data(analysis_file[f"processing/ecephys/{lfp_container.name}/{name}/data"])
+            write_time = time.perf_counter() - start_time
+            if copy_mode != "link":
+                record["bytes_read"], record["bytes_written"] = num_bytes_read, num_bytes
+        if copy_mode == "link":
+            print(f"Linked {len(keys)} LFP series from {source_path} in {write_time:.1f} s")
+        else:
+            print(
+                f"Copied {num_bytes / 1e6:.1f} MB of LFP data from {len(keys)} series in {write_time:.1f} s "
+                f"({num_bytes / 1e6 / max(write_time, 1e-9):.1f} MB/s, peak RSS {get_peak_rss_mb():.1f} MB)"
+            )
+
+    except BaseException:
+        # the analysis file is not registered in spyglass yet: remove it rather than leave a partial file behind
+        if analysis_io is not None:
+            analysis_io.close()
+        Path(analysis_file_abspath).unlink(missing_ok=True)
+        raise
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+    return lfp_file_name, keys, group_of_electrodes
+
+
+def find_lfp_series(file: h5py.File, index: dict) -> list:
+    """Return a TimeSeriesView of every ElectricalSeries in an LFP or FilteredEphys container of an NWB file."""
+    paths = find_objects(index, "ElectricalSeries", parent_types=LFP_CONTAINER_TYPES)
+    return [TimeSeriesView(file[path]) for path in paths]
+
+
+def find_raw_series(file: h5py.File, index: dict) -> list:
+    """Return a TimeSeriesView of every ElectricalSeries in the acquisition of an NWB file."""
+    return [TimeSeriesView(file[path]) for path in find_objects(index, "ElectricalSeries", parent="acquisition")]
+
+
+def get_lfp_series_names(lfp_series: list) -> dict:
+    """
+    Name the LFP series of an NWB file in the analysis file.
+
+    A single series is named "filtered data", as in spyglass. Several series keep their names, prefixed by the name
+    of their container if two series have the same name, and by the names of their processing module and container
+    if that is not enough (e.g. ecephys/LFP/ES and ecephys2/LFP/ES).
+    """
+    if len(lfp_series) == 1:
+        return {"filtered data": lfp_series[0]}
+    names = [eseries.name for eseries in lfp_series]
+    container_names = [f"{eseries.container_name} {eseries.name}" for eseries in lfp_series]
+    series_names = {}
+    for name, container_name, eseries in zip(names, container_names, lfp_series):
+        if names.count(name) > 1:
+            name = container_name
+        if container_names.count(container_name) > 1:
+            name = " ".join(eseries.path.strip("/").split("/")[-3:])
+        if name in series_names:
+            raise ValueError(f"Two LFP series would be named {name!r} in the analysis file.")
+        series_names[name] = eseries
+    return series_names
+
+
+def get_selected_electrode_ids(electrodes_table, electrodes=None):
+    """
+    Return the ids of the selected electrodes.
+
+    Parameters
+    ----------
+    electrodes_table : h5py.Group
+        The electrodes table of the NWB file.
+    electrodes : list of int or callable, optional
+        The electrode ids to select, or a function returning a boolean mask of the electrodes to select from the
+        electrodes table as a DataFrame (see nwb_index.read_table).
+
+    Returns
+    -------
+    np.ndarray or None
+        The selected electrode ids, or None if `electrodes` is None (every electrode is selected).
+    """
+    if electrodes is None:
+        return None
+    if callable(electrodes):
+        mask = np.asarray(electrodes(read_table(electrodes_table)), dtype=bool)
+        return np.asarray(electrodes_table["id"][:])[mask]
+    return np.asarray(electrodes)
+
+
+def get_lfp_channels(channel_electrode_ids, selected_ids=None):
+    """
+    Return the channels of an LFP series that record the selected electrodes.
+
+    Parameters
+    ----------
+    channel_electrode_ids : np.ndarray
+        The id of the electrode recorded by each channel of the LFP series.
+    selected_ids : np.ndarray, optional
+        The ids of the selected electrodes. Defaults to every electrode.
+
+    Returns
+    -------
+    np.ndarray
+        The selected channels in increasing order, possibly none.
+    """
+    if selected_ids is None:
+        return np.arange(len(channel_electrode_ids))
+    return np.flatnonzero(np.isin(channel_electrode_ids, selected_ids))
+
+
+def delete_lfp(nwb_copy_file_name: str):
+    """
+    Delete the imported LFP of a session, its LFPOutput merge entries and its LFPElectrodeGroups from the database.
+
+    The groups are deleted too (along with their electrodes) because create_lfp_electrode_group skips existing
+    groups, so a group re-inserted with other electrodes would otherwise keep its previous electrodes as well.
+    """
+    key = {"nwb_file_name": nwb_copy_file_name}
+    sglfp.lfp_merge.LFPOutput.merge_delete(key)
+    if sglfp.ImportedLFP & key:
+        (sglfp.ImportedLFP & key).delete(safemode=False)
+    if sglfp.lfp_electrode.LFPElectrodeGroup & key:
+        (sglfp.lfp_electrode.LFPElectrodeGroup & key).delete(safemode=False)
+
+
+def test_lfp(
+    nwbfile_path: Path,
+    full_length: bool = False,
+    num_threads: int = None,
+    use_checksums: bool = False,
+    lfp_electrode_group_name: str = None,
+    lfp_rate: float = None,
+    num_taps: int = None,
+):
+    """
+    Test that the LFP data fetched from spyglass matches the LFP data of the NWB file.
+
+    Each inserted series is matched to its source series by name (see get_lfp_series_names), and its channels are
+    compared with the channels of the source series that record the same electrodes, so an insertion of selected
+    electrodes is tested against those electrodes only. By default only the first 100 samples are compared.
+    With `full_length=True` the full datasets are compared in aligned blocks by a thread pool (see
+    verification.assert_datasets_equal), which reports the first mismatching block and the verification throughput.
+    LFP decimated from raw data (see the `lfp_rate` of insert_lfp) is compared with the raw series decimated again.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the inserted NWB file.
+    full_length : bool, default: False
+        Whether to compare the full LFP data rather than its first 100 samples.
+    num_threads : int, optional
+        The number of threads used for the full-length comparison. Defaults to the number of CPUs.
+    use_checksums : bool, default: False
+        Whether the full-length comparison compares per-block checksums rather than values.
+    lfp_electrode_group_name : str, optional
+        Only test the LFP of this LFPElectrodeGroup. Defaults to all the imported LFP of the session.
+    lfp_rate : float, optional
+        The `lfp_rate` the LFP was inserted with, if it was decimated from the raw ElectricalSeries.
+    num_taps : int, optional
+        The `num_taps` the LFP was inserted with, if it was decimated from the raw ElectricalSeries.
+    """
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    key = {"nwb_file_name": nwb_copy_file_name}
+    if lfp_electrode_group_name is not None:
+        key["lfp_electrode_group_name"] = lfp_electrode_group_name
+    lfp_electrical_series = [row["lfp"] for row in (sglfp.ImportedLFP & key).fetch_nwb()]
+    if not lfp_electrical_series:
+        raise AssertionError(f"No imported LFP for {key}")
+    index = load_index(nwbfile_path)
+    with h5py.File(nwbfile_path, "r") as file:
+        if lfp_rate is None:
+            nwb_lfp_series = get_lfp_series_names(find_lfp_series(file, index))
+        else:
+            nwb_lfp_series = get_lfp_series_names(find_raw_series(file, index))
+        for lfp_eseries in lfp_electrical_series:
+            nwb_lfp_eseries = nwb_lfp_series[lfp_eseries.name]
+            nwb_lfp_data = memmap_dataset(nwb_lfp_eseries.data)
+            electrode_rows = nwb_lfp_eseries.electrodes
+            inserted_rows = np.asarray(lfp_eseries.electrodes.data[:])
+            if not np.array_equal(inserted_rows, electrode_rows):
+                channel_of_row = {row: channel for channel, row in enumerate(electrode_rows)}
+                nwb_lfp_data = ChannelSelection(nwb_lfp_data, [channel_of_row[row] for row in inserted_rows])
+            if lfp_rate is not None:
+                sampling_rate, _ = get_sampling_rate(
+                    timestamps=memmap_dataset(nwb_lfp_eseries.timestamps), rate=nwb_lfp_eseries.rate
+                )
+                factor = get_decimation_factor(sampling_rate, lfp_rate)
+                nwb_lfp_data = DecimatedView(nwb_lfp_data, factor, taps=design_lowpass(factor, num_taps))
+            if full_length:
+                assert_datasets_equal(
+                    memmap_dataset(lfp_eseries.data), nwb_lfp_data, num_threads=num_threads, use_checksums=use_checksums
+                )
+            else:
+                np.testing.assert_array_equal(np.asarray(lfp_eseries.data[:100]), np.asarray(nwb_lfp_data[:100]))
+
 
 def main():
+    # imported here because batch_insert imports this module
+    from batch_insert import insert_session_incrementally
+
     nwbfile_path = Path("/Volumes/T7/CatalystNeuro/Spyglass/raw/mock_lfp.nwb")
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-
-    if sgc.Session & {"nwb_file_name": nwb_copy_file_name}:
-        (sgc.Session & {"nwb_file_name": nwb_copy_file_name}).delete()
-    if sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}:
-        (sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}).delete()
-    if sgc.ProbeType & {"probe_type": "my_probe_type"}:
-        (sgc.ProbeType & {"probe_type": "my_probe_type"}).delete()
-
-    sgi.insert_sessions(str(nwbfile_path), rollback_on_fail=True, raise_err=True)
-    insert_lfp(nwbfile_path=nwbfile_path)
-    test_lfp(nwbfile_path=nwbfile_path)
+    cache_dir = nwbfile_path.parent / "ingestion_cache"
+    insert_session_incrementally(nwbfile_path, cache_dir=cache_dir, lfp=True)
+    test_lfp(nwbfile_path=nwbfile_path, full_length=True)
 
 
 if __name__ == "__main__":
@@ -1,35 +1,35 @@
-import datajoint as dj
+import functools
 from pathlib import Path
-from pynwb import NWBHDF5IO
+import h5py
 import numpy as np
-from tqdm import tqdm
 
-dj_local_conf_path = "/Users/pauladkisson/Documents/CatalystNeuro/JadhavConv/jadhav-lab-to-nwb/src/jadhav_lab_to_nwb/spyglass_mock/dj_local_conf.json"
-dj.config.load(dj_local_conf_path)  # load config for database connection info
+from spyglass_setup import lazy_import
 
-# spyglass.common has the most frequently used tables
-import spyglass.common as sgc  # this import connects to the database
+sgc = lazy_import("spyglass.common")
+nwb_helper_fn = lazy_import("spyglass.utils.nwb_helper_fn")
 
-# spyglass.data_import has tools for inserting NWB files into the database
-import spyglass.data_import as sgi
-from spyglass.utils.nwb_helper_fn import get_nwb_copy_filename
+# Spike sorting specific imports (the merge module also declares the spikesorting.v1 tables it depends on)
+spikesorting_merge = lazy_import("spyglass.spikesorting.spikesorting_merge")
+sorted_spikes_group = lazy_import("spyglass.spikesorting.analysis.v1.group")
+unit_annotation = lazy_import("spyglass.spikesorting.analysis.v1.unit_annotation")
 
-# Spike sorting specific imports
-from spyglass.spikesorting.spikesorting_merge import (
-    SpikeSortingOutput,
-)
-import spyglass.spikesorting.v1 as sgs
-from spyglass.spikesorting.analysis.v1.group import SortedSpikesGroup
-from spyglass.spikesorting.analysis.v1.group import UnitSelectionParams
-from spyglass.spikesorting.analysis.v1.unit_annotation import UnitAnnotation
+from instrumentation import stage
+from nwb_index import find_objects, get_colnames, get_index_size, load_index, read_column
+from spike_cache import load_spike_trains
+from verification import assert_spike_trains_equal, concatenate_spike_trains
 
 
-def insert_sorting(nwbfile_path: Path, annotation_to_type: dict):
+def insert_sorting(nwbfile_path: Path, annotation_to_type: dict, raise_err: bool = True):
     """
     Insert spike sorting data from an NWB file into a spyglass database.
 
     This function adds UnitAnnotation data from the units table in the NWB file to the UnitAnnotation table in the
     spyglass database. The annotations are added as labels or quantifications depending on the type of annotation.
+    The annotated units are enumerated from the length of the units table (see get_unit_keys) rather than by fetching
+    their spike data. Each annotation column is read once as an array, and all units and annotations are inserted
+    with one batched insert per table inside a single transaction. The units table is found in the structural index
+    of the NWB file (see nwb_index) and its columns are read with h5py, without reading the file with pynwb. Each
+    stage is recorded when tracing is enabled (see instrumentation.stage).
 
     Parameters
     ----------
@@ -37,71 +37,233 @@ def insert_sorting(nwbfile_path: Path, annotation_to_type: dict):
         The path to the NWB file to insert.
     annotation_to_type : dict
         A dictionary mapping annotation names to their types (label or quantification).
+    raise_err : bool, default: True
+        Whether to raise an error listing every invalid unit annotation before inserting anything. If False, the
+        invalid annotations are reported and skipped.
     """
-    io = NWBHDF5IO(nwbfile_path, "r")
-    nwbfile = io.read()
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-    merge_id = str((SpikeSortingOutput.ImportedSpikeSorting & {"nwb_file_name": nwb_copy_file_name}).fetch1("merge_id"))
-
-    UnitSelectionParams().insert_default()
-    group_name = "all_units"
-    SortedSpikesGroup().create_group(
-        group_name=group_name,
-        nwb_file_name=nwb_copy_file_name,
-        keys=[{"spikesorting_merge_id": merge_id}],
-    )
-    group_key = {
-        "nwb_file_name": nwb_copy_file_name,
-        "sorted_spikes_group_name": group_name,
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    with stage("insert_sorting", nwb_file_name=nwb_copy_file_name):
+        with stage("nwb_read") as record:
+            units_path = get_units_path(nwbfile_path)
+            record["bytes_read"] = get_index_size(nwbfile_path)
+
+        with stage("unit_keys"):
+            imported_sorting = spikesorting_merge.SpikeSortingOutput.ImportedSpikeSorting
+            merge_id = str((imported_sorting & {"nwb_file_name": nwb_copy_file_name}).fetch1("merge_id"))
+
+            sorted_spikes_group.UnitSelectionParams().insert_default()
+            group_name = "all_units"
+            sorted_spikes_group.SortedSpikesGroup().create_group(
+                group_name=group_name,
+                nwb_file_name=nwb_copy_file_name,
+                keys=[{"spikesorting_merge_id": merge_id}],
+            )
+            unit_ids = get_unit_keys(merge_id)
+
+        with stage("annotation_rows") as record:
+            with h5py.File(nwbfile_path, "r") as file:
+                units_table = file[units_path]
+                annotation_rows, errors = get_annotation_rows(units_table, unit_ids, annotation_to_type)
+                # the annotation columns read, with the index of ragged columns
+                columns = [f"{name}{suffix}" for name in annotation_to_type for suffix in ("", "_index")]
+                record["bytes_read"] = sum(units_table[name].nbytes for name in columns if name in units_table)
+            record["rows"] = len(annotation_rows)
+        if errors:
+            message = f"Invalid unit annotations in {nwbfile_path.name}:\n" + "\n".join(errors)
+            if raise_err:
+                raise ValueError(message)
+            print(message)
+
+        annotated_unit_ids = {row["unit_id"] for row in annotation_rows}
+        unit_rows = [unit_key for unit_key in unit_ids if unit_key["unit_id"] in annotated_unit_ids]
+        with stage("db_insert", rows=len(unit_rows) + len(annotation_rows)):
+            with unit_annotation.UnitAnnotation.connection.transaction:
+                unit_annotation.UnitAnnotation().insert(unit_rows, skip_duplicates=True)
+                unit_annotation.UnitAnnotation.Annotation().insert(annotation_rows, skip_duplicates=True)
+    print(f"Inserted {len(annotation_rows)} unit annotations for {len(unit_rows)} units")
+
+
+def get_units_path(nwbfile_path: Path) -> str:
+    """Return the path of the units table in an NWB file, found in its structural index (see nwb_index)."""
+    units_paths = find_objects(load_index(nwbfile_path), "Units", parent="")
+    if not units_paths:
+        raise ValueError(f"{Path(nwbfile_path).name} has no units table.")
+    return units_paths[0]
+
+
+@functools.lru_cache(maxsize=128)
+def _get_num_units(merge_id: str) -> int:
+    imported_sorting = spikesorting_merge.SpikeSortingOutput.ImportedSpikeSorting & {"merge_id": merge_id}
+    nwb_file_name = imported_sorting.fetch1("nwb_file_name")
+    with h5py.File(sgc.Nwbfile.get_abs_path(nwb_file_name), "r") as file:
+        return file["units/id"].shape[0]
+
+
+def get_unit_keys(merge_id: str) -> list:
+    """
+    Return the unit keys of an imported sorting without reading its spike times.
+
+    As in SortedSpikesGroup.fetch_spike_data, the units of an imported sorting are numbered by their row in the units
+    table of the spyglass copy of the NWB file, so only the length of its id column is read. The number of units is
+    cached per merge_id; merge ids are never reused, so a reinserted sorting is never served from the cache.
+
+    Parameters
+    ----------
+    merge_id : str
+        The merge_id of the imported sorting in SpikeSortingOutput.
+
+    Returns
+    -------
+    list of dict
+        The unit keys (spikesorting_merge_id and unit_id).
+    """
+    return [{"spikesorting_merge_id": merge_id, "unit_id": unit_id} for unit_id in range(_get_num_units(merge_id))]
+
+
+def get_inserted_annotations(nwb_copy_file_name: str) -> set:
+    """Return the names of the unit annotations inserted for the imported sorting of a session."""
+    imported_sorting = spikesorting_merge.SpikeSortingOutput.ImportedSpikeSorting & {
+        "nwb_file_name": nwb_copy_file_name
+    }
+    if not imported_sorting:
+        return set()
+    merge_id = str(imported_sorting.fetch1("merge_id"))
+    annotations = unit_annotation.UnitAnnotation.Annotation & {"spikesorting_merge_id": merge_id}
+    return set(annotations.fetch("annotation"))
+
+
+def delete_annotations(nwb_copy_file_name: str, annotations: list):
+    """Delete the given unit annotations of the imported sorting of a session from the database."""
+    imported_sorting = spikesorting_merge.SpikeSortingOutput.ImportedSpikeSorting & {
+        "nwb_file_name": nwb_copy_file_name
     }
-    group_key = (SortedSpikesGroup & group_key).fetch1("KEY")
-    _, unit_ids = SortedSpikesGroup().fetch_spike_data(group_key, return_unit_ids=True)
-
-    for unit_key in tqdm(unit_ids, desc="Inserting Unit Annotations"):
-        unit_id = unit_key["unit_id"]
-        for annotation, annotation_type in annotation_to_type.items():
-            annotation_value = nwbfile.units.get((unit_id, annotation))
-            annotation_key = {
-                **unit_key,
-                "annotation": annotation,
-                annotation_type: annotation_value,
-            }
-            UnitAnnotation().add_annotation(annotation_key, skip_duplicates=True)
-    io.close()
-
-
-def test_sorting(nwbfile_path: Path):
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-    with NWBHDF5IO(nwbfile_path, "r") as io:
-        nwbfile = io.read()
-        units_table = nwbfile.units.to_dataframe()
+    if not imported_sorting:
+        return
+    merge_id = str(imported_sorting.fetch1("merge_id"))
+    for annotation in annotations:
+        # part table rows have no dependents, so they are deleted without a cascade
+        key = {"spikesorting_merge_id": merge_id, "annotation": annotation}
+        (unit_annotation.UnitAnnotation.Annotation & key).delete_quick()
+
+
+def get_annotation_rows(units_table, unit_keys: list, annotation_to_type: dict):
+    """
+    Build the UnitAnnotation.Annotation rows of every unit and annotation from the columns of a units table.
+
+    Parameters
+    ----------
+    units_table : h5py.Group
+        The units table holding one column per annotation.
+    unit_keys : list of dict
+        The unit keys (spikesorting_merge_id and unit_id) to annotate. As in spyglass, the unit_id of a unit is its row
+        in the units table, not its id.
+    annotation_to_type : dict
+        A dictionary mapping annotation names to their types (label or quantification).
+
+    Returns
+    -------
+    annotation_rows : list of dict
+        The valid annotation rows.
+    errors : list of str
+        One message per unit annotation that could not be built.
+    """
+    invalid_types = {value for value in annotation_to_type.values() if value not in ("label", "quantification")}
+    if invalid_types:
+        raise ValueError(f"Annotation types must be 'label' or 'quantification', got {sorted(invalid_types)}.")
+
+    num_units = units_table["id"].shape[0]
+    rows = [unit_key["unit_id"] if 0 <= unit_key["unit_id"] < num_units else None for unit_key in unit_keys]
+    errors = [
+        f"unit {unit_key['unit_id']}: not a row of the units table"
+        for unit_key, row in zip(unit_keys, rows)
+        if row is None
+    ]
+
+    colnames = get_colnames(units_table)
+    annotation_rows = []
+    for annotation, annotation_type in annotation_to_type.items():
+        if annotation not in colnames:
+            errors.append(f"annotation {annotation!r}: not a column of the units table")
+            continue
+        if f"{annotation}_index" in units_table:
+            errors.append(f"annotation {annotation!r}: ragged columns cannot be used as annotations")
+            continue
+        values = read_column(units_table, annotation)
+        for unit_key, row in zip(unit_keys, rows):
+            if row is None:
+                continue
+            value = values[row]
+            if annotation_type == "label":
+                value = value.decode("utf-8") if isinstance(value, bytes) else str(value)
+            else:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    errors.append(f"unit {unit_key['unit_id']}: quantification {annotation!r} is not a number")
+                    continue
+                if np.isnan(value):
+                    errors.append(f"unit {unit_key['unit_id']}: quantification {annotation!r} is NaN")
+                    continue
+            annotation_rows.append({**unit_key, "annotation": annotation, annotation_type: value})
+    return annotation_rows, errors
+
+
+def test_sorting(nwbfile_path: Path, spike_cache_dir: Path = None):
+    """
+    Test that the spike trains fetched from spyglass match the units table of the NWB file.
+
+    The ragged spike_times column is read with h5py as one flat array plus its index, and compared to the fetched
+    spike trains unit by unit id with vectorized operations (see verification.assert_spike_trains_equal).
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the inserted NWB file.
+    spike_cache_dir : Path, optional
+        The directory of a spike train cache (see spike_cache). If given, the spike trains of the group are loaded
+        from the cache, which fetches them once per sorting, instead of being fetched with fetch_spike_data.
+    """
+    nwb_copy_file_name = nwb_helper_fn.get_nwb_copy_filename(nwbfile_path.name)
+    with h5py.File(nwbfile_path, "r") as file:
+        units_table = file[get_units_path(nwbfile_path)]
+        nwb_spike_times = units_table["spike_times"][:]
+        nwb_spike_times_index = units_table["spike_times_index"][:]
+        # spyglass numbers the units by their row in the units table, not by their id
+        nwb_unit_ids = np.arange(len(nwb_spike_times_index))
     group_key = {
         "nwb_file_name": nwb_copy_file_name,
         "sorted_spikes_group_name": "all_units",
     }
-    group_key = (SortedSpikesGroup & group_key).fetch1("KEY")
-    spikes_spyglass = SortedSpikesGroup().fetch_spike_data(group_key)
-    spikes_nwb = [unit.spike_times for _, unit in units_table.iterrows()]
-    for nwb_unit, spyglass_unit in zip(spikes_nwb, spikes_spyglass):
-        np.testing.assert_array_equal(nwb_unit, spyglass_unit)
+    group_key = (sorted_spikes_group.SortedSpikesGroup & group_key).fetch1("KEY")
+    if spike_cache_dir is not None:
+        spyglass_spike_times, spyglass_spike_times_index, unit_keys = load_spike_trains(group_key, spike_cache_dir)
+    else:
+        spikes_spyglass, unit_keys = sorted_spikes_group.SortedSpikesGroup().fetch_spike_data(
+            group_key, return_unit_ids=True
+        )
+        spyglass_spike_times, spyglass_spike_times_index = concatenate_spike_trains(spikes_spyglass)
+    assert_spike_trains_equal(
+        actual_spike_times=spyglass_spike_times,
+        actual_index=spyglass_spike_times_index,
+        actual_unit_ids=[unit_key["unit_id"] for unit_key in unit_keys],
+        expected_spike_times=nwb_spike_times,
+        expected_index=nwb_spike_times_index,
+        expected_unit_ids=nwb_unit_ids,
+    )
 
 
 def main():
-    nwbfile_path = Path("/Volumes/T7/CatalystNeuro/Spyglass/raw/mock_sorting.nwb")
-    nwb_copy_file_name = get_nwb_copy_filename(nwbfile_path.name)
-
-    if sgc.Session & {"nwb_file_name": nwb_copy_file_name}:
-        (sgc.Session & {"nwb_file_name": nwb_copy_file_name}).delete()
-    if sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}:
-        (sgc.Nwbfile & {"nwb_file_name": nwb_copy_file_name}).delete()
+    # imported here because batch_insert imports this module
+    from batch_insert import insert_session_incrementally
 
-    sgi.insert_sessions(str(nwbfile_path), rollback_on_fail=True, raise_err=True)
+    nwbfile_path = Path("/Volumes/T7/CatalystNeuro/Spyglass/raw/mock_sorting.nwb")
+    cache_dir = nwbfile_path.parent / "ingestion_cache"
     annotation_to_type = {
         "custom_label": "label",
         "custom_quantification": "quantification",
     }
-    insert_sorting(nwbfile_path=nwbfile_path, annotation_to_type=annotation_to_type)
-    test_sorting(nwbfile_path=nwbfile_path)
+    insert_session_incrementally(nwbfile_path, cache_dir=cache_dir, annotation_to_type=annotation_to_type)
+    test_sorting(nwbfile_path=nwbfile_path, spike_cache_dir=cache_dir / "spike_trains")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+"""
+Per-stage instrumentation of the insert scripts.
+
+The insert functions wrap each of their stages (reading the NWB file, writing the analysis file, inserting rows, ...)
+in `stage(name)`. When a sink is registered with add_sink (or for the duration of a `tracing(...)` block), every
+stage emits a record with its wall time, the bytes it read and wrote, the rows it inserted and the peak resident memory
+of the process during the stage to each sink. A sink is any callable taking the record; JsonLinesSink and LoggingSink
+are provided. When no sink is registered, stage() does no timing or bookkeeping at all.
+
+Example:
+    with tracing(JsonLinesSink("trace.jsonl")):
+        insert_lfp(nwbfile_path)
+"""
+
+import contextvars
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+_sinks = []
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+# the interval in seconds at which the resident memory is sampled while stages run
+RSS_SAMPLING_INTERVAL = 0.01
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of the current process in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        return peak_rss / 1e6
+    return peak_rss / 1e3
+
+
+def get_rss_mb():
+    """
+    Return the current resident set size of the process in MB.
+
+    It is read from /proc/self/statm, so it is only available on Linux; elsewhere the peak of the process (see
+    get_peak_rss_mb) is returned instead.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+    except OSError:
+        return get_peak_rss_mb()
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+class RssSampler:
+    """
+    The peak resident memory of each running stage, sampled every `interval` seconds by a background thread.
+
+    The thread only runs while a stage is being measured. Memory allocated and freed between two samples is missed,
+    but each stage is also sampled when it starts and ends.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLING_INTERVAL):
+        self.interval = interval
+        self._peaks = {}  # the peak of each running stage by its id
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self) -> int:
+        """Start measuring a stage, and return its id."""
+        rss_mb = get_rss_mb()
+        with self._lock:
+            stage_id = max(self._peaks, default=0) + 1
+            self._peaks[stage_id] = rss_mb
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+        return stage_id
+
+    def stop(self, stage_id: int) -> float:
+        """Stop measuring a stage, and return its peak resident memory in MB."""
+        rss_mb = get_rss_mb()
+        with self._lock:
+            return max(self._peaks.pop(stage_id), rss_mb)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            rss_mb = get_rss_mb()
+            with self._lock:
+                if not self._peaks:
+                    self._thread = None
+                    return
+                for stage_id, peak_mb in self._peaks.items():
+                    self._peaks[stage_id] = max(peak_mb, rss_mb)
+
+
+_rss_sampler = RssSampler()
+
+
+def add_sink(sink):
+    """Register a sink, a callable that is passed the record (a dict) of every stage that completes."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """Unregister a sink registered with add_sink."""
+    _sinks.remove(sink)
+
+
+def is_enabled() -> bool:
+    """Whether any sink is registered, i.e. whether stages are recorded."""
+    return bool(_sinks)
+
+
+@contextmanager
+def tracing(*sinks):
+    """Register `sinks` for the duration of the block."""
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Record a stage of an insert: its wall time, I/O, inserted rows and peak resident memory (see RssSampler).
+
+    The record is yielded so that the stage can add its own measurements (by convention "bytes_read",
+    "bytes_written" and "rows"). Stages nest: the name of a stage inside another is prefixed by the name of the
+    outer stage, e.g. "insert_lfp/analysis_write". If the stage raises, its record has an "error" and is still
+    emitted.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+    **attributes
+        Extra fields of the record, e.g. the NWB file name.
+
+    Yields
+    ------
+    dict
+        The record of the stage, emitted to the sinks when the stage completes. When no sink is registered, a
+        throwaway dict.
+    """
+    if not _sinks:
+        yield {}
+        return
+    parent = _current_stage.get()
+    record = dict(stage=name if parent is None else f"{parent}/{name}", **attributes)
+    token = _current_stage.set(record["stage"])
+    record["start_time"] = time.time()
+    start_time = time.perf_counter()
+    stage_id = _rss_sampler.start()
+    try:
+        yield record
+    except BaseException as error:
+        record["error"] = repr(error)
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - start_time
+        record["peak_rss_mb"] = _rss_sampler.stop(stage_id)
+        _current_stage.reset(token)
+        for sink in list(_sinks):
+            sink(record)
+
+
+class JsonLinesSink:
+    """A sink appending each record as a line of JSON to a file, so that several processes can share the file."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def __call__(self, record: dict):
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record, default=str) + "\n")
+
+
+class LoggingSink:
+    """A sink logging a one-line summary of each record."""
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger("insert")
+        self.level = level
+
+    def __call__(self, record: dict):
+        measurements = [f"{record['duration']:.3f} s"]
+        for key, unit, scale in (("bytes_read", "MB read", 1e6), ("bytes_written", "MB written", 1e6)):
+            if record.get(key) is not None:
+                measurements.append(f"{record[key] / scale:.1f} {unit}")
+        if record.get("rows") is not None:
+            measurements.append(f"{record['rows']} rows")
+        measurements.append(f"peak RSS {record['peak_rss_mb']:.1f} MB")
+        error = f" FAILED: {record['error']}" if "error" in record else ""
+        self.logger.log(self.level, "%s: %s%s", record["stage"], ", ".join(measurements), error)
@@ -0,0 +1,31 @@
+"""
+The JSON sidecar files of the inserts (NWB file indexes, fingerprint cache entries and checkpoint journals).
+
+These files only save work: a missing or corrupt file is treated as absent, which costs a rebuild or a re-insert but
+never fails an insert, and files are written atomically, so a concurrent or interrupted write never leaves a partial
+file behind.
+"""
+
+import json
+import os
+from pathlib import Path
+
+
+def load_json(path: Path):
+    """Return the content of a JSON file, or None if it is missing or corrupt."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text())
+    except json.JSONDecodeError:
+        return None
+
+
+def atomic_write_json(path: Path, value, indent: int = None):
+    """Write a value to a JSON file through a temporary file that replaces it, creating its directory if needed."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    temp_path.write_text(json.dumps(value, indent=indent))
+    os.replace(temp_path, path)
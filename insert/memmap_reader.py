@@ -0,0 +1,54 @@
+"""
+Zero-copy reads of contiguous, uncompressed HDF5 datasets.
+
+A dataset stored contiguously and without filters is a single block of bytes at a fixed offset of its file, so it can
+be read as a read-only np.memmap instead of through h5py. Reads of a memmap are plain page-cache reads: they need no
+HDF5 library call (and hold no HDF5 lock, so threads read in parallel), no intermediate buffer and no type
+conversion. Chunked or filtered datasets, and datasets that cannot be mapped for another reason, are returned as is
+and read through h5py.
+"""
+
+import h5py
+import numpy as np
+
+# the HDF5 file drivers that store a file as one regular file on disk
+MAPPABLE_DRIVERS = ("sec2", "stdio")
+
+
+def get_memmap_offset(dataset) -> int:
+    """
+    Return the offset in its file of the data of an HDF5 dataset that can be memory-mapped, or None.
+
+    A dataset can be memory-mapped if it is contiguous (not chunked, hence not compressed), allocated, not stored in
+    an external file, of a fixed-size numeric or boolean type, and its file is a single regular file.
+    """
+    if not isinstance(dataset, h5py.Dataset):
+        return None
+    if dataset.chunks is not None or dataset.external or dataset.shape is None or dataset.size == 0:
+        return None
+    if dataset.dtype.kind not in "biufc" or dataset.file.driver not in MAPPABLE_DRIVERS:
+        return None
+    return dataset.id.get_offset()  # None if the data was never written; includes the user block
+
+
+def memmap_dataset(dataset):
+    """
+    Return a read-only np.memmap of the data of an HDF5 dataset, or the dataset itself if it cannot be mapped.
+
+    The memmap stays valid after the HDF5 file is closed and supports the slicing of an h5py dataset, so it can be
+    used wherever the dataset is read, e.g. by a DatasetChunkIterator, ChannelSelection, get_sampling_rate or
+    assert_datasets_equal.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        The dataset to map. Anything that is not a contiguous HDF5 dataset (see get_memmap_offset) is returned as is.
+
+    Returns
+    -------
+    np.memmap or h5py.Dataset or array-like
+    """
+    offset = get_memmap_offset(dataset)
+    if offset is None:
+        return dataset
+    return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape)
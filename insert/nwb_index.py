@@ -0,0 +1,246 @@
+"""
+Structural indexes of NWB files, so that the insert and test functions open only the HDF5 objects they need.
+
+Reading an NWB file with NWBHDF5IO builds a pynwb object for every group and dataset of the file, including those of
+extensions such as ndx_franklab_novela, which takes seconds to minutes for files with many objects when an insert only
+needs a few datasets. The index of a file records the path, neurodata type, object id, shape, dtype, chunk layout and
+compression of each of its objects, along with their scalar attributes, in a single traversal of the file with h5py.
+It is saved as a JSON sidecar next to the file (or in `index_dir`) and rebuilt when the size or modification time of
+the file changes. The objects found in the index are then opened by path with h5py, e.g. as a TimeSeriesView or with
+read_table.
+"""
+
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from ingestion_cache import get_file_stat
+from json_files import atomic_write_json, load_json
+
+INDEX_VERSION = 1
+# the attributes stored in their own field of an entry of the index
+IDENTITY_ATTRIBUTES = ("neurodata_type", "namespace", "object_id")
+
+
+def get_index_path(nwbfile_path: Path, index_dir: Path = None) -> Path:
+    """Return the path of the index of an NWB file: next to the file, or in `index_dir`."""
+    nwbfile_path = Path(nwbfile_path)
+    return Path(index_dir or nwbfile_path.parent) / f"{nwbfile_path.name}.index.json"
+
+
+def get_index_size(nwbfile_path: Path, index_dir: Path = None) -> int:
+    """Return the size in bytes of the saved index of an NWB file, or 0 if it is not saved."""
+    index_path = get_index_path(nwbfile_path, index_dir)
+    return index_path.stat().st_size if index_path.exists() else 0
+
+
+def build_index(nwbfile_path: Path) -> dict:
+    """
+    Index the objects of an NWB file in one traversal of the file, without reading any data.
+
+    Returns
+    -------
+    dict
+        The index with keys "version", "file" (the size and modification time of the file) and "objects", which maps
+        the path of each group and dataset in the file ("" for the root) to its entry: its "kind" ("group" or
+        "dataset"), "neurodata_type", "namespace", "object_id" and scalar "attributes", plus the "shape", "dtype",
+        "itemsize", "chunks", "compression", "compression_opts" and "storage_size" (in bytes) of datasets. An object
+        reachable through several hard links is recorded once; soft links are not recorded, but opening their path
+        with h5py resolves them.
+    """
+    objects = {}
+
+    def visit(path: str, h5_object):
+        objects[path] = _describe(h5_object)
+
+    file_stat = get_file_stat(nwbfile_path)
+    with h5py.File(nwbfile_path, "r") as file:
+        visit("", file)
+        file.visititems(visit)
+    return dict(version=INDEX_VERSION, file=file_stat, objects=objects)
+
+
+def _describe(h5_object) -> dict:
+    entry = dict(kind="dataset" if isinstance(h5_object, h5py.Dataset) else "group")
+    for key in IDENTITY_ATTRIBUTES:
+        entry[key] = _decode(h5_object.attrs.get(key))
+    attributes = {}
+    for key in h5_object.attrs:
+        if key in IDENTITY_ATTRIBUTES:
+            continue
+        value = _to_json(h5_object.attrs[key])
+        if value is not None:
+            attributes[key] = value
+    entry["attributes"] = attributes
+    if entry["kind"] == "dataset":
+        entry.update(
+            shape=None if h5_object.shape is None else list(h5_object.shape),
+            dtype=_describe_dtype(h5_object.dtype),
+            itemsize=h5_object.dtype.itemsize,
+            chunks=None if h5_object.chunks is None else list(h5_object.chunks),
+            compression=h5_object.compression,
+            compression_opts=_to_json(h5_object.compression_opts),
+            storage_size=h5_object.id.get_storage_size(),
+        )
+    return entry
+
+
+def _describe_dtype(dtype: np.dtype) -> str:
+    if h5py.check_string_dtype(dtype) is not None:
+        return "str"
+    if h5py.check_ref_dtype(dtype) is not None:
+        return "reference"
+    return str(dtype)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _to_json(value):
+    # the JSON value of a scalar or 1D attribute of numbers or strings (e.g. the colnames of a table), otherwise None
+    if isinstance(value, (bytes, str)):
+        return _decode(value)
+    value = np.asarray(value)
+    if value.ndim > 1:
+        return None
+    if value.dtype.kind in "biuf":
+        return value.tolist()
+    items = value.tolist() if value.ndim else [value.item()]
+    if not all(isinstance(item, (bytes, str)) for item in items):
+        return None  # references, compound values, ...
+    items = [_decode(item) for item in items]
+    return items if value.ndim else items[0]
+
+
+def load_index(nwbfile_path: Path, index_dir: Path = None) -> dict:
+    """
+    Return the index of an NWB file (see build_index), building and saving it if it is missing or out of date.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path to the NWB file.
+    index_dir : Path, optional
+        The directory of the index. Defaults to the directory of the NWB file. If the index cannot be saved there
+        (e.g. a read-only directory), it is rebuilt on every load.
+    """
+    index_path = get_index_path(nwbfile_path, index_dir)
+    index = load_json(index_path)
+    if index is not None and index.get("version") == INDEX_VERSION and index.get("file") == get_file_stat(nwbfile_path):
+        return index
+    index = build_index(nwbfile_path)
+    try:
+        atomic_write_json(index_path, index)
+    except OSError as error:
+        print(f"Could not save the index of {Path(nwbfile_path).name} to {index_path}: {error}")
+    return index
+
+
+def find_objects(index: dict, neurodata_types, parent_types=None, parent: str = None) -> list:
+    """
+    Return the paths of the objects of an index with one of the given neurodata types, in the order of the file.
+
+    Parameters
+    ----------
+    index : dict
+        The index of the NWB file (see load_index).
+    neurodata_types : str or tuple of str
+        The neurodata types of the objects, e.g. "ElectricalSeries". Subtypes are not matched.
+    parent_types : tuple of str, optional
+        Only return objects whose parent group has one of these neurodata types, e.g. ("LFP", "FilteredEphys").
+    parent : str, optional
+        Only return objects in this group, e.g. "acquisition".
+    """
+    neurodata_types = (neurodata_types,) if isinstance(neurodata_types, str) else tuple(neurodata_types)
+    objects = index["objects"]
+    paths = []
+    for path, entry in objects.items():
+        if entry["neurodata_type"] not in neurodata_types:
+            continue
+        parent_path = path.rpartition("/")[0]
+        if parent is not None and parent_path != parent.strip("/"):
+            continue
+        if parent_types is not None and objects.get(parent_path, {}).get("neurodata_type") not in parent_types:
+            continue
+        paths.append(path)
+    return paths
+
+
+class TimeSeriesView:
+    """
+    The datasets and attributes of a TimeSeries, opened from its HDF5 group without pynwb.
+
+    Attributes
+    ----------
+    name : str
+        The name of the series.
+    path : str
+        The path of the series in the NWB file.
+    container_name : str
+        The name of the group holding the series, e.g. its LFP container.
+    data : h5py.Dataset
+        The data of the series.
+    timestamps : h5py.Dataset or None
+        The timestamps of the series, or None if it has a starting time and rate.
+    starting_time, rate : float or None
+        The starting time and sampling rate of the series, or None if it has timestamps.
+    description : str
+        The description of the series.
+    electrodes : np.ndarray or None
+        The rows of the electrodes table recorded by each channel of an ElectricalSeries, or None for other series.
+    """
+
+    def __init__(self, group: h5py.Group):
+        self.name = group.name.rpartition("/")[2]
+        self.path = group.name
+        self.container_name = group.parent.name.rpartition("/")[2]
+        self.data = group["data"]
+        self.timestamps = group.get("timestamps")
+        self.starting_time = self.rate = None
+        if "starting_time" in group:
+            self.starting_time = float(group["starting_time"][()])
+            self.rate = float(group["starting_time"].attrs["rate"])
+        self.description = _decode(group.attrs.get("description", "no description"))
+        self.electrodes = np.asarray(group["electrodes"][:]) if "electrodes" in group else None
+
+
+def get_colnames(table: h5py.Group) -> list:
+    """Return the names of the columns of a DynamicTable from its HDF5 group, in order."""
+    return [_decode(name) for name in table.attrs.get("colnames", [])]
+
+
+def read_column(table: h5py.Group, name: str):
+    """
+    Read a column of a DynamicTable from its HDF5 group.
+
+    Strings are decoded and references are resolved to the names of the referenced objects (e.g. the electrode group
+    of each electrode). A ragged column (with a `<name>_index` dataset) is returned as a list with one array per row.
+    """
+    dataset = table[name]
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        values = dataset.asstr()[:]
+    elif h5py.check_ref_dtype(dataset.dtype) is h5py.Reference:
+        values = np.array(
+            [table.file[reference].name.rpartition("/")[2] if reference else None for reference in dataset[:]],
+            dtype=object,
+        )
+    else:
+        values = dataset[:]
+    index_name = f"{name}_index"
+    if index_name in table:
+        return np.split(values, table[index_name][:-1])
+    return list(values) if values.ndim > 1 else values
+
+
+def read_table(table: h5py.Group) -> pd.DataFrame:
+    """
+    Read a DynamicTable from its HDF5 group as a DataFrame indexed by its ids, like DynamicTable.to_dataframe.
+
+    The columns are read with read_column, so reference columns (e.g. the group column of the electrodes table) hold
+    the names of the referenced objects rather than pynwb objects.
+    """
+    columns = {name: read_column(table, name) for name in get_colnames(table)}
+    return pd.DataFrame(columns, index=pd.Index(table["id"][:], name="id"))
@@ -0,0 +1,163 @@
+"""
+Overlapped read, compress and write of a dataset into a chunked HDF5 dataset.
+
+A plain copy of a compressed dataset is sequential: each chunk is read (and decompressed), then compressed and
+written, so either the CPU or the disk is idle. copy_dataset_pipelined instead runs three stages at once:
+
+- a reader thread reads bands of rows of the source, one band of target chunks high, into a bounded pool of
+  preallocated buffers,
+- a pool of worker threads applies the HDF5 filters of the target (shuffle and deflate) to each chunk with numpy and
+  zlib, which release the GIL,
+- the calling thread writes the encoded chunks in order with H5Dwrite_chunk (h5py's write_direct_chunk), bypassing
+  the HDF5 filter pipeline.
+
+The number of buffers (`queue_depth`) bounds the memory of the copy to `queue_depth` bands plus their encoded chunks.
+"""
+
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+
+
+def get_chunk_shape(shape: tuple, dtype, chunk_mb: float = 10.0) -> tuple:
+    """Return a chunk shape of about `chunk_mb` MB spanning every column, as hdmf does for time series."""
+    row_bytes = int(np.prod(shape[1:], dtype="int64")) * np.dtype(dtype).itemsize
+    chunk_rows = max(1, min(shape[0], int(chunk_mb * 1e6) // max(row_bytes, 1)))
+    return (chunk_rows, *shape[1:])
+
+
+def get_filters(dataset: h5py.Dataset) -> tuple:
+    """
+    Return whether the chunks of a dataset are shuffled and their deflate (gzip) level, or None if not deflated.
+
+    Raises
+    ------
+    ValueError
+        If the dataset uses another filter, which the pipeline cannot encode.
+    """
+    plist = dataset.id.get_create_plist()
+    shuffle, level = False, None
+    for index in range(plist.get_nfilters()):
+        filter_id, _, values, _ = plist.get_filter(index)
+        if filter_id == H5Z_FILTER_SHUFFLE:
+            shuffle = True
+        elif filter_id == H5Z_FILTER_DEFLATE:
+            level = values[0] if values else 6
+        else:
+            raise ValueError(f"Cannot encode the chunks of {dataset.name}: unsupported HDF5 filter {filter_id}.")
+    return shuffle, level
+
+
+def encode_chunk(chunk: np.ndarray, shuffle: bool = False, level: int = None) -> bytes:
+    """Apply the HDF5 shuffle and deflate filters to a chunk, as HDF5 would when writing it."""
+    chunk = np.ascontiguousarray(chunk)
+    if shuffle and chunk.dtype.itemsize > 1:
+        # the shuffle filter stores the first byte of every element, then the second byte, ...
+        chunk = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T
+    data = np.ascontiguousarray(chunk).tobytes()
+    if level is not None:
+        data = zlib.compress(data, level)
+    return data
+
+
+def copy_dataset_pipelined(source, target: h5py.Dataset, queue_depth: int = 4, num_workers: int = None) -> float:
+    """
+    Copy `source` into the empty, chunked HDF5 dataset `target` with overlapped reads, encoding and writes.
+
+    Parameters
+    ----------
+    source : h5py.Dataset or array-like
+        The data to copy, with the shape of `target`. Anything that supports slicing rows works, e.g. a
+        ChannelSelection.
+    target : h5py.Dataset
+        The chunked dataset to write, with no filters or with the shuffle and/or deflate (gzip) filters.
+    queue_depth : int, default: 4
+        The number of preallocated band buffers, i.e. how far reading can run ahead of writing.
+    num_workers : int, optional
+        The number of chunk encoding threads. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    float
+        The duration of the copy in seconds.
+    """
+    if tuple(source.shape) != tuple(target.shape):
+        raise ValueError(f"Shape mismatch: {tuple(source.shape)} != {tuple(target.shape)}")
+    if target.chunks is None:
+        raise ValueError(f"{target.name} is not chunked.")
+    if queue_depth < 1:
+        raise ValueError(f"queue_depth must be at least 1, got {queue_depth}.")
+    shuffle, level = get_filters(target)
+    chunks = target.chunks
+    num_rows = target.shape[0]
+    band_shape = (chunks[0], *target.shape[1:])
+    # the column offsets of the chunks of a band (one chunk per band for 1D data)
+    column_offsets = list(np.ndindex(*[-(-size // chunk) for size, chunk in zip(target.shape[1:], chunks[1:])]))
+
+    free_buffers = queue.Queue()
+    for _ in range(queue_depth):
+        free_buffers.put(np.empty(band_shape, dtype=target.dtype))
+    ready_bands = queue.Queue()
+    stop = threading.Event()
+    start_time = time.perf_counter()
+
+    def read_bands(executor):
+        try:
+            for band_start in range(0, num_rows, chunks[0]):
+                buffer = free_buffers.get()
+                if stop.is_set():
+                    return
+                band_rows = min(chunks[0], num_rows - band_start)
+                if isinstance(source, h5py.Dataset):
+                    source.read_direct(buffer, np.s_[band_start : band_start + band_rows], np.s_[:band_rows])
+                else:
+                    buffer[:band_rows] = source[band_start : band_start + band_rows]
+                buffer[band_rows:] = 0  # HDF5 stores edge chunks padded to the full chunk shape
+                futures = []
+                for offset in column_offsets:
+                    columns = tuple(
+                        slice(index * chunk, (index + 1) * chunk) for index, chunk in zip(offset, chunks[1:])
+                    )
+                    chunk = _pad(buffer[(slice(None), *columns)], chunks)
+                    chunk_offset = (band_start, *(index * chunk for index, chunk in zip(offset, chunks[1:])))
+                    futures.append((chunk_offset, executor.submit(encode_chunk, chunk, shuffle, level)))
+                ready_bands.put((buffer, futures))
+        except BaseException as error:
+            ready_bands.put(error)
+            return
+        ready_bands.put(None)
+
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        reader = threading.Thread(target=read_bands, args=(executor,), daemon=True)
+        reader.start()
+        try:
+            while (band := ready_bands.get()) is not None:
+                if isinstance(band, BaseException):
+                    raise band
+                buffer, futures = band
+                for chunk_offset, future in futures:
+                    target.id.write_direct_chunk(chunk_offset, future.result())
+                free_buffers.put(buffer)
+        finally:
+            stop.set()
+            free_buffers.put(None)  # unblock a reader waiting for a buffer
+            reader.join()
+    return time.perf_counter() - start_time
+
+
+def _pad(chunk: np.ndarray, chunk_shape: tuple) -> np.ndarray:
+    # the last chunk of each column is padded to the full chunk shape, as HDF5 stores it
+    if chunk.shape == tuple(chunk_shape):
+        return chunk
+    padded = np.zeros(chunk_shape, dtype=chunk.dtype)
+    padded[tuple(slice(0, size) for size in chunk.shape)] = chunk
+    return padded
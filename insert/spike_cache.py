@@ -0,0 +1,114 @@
+"""
+A columnar on-disk cache of the spike trains of sorted spikes groups.
+
+SortedSpikesGroup.fetch_spike_data opens the NWB files of every sorting of a group and builds a list of per-unit
+arrays on every call. load_spike_trains stores the spike trains of a group once, as columns in a directory of the
+cache:
+
+- spike_times.npy: the spike times of every unit, concatenated,
+- index.npy: the end offset of the spike times of each unit (the layout of a ragged NWB column, see
+  verification.concatenate_spike_trains),
+- unit_keys.json: the key (spikesorting_merge_id and unit_id) of each unit, and the key of the group.
+
+Later loads map the .npy files read-only, so they take milliseconds and copy nothing whatever the number of spikes.
+The entry of a group is named after a digest of its key and of the merge ids of its sortings. A sorting gets a new
+merge id whenever it is reinserted, so a group whose sortings changed is fetched and stored again rather than served
+stale, and the entries of its previous sortings are deleted.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from spyglass_setup import lazy_import
+
+sorted_spikes_group = lazy_import("spyglass.spikesorting.analysis.v1.group")
+
+from verification import concatenate_spike_trains
+
+
+def _digest(value) -> str:
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def _to_json(value):
+    # merge ids are UUIDs and unit ids may be numpy integers
+    return int(value) if isinstance(value, (int, np.integer)) else str(value)
+
+
+def get_entry_path(cache_dir: Path, group_key: dict, merge_ids: list) -> Path:
+    """Return the directory of the cached spike trains of a group of sortings."""
+    return Path(cache_dir) / _digest(group_key) / _digest(sorted(str(merge_id) for merge_id in merge_ids))
+
+
+def load_spike_trains(group_key: dict, cache_dir: Path, refresh: bool = False) -> tuple:
+    """
+    Return the spike trains of a sorted spikes group as columns, fetching and caching them if they are not cached.
+
+    Parameters
+    ----------
+    group_key : dict
+        The primary key of the SortedSpikesGroup.
+    cache_dir : Path
+        The directory of the cache.
+    refresh : bool, default: False
+        Whether to fetch the spike trains again even if they are cached.
+
+    Returns
+    -------
+    spike_times : np.ndarray
+        The spike times of every unit, concatenated, as a read-only memmap.
+    index : np.ndarray
+        The end offset in `spike_times` of the spike times of each unit.
+    unit_keys : list of dict
+        The key of each unit, in the order of fetch_spike_data(key, return_unit_ids=True).
+    """
+    group_key = dict(group_key)
+    merge_ids = (sorted_spikes_group.SortedSpikesGroup.Units & group_key).fetch("spikesorting_merge_id")
+    entry_path = get_entry_path(cache_dir, group_key, merge_ids)
+    if refresh or not (entry_path / "unit_keys.json").exists():
+        spike_trains, unit_keys = sorted_spikes_group.SortedSpikesGroup().fetch_spike_data(
+            group_key, return_unit_ids=True
+        )
+        save_spike_trains(entry_path, group_key, *concatenate_spike_trains(spike_trains), unit_keys)
+    entry = json.loads((entry_path / "unit_keys.json").read_text())
+    # an empty array cannot be mapped
+    spike_times = np.load(entry_path / "spike_times.npy", mmap_mode="r" if entry["num_spikes"] else None)
+    index = np.load(entry_path / "index.npy", mmap_mode="r" if entry["unit_keys"] else None)
+    return spike_times, index, entry["unit_keys"]
+
+
+def save_spike_trains(entry_path: Path, group_key: dict, spike_times, index, unit_keys: list):
+    """
+    Atomically store the spike trains of a group in a cache entry, and delete the other entries of the group.
+
+    The entry is written to a temporary directory that is then renamed, so a concurrent or interrupted write never
+    leaves a partial entry behind.
+    """
+    entry_path = Path(entry_path)
+    temp_path = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temp_path, ignore_errors=True)
+    temp_path.mkdir(parents=True)
+    np.save(temp_path / "spike_times.npy", np.ascontiguousarray(spike_times))
+    np.save(temp_path / "index.npy", np.asarray(index, dtype="int64"))
+    unit_keys = [{name: _to_json(value) for name, value in key.items()} for key in unit_keys]
+    entry = dict(group_key={name: _to_json(value) for name, value in group_key.items()}, unit_keys=unit_keys)
+    entry["num_spikes"] = len(spike_times)
+    (temp_path / "unit_keys.json").write_text(json.dumps(entry))
+    shutil.rmtree(entry_path, ignore_errors=True)
+    try:
+        os.replace(temp_path, entry_path)
+    except OSError:
+        shutil.rmtree(temp_path, ignore_errors=True)  # another process stored the same entry first
+    for stale_path in entry_path.parent.iterdir():
+        if stale_path != entry_path and not stale_path.name.endswith(".tmp"):
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def split_spike_trains(spike_times: np.ndarray, index: np.ndarray) -> list:
+    """Return the spike train of each unit as a view of the concatenated spike times, like fetch_spike_data."""
+    return np.split(spike_times, np.asarray(index)[:-1])
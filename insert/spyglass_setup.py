@@ -0,0 +1,64 @@
+"""
+Deferred datajoint configuration and spyglass imports.
+
+Importing spyglass.common connects to the database, and spyglass pulls in a large dependency tree. The insert modules
+therefore import spyglass through lazy_import, so that importing them (e.g. in a worker process, a CLI or a test) is
+cheap and the datajoint config is only loaded, and the database only connected to, when a spyglass table is first
+used.
+"""
+
+import importlib
+import os
+
+import datajoint as dj
+
+DJ_LOCAL_CONF_PATH_ENV_VAR = "DJ_LOCAL_CONF_PATH"
+_dj_config_loaded = False
+
+
+def load_dj_config(dj_local_conf_path: str = None):
+    """
+    Load the datajoint config with the database connection info.
+
+    The config is read from `dj_local_conf_path` if given, otherwise from the path in the DJ_LOCAL_CONF_PATH
+    environment variable. If neither is set, datajoint's own defaults apply (a dj_local_conf.json in the working
+    directory and the DJ_HOST/DJ_USER/DJ_PASS environment variables). Without an explicit path, the config is only
+    loaded once per process.
+
+    Parameters
+    ----------
+    dj_local_conf_path : str, optional
+        The path to a datajoint config file.
+    """
+    global _dj_config_loaded
+    if dj_local_conf_path is None:
+        if _dj_config_loaded:
+            return
+        dj_local_conf_path = os.environ.get(DJ_LOCAL_CONF_PATH_ENV_VAR)
+    if dj_local_conf_path is not None:
+        dj.config.load(str(dj_local_conf_path))
+    _dj_config_loaded = True
+
+
+class LazyModule:
+    """A module proxy that loads the datajoint config and imports the module on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):  # keep copy/pickle/introspection from triggering the import
+            raise AttributeError(attr)
+        if self._module is None:
+            load_dj_config()
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r} ({'imported' if self._module is not None else 'not imported'})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Return a proxy of the module `name` that is imported (after loading the datajoint config) on first use."""
+    return LazyModule(name)
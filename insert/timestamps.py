@@ -0,0 +1,92 @@
+"""Sampling rate detection for time series stored with explicit timestamps."""
+
+import numpy as np
+
+
+def get_sampling_rate(
+    timestamps=None,
+    rate: float = None,
+    num_blocks: int = 100,
+    block_size: int = 1_000,
+    jitter_tolerance: float = 1e-3,
+):
+    """
+    Get the sampling rate of a time series and whether its samples are regularly spaced.
+
+    If the series has a `rate` it is returned as is. Otherwise only `num_blocks` blocks of `block_size` consecutive
+    timestamps, spread evenly over the series, are read (plus the first and last timestamps), so the cost does not
+    depend on the length of the series. The sampling rate is estimated from the median sampling interval of the
+    blocks. The series is regular if every sampled interval is within `jitter_tolerance` (relative) of the median and
+    the total duration matches the number of samples to within half a sampling interval. The sampling rate of a
+    regular series is computed from its total duration.
+
+    Irregularities between the sampled blocks (e.g. a short glitch) are not detected, so a series must also pass
+    check_regular_timestamps before its timestamps are replaced by its starting time and sampling rate.
+
+    Parameters
+    ----------
+    timestamps : h5py.Dataset or array-like, optional
+        The timestamps of the series. Required if `rate` is None.
+    rate : float, optional
+        The sampling rate of the series, if it has one.
+    num_blocks : int, default: 100
+        The number of blocks of timestamps to sample.
+    block_size : int, default: 1_000
+        The number of consecutive timestamps in each block.
+    jitter_tolerance : float, default: 1e-3
+        The maximum relative deviation of a sampling interval from the median for the series to be regular.
+
+    Returns
+    -------
+    sampling_rate : float
+        The sampling rate in Hz.
+    is_regular : bool
+        Whether the sampled timestamps of the series are regularly spaced (always True for a series with a rate).
+    """
+    if rate is not None:
+        return float(rate), True
+    if timestamps is None:
+        raise ValueError("Either timestamps or rate must be provided.")
+
+    num_samples = len(timestamps)
+    if num_samples < 2:
+        raise ValueError("At least two timestamps are needed to estimate a sampling rate.")
+    if num_samples <= num_blocks * block_size:
+        blocks = [np.asarray(timestamps[:], dtype="float64")]
+    else:
+        block_starts = np.linspace(0, num_samples - block_size, num_blocks).astype("int64")
+        blocks = [np.asarray(timestamps[start : start + block_size], dtype="float64") for start in block_starts]
+    intervals = np.concatenate([np.diff(block) for block in blocks])
+    median_interval = float(np.median(intervals))
+    if median_interval <= 0:
+        raise ValueError("Timestamps must be increasing to estimate a sampling rate.")
+
+    first_timestamp, last_timestamp = float(timestamps[0]), float(timestamps[num_samples - 1])
+    duration = last_timestamp - first_timestamp
+    max_jitter = float(np.max(np.abs(intervals - median_interval))) / median_interval
+    is_regular = (
+        max_jitter <= jitter_tolerance and abs(duration - (num_samples - 1) * median_interval) <= 0.5 * median_interval
+    )
+    if is_regular:
+        return (num_samples - 1) / duration, True
+    return 1.0 / median_interval, False
+
+
+def check_regular_timestamps(
+    timestamps, sampling_rate: float, jitter_tolerance: float = 1e-3, chunk_size: int = 1_000_000
+) -> bool:
+    """
+    Check that every timestamp of a series is within `jitter_tolerance` sampling intervals of its first timestamp plus
+    its index divided by `sampling_rate`, i.e. that the series loses nothing when stored with a starting time and rate.
+
+    The timestamps are read in chunks of `chunk_size`, so memory use does not depend on the length of the series.
+    """
+    num_samples = len(timestamps)
+    interval = 1.0 / sampling_rate
+    first_timestamp = float(timestamps[0])
+    for start in range(0, num_samples, chunk_size):
+        chunk = np.asarray(timestamps[start : start + chunk_size], dtype="float64")
+        expected = first_timestamp + np.arange(start, start + len(chunk)) * interval
+        if np.max(np.abs(chunk - expected)) > jitter_tolerance * interval:
+            return False
+    return True
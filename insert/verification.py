@@ -0,0 +1,198 @@
+"""Verification of data inserted into spyglass against the source NWB file."""
+
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def assert_datasets_equal(
+    actual, expected, block_mb: float = 64.0, num_threads: int = None, use_checksums: bool = False
+):
+    """
+    Assert that two datasets are equal over their full length, comparing aligned blocks of rows in a thread pool.
+
+    Blocks of about `block_mb` MB are read from both datasets and compared by worker threads, with at most two blocks
+    per thread in flight, so memory stays bounded and the comparison of one block overlaps the reads of the next.
+    Blocks are aligned to the chunk boundaries of `expected` when it is chunked. The first mismatching block is
+    reported and the throughput of the verification is printed.
+
+    Parameters
+    ----------
+    actual : h5py.Dataset or array-like
+        The dataset to verify.
+    expected : h5py.Dataset or array-like
+        The reference dataset.
+    block_mb : float, default: 64.0
+        The approximate size of each compared block in MB.
+    num_threads : int, optional
+        The number of worker threads. Defaults to the number of CPUs.
+    use_checksums : bool, default: False
+        Whether to compare blake2b checksums of the blocks rather than their values. Values of different byte order
+        are converted to the native byte order before hashing.
+
+    Raises
+    ------
+    AssertionError
+        If the shapes differ or a block does not match.
+    """
+    if tuple(actual.shape) != tuple(expected.shape):
+        raise AssertionError(f"Shape mismatch: {tuple(actual.shape)} != {tuple(expected.shape)}")
+    num_rows = actual.shape[0]
+    row_bytes = int(np.prod(expected.shape[1:], dtype="int64")) * np.dtype(expected.dtype).itemsize
+    block_rows = max(1, int(block_mb * 1e6) // max(row_bytes, 1))
+    chunks = getattr(expected, "chunks", None)
+    if chunks:
+        block_rows = max(chunks[0], block_rows // chunks[0] * chunks[0])
+
+    def compare_block(start):
+        stop = min(start + block_rows, num_rows)
+        actual_block = np.asarray(actual[start:stop])
+        expected_block = np.asarray(expected[start:stop])
+        if use_checksums:
+            return _checksum(actual_block) == _checksum(expected_block)
+        equal_nan = np.issubdtype(expected_block.dtype, np.inexact)
+        return np.array_equal(actual_block, expected_block, equal_nan=equal_nan)
+
+    def report_mismatch(start):
+        stop = min(start + block_rows, num_rows)
+        actual_block, expected_block = np.asarray(actual[start:stop]), np.asarray(expected[start:stop])
+        mismatches = np.argwhere(actual_block != expected_block)
+        message = f"Mismatch in rows [{start}, {stop}) ({len(mismatches)} differing elements)"
+        if len(mismatches):
+            first = tuple(int(index) for index in mismatches[0])
+            message += (
+                f"; first mismatch at index {(start + first[0], *first[1:])}: "
+                f"{actual_block[first]!r} != {expected_block[first]!r}"
+            )
+        raise AssertionError(message)
+
+    num_threads = num_threads or os.cpu_count()
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        in_flight = deque()
+        for start in range(0, num_rows, block_rows):
+            in_flight.append((start, executor.submit(compare_block, start)))
+            while len(in_flight) >= 2 * num_threads or (start + block_rows >= num_rows and in_flight):
+                block_start, future = in_flight.popleft()
+                if not future.result():
+                    for _, pending_future in in_flight:
+                        pending_future.cancel()
+                    report_mismatch(block_start)
+    verify_time = time.perf_counter() - start_time
+    num_bytes = num_rows * row_bytes
+    print(
+        f"Verified {num_bytes / 1e6:.1f} MB in {verify_time:.1f} s "
+        f"({num_bytes / 1e6 / max(verify_time, 1e-9):.1f} MB/s)"
+    )
+
+
+def _checksum(block: np.ndarray) -> bytes:
+    native_block = np.ascontiguousarray(block, dtype=block.dtype.newbyteorder("="))
+    return hashlib.blake2b(memoryview(native_block).cast("B")).digest()
+
+
+def assert_spike_trains_equal(
+    actual_spike_times,
+    actual_index,
+    actual_unit_ids,
+    expected_spike_times,
+    expected_index,
+    expected_unit_ids,
+    max_reported_units: int = 20,
+):
+    """
+    Assert that two sets of spike trains, each stored as a flat array of spike times plus end offsets, are equal.
+
+    This is the layout of the ragged spike_times column of an NWB units table (spike_times + spike_times_index), so
+    neither side needs to be split into per-unit arrays. Units are matched by unit id rather than by position, and
+    all comparisons are vectorized over the flat arrays.
+
+    Parameters
+    ----------
+    actual_spike_times, expected_spike_times : array-like
+        The spike times of all units, concatenated in unit order.
+    actual_index, expected_index : array-like
+        The end offset of each unit in the flat spike times (i.e. the data of a VectorIndex).
+    actual_unit_ids, expected_unit_ids : array-like
+        The id of each unit.
+    max_reported_units : int, default: 20
+        The maximum number of unit ids listed per kind of mismatch.
+
+    Raises
+    ------
+    AssertionError
+        If units are missing or unexpected, or the spike times of any unit differ.
+    """
+    actual_unit_ids, actual_counts, actual_spike_times = _sort_units(actual_spike_times, actual_index, actual_unit_ids)
+    expected_unit_ids, expected_counts, expected_spike_times = _sort_units(
+        expected_spike_times, expected_index, expected_unit_ids
+    )
+    missing_unit_ids = np.setdiff1d(expected_unit_ids, actual_unit_ids)
+    unexpected_unit_ids = np.setdiff1d(actual_unit_ids, expected_unit_ids)
+    common_unit_ids = np.intersect1d(actual_unit_ids, expected_unit_ids)
+    _, actual_counts, actual_spike_times = _select_units(
+        actual_unit_ids, actual_counts, actual_spike_times, common_unit_ids
+    )
+    _, expected_counts, expected_spike_times = _select_units(
+        expected_unit_ids, expected_counts, expected_spike_times, common_unit_ids
+    )
+
+    same_count = actual_counts == expected_counts
+    mismatched_unit_ids = set(common_unit_ids[~same_count].tolist())
+    differs = actual_spike_times[np.repeat(same_count, actual_counts)] != (
+        expected_spike_times[np.repeat(same_count, expected_counts)]
+    )
+    if differs.any():
+        element_unit_ids = np.repeat(common_unit_ids[same_count], actual_counts[same_count])
+        mismatched_unit_ids.update(np.unique(element_unit_ids[differs]).tolist())
+
+    errors = []
+    for description, unit_ids in (
+        ("missing", missing_unit_ids.tolist()),
+        ("unexpected", unexpected_unit_ids.tolist()),
+        ("with mismatching spike times", sorted(mismatched_unit_ids)),
+    ):
+        if unit_ids:
+            listed = ", ".join(str(unit_id) for unit_id in unit_ids[:max_reported_units])
+            more = f", ... ({len(unit_ids)} total)" if len(unit_ids) > max_reported_units else ""
+            errors.append(f"units {description}: {listed}{more}")
+    if errors:
+        raise AssertionError("Spike trains differ; " + "; ".join(errors))
+
+
+def concatenate_spike_trains(spike_trains: list):
+    """Concatenate a list of per-unit spike time arrays into a flat array of spike times and their end offsets."""
+    index = np.cumsum([len(spike_train) for spike_train in spike_trains], dtype="int64")
+    if not len(spike_trains):
+        return np.zeros(0, dtype="float64"), index
+    return np.concatenate(spike_trains), index
+
+
+def _sort_units(spike_times, index, unit_ids):
+    # reorder the units (and their spike times) by unit id, without copying if they already are in order
+    spike_times, unit_ids = np.asarray(spike_times), np.asarray(unit_ids)
+    ends = np.asarray(index, dtype="int64")
+    starts = np.concatenate([[0], ends[:-1]]).astype("int64")
+    counts = ends - starts
+    if len(unit_ids) != len(counts):
+        raise AssertionError(f"{len(unit_ids)} unit ids for {len(counts)} spike trains")
+    if len(np.unique(unit_ids)) != len(unit_ids):
+        raise AssertionError("Unit ids are not unique")
+    order = np.argsort(unit_ids, kind="stable")
+    if np.array_equal(order, np.arange(len(order))):
+        return unit_ids, counts, spike_times[: ends[-1] if len(ends) else 0]
+    sorted_counts = counts[order]
+    sorted_starts = np.cumsum(sorted_counts) - sorted_counts
+    gather = np.repeat(starts[order] - sorted_starts, sorted_counts) + np.arange(sorted_counts.sum())
+    return unit_ids[order], sorted_counts, spike_times[gather]
+
+
+def _select_units(unit_ids, counts, spike_times, selected_unit_ids):
+    mask = np.isin(unit_ids, selected_unit_ids)
+    if mask.all():
+        return unit_ids, counts, spike_times
+    return unit_ids[mask], counts[mask], spike_times[np.repeat(mask, counts)]
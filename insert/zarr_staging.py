@@ -0,0 +1,126 @@
+"""
+Parallel compression of a dataset into a chunked HDF5 dataset through a Zarr staging store.
+
+An HDF5 file is written through a single handle, and h5py serializes every call into the HDF5 library, so even the
+threads of copy_dataset_pipelined share one reader. copy_dataset_zarr instead splits the copy in two:
+
+- a pool of worker processes, each with its own handle on the source file, reads bands of rows of the source and
+  writes them to a Zarr array on local disk, which compresses each chunk in the worker and stores it as a separate
+  file, so reads, decompression of the source and compression all scale with the number of processes,
+- the calling process then moves the compressed chunks into the target HDF5 dataset with H5Dwrite_chunk. The Zarr
+  chunks use the same codecs as the HDF5 filters of the target (numcodecs Shuffle and Zlib produce the bytes of the
+  HDF5 shuffle and deflate filters, and edge chunks are stored padded in both formats), so they are written as is,
+  without being decoded.
+
+The analysis file stays a single HDF5 file, so the spyglass AnalysisNwbfile bookkeeping (checksums, fetch_nwb, ...)
+is unchanged. The staging store is deleted after the copy.
+"""
+
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+import numcodecs
+import zarr
+
+from data_iterators import ChannelSelection
+from memmap_reader import memmap_dataset
+from pipelined_copy import get_filters
+
+# the staging store uses the zarr 2 API (dimension_separator, array.store, cdata_shape), removed in zarr 3
+if int(zarr.__version__.split(".")[0]) != 2:
+    raise ImportError(f"Zarr staged copies require zarr 2 (pip install 'zarr<3'), found zarr {zarr.__version__}.")
+
+# the source of the worker process, opened once per process by _init_worker
+_worker_source = {}
+
+
+def copy_dataset_zarr(
+    source: h5py.Dataset, target: h5py.Dataset, staging_path: Path, channels=None, num_workers: int = None
+) -> float:
+    """
+    Copy an HDF5 dataset (or some of its channels) into the empty, chunked HDF5 dataset `target` in parallel.
+
+    Parameters
+    ----------
+    source : h5py.Dataset
+        The dataset to copy. Its file is opened again by each worker process.
+    target : h5py.Dataset
+        The chunked dataset to write, with no filters or with the shuffle and/or deflate (gzip) filters.
+    staging_path : Path
+        The path of the Zarr staging store, on a local disk with room for the compressed data. Deleted after the copy.
+    channels : array-like of int, optional
+        The channels (columns) of a 2D source to copy, as for ChannelSelection. Defaults to every channel.
+    num_workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    float
+        The duration of the copy in seconds.
+    """
+    shape = (source.shape[0], len(channels)) if channels is not None else tuple(source.shape)
+    if shape != tuple(target.shape):
+        raise ValueError(f"Shape mismatch: {shape} != {tuple(target.shape)}")
+    if target.chunks is None:
+        raise ValueError(f"{target.name} is not chunked.")
+    shuffle, level = get_filters(target)
+    start_time = time.perf_counter()
+    staging_path = Path(staging_path)
+    array = zarr.open_array(
+        str(staging_path),
+        mode="w",
+        shape=target.shape,
+        chunks=target.chunks,
+        dtype=target.dtype,
+        fill_value=0,
+        order="C",
+        filters=[numcodecs.Shuffle(elementsize=target.dtype.itemsize)] if shuffle else None,
+        compressor=None if level is None else numcodecs.Zlib(level=level),
+        dimension_separator=".",
+        write_empty_chunks=True,
+    )
+    try:
+        num_rows, band_rows = target.shape[0], target.chunks[0]
+        source_spec = (source.file.filename, source.name, None if channels is None else list(channels))
+        # spawn rather than fork: the HDF5 library state of the parent, with its open files, is not fork-safe
+        with ProcessPoolExecutor(
+            max_workers=num_workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(*source_spec, str(staging_path), band_rows),
+        ) as executor:
+            # consume the results so that an error in a worker is raised here
+            list(executor.map(_write_band, range(0, num_rows, band_rows)))
+        copy_zarr_chunks(array, target)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+    return time.perf_counter() - start_time
+
+
+def copy_zarr_chunks(array: zarr.Array, target: h5py.Dataset):
+    """Write the stored chunks of a Zarr array as is into an HDF5 dataset with the same chunks and filters."""
+    for chunk_index in np.ndindex(*array.cdata_shape):
+        data = array.store.get(".".join(str(index) for index in chunk_index))
+        if data is None:
+            continue  # never written: the fill value, as in HDF5
+        chunk_offset = tuple(index * chunk for index, chunk in zip(chunk_index, array.chunks))
+        target.id.write_direct_chunk(chunk_offset, bytes(data))
+
+
+def _init_worker(source_path: str, dataset_name: str, channels: list, staging_path: str, band_rows: int):
+    dataset = memmap_dataset(h5py.File(source_path, "r")[dataset_name])
+    _worker_source["data"] = dataset if channels is None else ChannelSelection(dataset, channels)
+    _worker_source["array"] = zarr.open_array(staging_path, mode="r+")
+    _worker_source["band_rows"] = band_rows
+
+
+def _write_band(start: int):
+    # bands are one chunk high, so no two workers write the same chunk
+    stop = start + _worker_source["band_rows"]
+    _worker_source["array"][start:stop] = _worker_source["data"][start:stop]
@@ -10,32 +10,48 @@ import numpy as np
 from pathlib import Path
 from ndx_franklab_novela import CameraDevice
 from pynwb.image import ImageSeries
-from pynwb.core import DynamicTable
+from pynwb.epoch import TimeIntervals
 from pynwb.behavior import BehavioralEvents
 
-from jadhav_lab_to_nwb.olson_2024.tools.spikegadgets import readCameraModuleTimeStamps
+from synthetic_nwbfile import TASK_COLUMN_DESCRIPTIONS, build_table
+from video_timestamps import read_video_timestamps
 
 
 def add_epoch(nwbfile):
     tasks_module = nwbfile.create_processing_module(name="tasks", description="tasks module")
     num_tasks = 2
     for i in range(1, num_tasks + 1):
-        task_table = DynamicTable(name=f"task_table_{i}", description="my task table")
-        task_table.add_column(name="task_name", description="Name of the task.")
-        task_table.add_column(name="task_description", description="Description of the task.")
-        task_table.add_column(name="camera_id", description="Camera ID.")
-        task_table.add_column(name="task_epochs", description="Task epochs.")
-        task_table.add_row(
-            task_name=f"task{i}", task_description=f"task{i} description", camera_id=[1], task_epochs=[i]
+        task_table = build_table(
+            name=f"task_table_{i}",
+            description="my task table",
+            columns=dict(
+                task_name=[f"task{i}"], task_description=[f"task{i} description"], camera_id=[[1]], task_epochs=[[i]]
+            ),
+            descriptions=TASK_COLUMN_DESCRIPTIONS,
         )
         tasks_module.add(task_table)
 
-    nwbfile.add_epoch_column(name="custom_data_string", description="Custom epoch column")
-    nwbfile.add_epoch(start_time=0.0, stop_time=1.0, tags=["01"], custom_data_string="custom_value1")
-    nwbfile.add_epoch(start_time=268.0, stop_time=2110.0, tags=["02"], custom_data_string="custom_value2")
+    nwbfile.epochs = build_table(
+        name="epochs",
+        description="experimental epochs",
+        columns=dict(
+            start_time=[0.0, 268.0],
+            stop_time=[1.0, 2110.0],
+            tags=(["01", "02"], [1, 2]),
+            custom_data_string=["custom_value1", "custom_value2"],
+        ),
+        descriptions=dict(custom_data_string="Custom epoch column"),
+        table_class=TimeIntervals,
+    )
+
 
+def add_video(nwbfile, frame_rate: float = None):
+    """
+    Add an external video with its camera and frame timestamps.
 
-def add_video(nwbfile):
+    With `frame_rate`, the video of a camera with a constant frame rate is stored with its starting time and that rate
+    instead of a timestamp per frame. Every frame timestamp must then be within a thousandth of a frame of it.
+    """
     camera_device = CameraDevice(
         name="camera_device 1",
         meters_per_pixel=1.0,
@@ -47,15 +63,21 @@ def add_video(nwbfile):
 
     video_file_path = "/Volumes/T7/CatalystNeuro/Jadhav/SubLearnProject/SL18_D19/SL18_D19_S01_F01_BOX_SLP_20230503_112642/SL18_D19_S01_F01_BOX_SLP_20230503_112642.1.h264"
     video_timestamps_file_path = "/Volumes/T7/CatalystNeuro/Jadhav/SubLearnProject/SL18_D19/SL18_D19_S01_F01_BOX_SLP_20230503_112642/SL18_D19_S01_F01_BOX_SLP_20230503_112642.1.videoTimeStamps"
-    timestamps, _ = readCameraModuleTimeStamps(video_timestamps_file_path)
+    timestamps, _ = read_video_timestamps(video_timestamps_file_path)
+    timing = dict(timestamps=timestamps)
+    if frame_rate is not None:
+        expected = timestamps[0] + np.arange(len(timestamps)) / frame_rate
+        if not np.allclose(timestamps, expected, rtol=0.0, atol=1e-3 / frame_rate):
+            raise ValueError(f"The frames of {video_timestamps_file_path} are not at a constant {frame_rate} Hz.")
+        timing = dict(starting_time=float(timestamps[0]), rate=frame_rate)
     image_series = ImageSeries(
         name="my_image_series",
         description="my_description",
         unit="n.a.",
         external_file=[video_file_path],
         format="external",
-        timestamps=timestamps,
         device=camera_device,
+        **timing,
     )
 
     behavior_module = nwbfile.create_processing_module(name="behavior", description="behavior module")
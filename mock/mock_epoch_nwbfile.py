@@ -2,10 +2,12 @@
 
 from pynwb.testing.mock.file import mock_NWBFile
 from pynwb import NWBHDF5IO
-from pynwb.core import DynamicTable
+from pynwb.epoch import TimeIntervals
 from pathlib import Path
 from ndx_franklab_novela import CameraDevice
 
+from synthetic_nwbfile import TASK_COLUMN_DESCRIPTIONS, build_table
+
 
 def main():
     nwbfile = mock_NWBFile(identifier="my_identifier", session_description="my_session_description")
@@ -23,19 +25,28 @@ def main():
     tasks_module = nwbfile.create_processing_module(name="tasks", description="tasks module")
     num_tasks = 2
     for i in range(1, num_tasks + 1):
-        task_table = DynamicTable(name=f"task_table_{i}", description="my task table")
-        task_table.add_column(name="task_name", description="Name of the task.")
-        task_table.add_column(name="task_description", description="Description of the task.")
-        task_table.add_column(name="camera_id", description="Camera ID.")
-        task_table.add_column(name="task_epochs", description="Task epochs.")
-        task_table.add_row(
-            task_name=f"task{i}", task_description=f"task{i} description", camera_id=[1], task_epochs=[i]
+        task_table = build_table(
+            name=f"task_table_{i}",
+            description="my task table",
+            columns=dict(
+                task_name=[f"task{i}"], task_description=[f"task{i} description"], camera_id=[[1]], task_epochs=[[i]]
+            ),
+            descriptions=TASK_COLUMN_DESCRIPTIONS,
         )
         tasks_module.add(task_table)
 
-    nwbfile.add_epoch_column(name="custom_data_string", description="Custom epoch column")
-    nwbfile.add_epoch(start_time=0.0, stop_time=1.0, tags=["01"], custom_data_string="custom_value1")
-    nwbfile.add_epoch(start_time=1.0, stop_time=2.0, tags=["02"], custom_data_string="custom_value2")
+    nwbfile.epochs = build_table(
+        name="epochs",
+        description="experimental epochs",
+        columns=dict(
+            start_time=[0.0, 1.0],
+            stop_time=[1.0, 2.0],
+            tags=(["01", "02"], [1, 2]),
+            custom_data_string=["custom_value1", "custom_value2"],
+        ),
+        descriptions=dict(custom_data_string="Custom epoch column"),
+        table_class=TimeIntervals,
+    )
 
     nwbfile_path = Path("/Volumes/T7/CatalystNeuro/Spyglass/raw/mock_epochs.nwb")
     if nwbfile_path.exists():
@@ -0,0 +1,490 @@
+"""
+Generate spyglass-compatible NWB files of arbitrary size for load testing.
+
+The probe/electrode boilerplate shared by the mock scripts lives here (add_probe), along with functions that add raw
+ephys, LFP, units and epochs at a configurable scale. Large arrays are written with chunk iterators that generate the
+data buffer by buffer, so the memory needed to write a file does not depend on its size. The generated data is
+deterministic for a given seed.
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.common import VectorData, VectorIndex
+from hdmf.data_utils import GenericDataChunkIterator
+from ndx_franklab_novela import DataAcqDevice, Probe, Shank, ShanksElectrode, NwbElectrodeGroup
+from pynwb import NWBHDF5IO
+from pynwb.core import DynamicTable
+from pynwb.ecephys import ElectricalSeries, LFP
+from pynwb.epoch import TimeIntervals
+from pynwb.misc import Units
+from pynwb.testing.mock.file import mock_NWBFile
+
+# the columns of the task tables read by spyglass (TaskEpoch)
+TASK_COLUMN_DESCRIPTIONS = dict(
+    task_name="Name of the task.",
+    task_description="Description of the task.",
+    camera_id="Camera ID.",
+    task_epochs="Task epochs.",
+)
+
+
+class SyntheticDataChunkIterator(GenericDataChunkIterator):
+    """Generate Gaussian noise of a given shape and dtype buffer by buffer; each buffer is seeded by its position."""
+
+    def __init__(self, shape: tuple, dtype="int16", scale: float = 100.0, seed: int = 0, **kwargs):
+        self.shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self.scale = scale
+        self.seed = seed
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        rng = np.random.default_rng([self.seed, *(axis_selection.start or 0 for axis_selection in selection)])
+        shape = tuple(
+            len(range(*axis_selection.indices(length))) for axis_selection, length in zip(selection, self.shape)
+        )
+        return (self.scale * rng.standard_normal(shape, dtype="float32")).astype(self._dtype)
+
+    def _get_maxshape(self):
+        return self.shape
+
+    def _get_dtype(self):
+        return self._dtype
+
+
+class RegularTimestampsIterator(GenericDataChunkIterator):
+    """Generate the timestamps of a regularly sampled series buffer by buffer."""
+
+    def __init__(self, num_samples: int, sampling_rate: float, starting_time: float = 0.0, **kwargs):
+        self.num_samples = num_samples
+        self.sampling_rate = sampling_rate
+        self.starting_time = starting_time
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        start, stop, _ = selection[0].indices(self.num_samples)
+        return self.starting_time + np.arange(start, stop, dtype="float64") / self.sampling_rate
+
+    def _get_maxshape(self):
+        return (self.num_samples,)
+
+    def _get_dtype(self):
+        return np.dtype("float64")
+
+
+class SpikeTimesIterator(GenericDataChunkIterator):
+    """
+    Generate the flat spike_times column of a units table buffer by buffer.
+
+    Every unit has `spikes_per_unit` spikes: spike k of a unit falls at a random time in the k-th of `spikes_per_unit`
+    equal bins of [starting_time, starting_time + duration), so each spike train is sorted.
+    """
+
+    def __init__(
+        self, num_units: int, spikes_per_unit: int, duration: float, starting_time: float = 0.0, seed: int = 0, **kwargs
+    ):
+        self.num_units = num_units
+        self.spikes_per_unit = spikes_per_unit
+        self.duration = duration
+        self.starting_time = starting_time
+        self.seed = seed
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        start, stop, _ = selection[0].indices(self.num_units * self.spikes_per_unit)
+        rng = np.random.default_rng([self.seed, start])
+        spike_index = np.arange(start, stop) % self.spikes_per_unit
+        bin_width = self.duration / self.spikes_per_unit
+        return self.starting_time + (spike_index + rng.random(stop - start)) * bin_width
+
+    def _get_maxshape(self):
+        return (self.num_units * self.spikes_per_unit,)
+
+    def _get_dtype(self):
+        return np.dtype("float64")
+
+
+def add_probe(nwbfile, num_shanks: int = 1, channels_per_shank: int = 1):
+    """
+    Add a data acquisition device, a probe and its electrodes to an NWB file, as spyglass expects them.
+
+    Each shank gets its own electrode group. Electrodes are numbered from 1 across the probe.
+
+    Parameters
+    ----------
+    nwbfile : pynwb.NWBFile
+        The NWB file to add the probe to.
+    num_shanks : int, default: 1
+        The number of shanks of the probe.
+    channels_per_shank : int, default: 1
+        The number of electrodes on each shank.
+    """
+    data_acq_device = DataAcqDevice(
+        name="my_data_acq", system="my_system", amplifier="my_amplifier", adc_circuit="my_adc_circuit"
+    )
+    nwbfile.add_device(data_acq_device)
+
+    shanks = []
+    for shank_index in range(num_shanks):
+        shanks_electrodes = [
+            ShanksElectrode(
+                name=str(shank_index * channels_per_shank + channel + 1), rel_x=0.0, rel_y=20.0 * channel, rel_z=0.0
+            )
+            for channel in range(channels_per_shank)
+        ]
+        shanks.append(Shank(name=str(shank_index + 1), shanks_electrodes=shanks_electrodes))
+    probe = Probe(
+        name="my_probe",
+        id=0,
+        probe_type="my_probe_type",
+        units="my_units",
+        probe_description="my_probe_description",
+        contact_side_numbering=False,
+        contact_size=1.0,
+        shanks=shanks,
+    )
+    nwbfile.add_device(probe)
+
+    extra_cols = [
+        "probe_shank",
+        "probe_electrode",
+        "bad_channel",
+        "ref_elect_id",
+    ]
+    for col in extra_cols:
+        nwbfile.add_electrode_column(name=col, description=f"description for {col}")
+    for shank_index, shank in enumerate(shanks):
+        electrode_group = NwbElectrodeGroup(
+            name="my_electrode_group" if num_shanks == 1 else f"my_electrode_group_{shank_index + 1}",
+            description="my_description",
+            location="my_location",
+            device=probe,
+            targeted_location="my_targeted_location",
+            targeted_x=0.0,
+            targeted_y=0.0,
+            targeted_z=0.0,
+            units="mm",
+        )
+        nwbfile.add_electrode_group(electrode_group)
+        for electrode_name in shank.shanks_electrodes:
+            nwbfile.add_electrode(
+                location="my_location",
+                group=electrode_group,
+                probe_shank=int(shank.name),
+                probe_electrode=int(electrode_name),
+                bad_channel=False,
+                ref_elect_id=0,
+                x=0.0,
+                y=0.0,
+                z=0.0,
+            )
+
+
+def create_electrical_series(
+    nwbfile,
+    name: str,
+    num_samples: int,
+    sampling_rate: float,
+    seed: int = 0,
+    buffer_gb: float = None,
+    compression: str = None,
+):
+    """
+    Create an ElectricalSeries of synthetic data over all electrodes of an NWB file, with explicit timestamps.
+
+    Parameters
+    ----------
+    nwbfile : pynwb.NWBFile
+        The NWB file whose electrodes the series is recorded from (see add_probe).
+    name : str
+        The name of the series.
+    num_samples : int
+        The number of samples per channel.
+    sampling_rate : float
+        The sampling rate in Hz.
+    seed : int, default: 0
+        The seed of the generated data.
+    buffer_gb : float, optional
+        The size of the buffers used to write the data. Defaults to the hdmf default (1 GB).
+    compression : str, optional
+        The HDF5 compression filter of the data.
+
+    Returns
+    -------
+    ElectricalSeries
+        The series, not yet added to the file.
+    """
+    num_channels = len(nwbfile.electrodes)
+    electrodes = nwbfile.electrodes.create_region(
+        name="electrodes", region=list(range(num_channels)), description="electrodes"
+    )
+    data = SyntheticDataChunkIterator(shape=(num_samples, num_channels), seed=seed, buffer_gb=buffer_gb)
+    timestamps = RegularTimestampsIterator(num_samples=num_samples, sampling_rate=sampling_rate, buffer_gb=buffer_gb)
+    return ElectricalSeries(
+        name=name,
+        description=f"synthetic {name}",
+        data=H5DataIO(data, compression=compression),
+        timestamps=H5DataIO(timestamps, compression=compression),
+        electrodes=electrodes,
+    )
+
+
+def add_units(nwbfile, num_units: int, spikes_per_unit: int, duration: float, seed: int = 0, buffer_gb: float = None):
+    """
+    Add a units table with `num_units` units of `spikes_per_unit` spikes each, plus a label and a quantification.
+
+    The spike_times column is built as a whole (flat data plus index) rather than unit by unit, and its data is
+    generated buffer by buffer while writing.
+    """
+    spike_times = VectorData(
+        name="spike_times",
+        description="the spike times for each unit in seconds",
+        data=H5DataIO(
+            SpikeTimesIterator(
+                num_units=num_units, spikes_per_unit=spikes_per_unit, duration=duration, seed=seed, buffer_gb=buffer_gb
+            )
+        ),
+    )
+    spike_times_index = VectorIndex(
+        name="spike_times_index",
+        data=np.arange(1, num_units + 1, dtype="int64") * spikes_per_unit,
+        target=spike_times,
+    )
+    rng = np.random.default_rng(seed)
+    custom_label = VectorData(
+        name="custom_label",
+        description="description for custom_label",
+        data=["even unit" if unit % 2 == 0 else "odd unit" for unit in range(num_units)],
+    )
+    custom_quantification = VectorData(
+        name="custom_quantification",
+        description="description for custom_quantification",
+        data=rng.random(num_units),
+    )
+    nwbfile.units = Units(
+        name="units",
+        description="synthetic units",
+        id=np.arange(num_units),
+        # the index must come before its target: hdmf drops columns backed by an iterator from its checks
+        columns=[spike_times_index, spike_times, custom_label, custom_quantification],
+        colnames=["spike_times", "custom_label", "custom_quantification"],
+    )
+
+
+def flatten_ragged(values: list) -> tuple:
+    """Return the flat data and the index (the end offset of each row) of a ragged column given as a list of lists."""
+    lengths = np.fromiter((len(value) for value in values), dtype="int64", count=len(values))
+    data = [item for value in values for item in value]
+    return data, np.cumsum(lengths)
+
+
+def build_table(
+    name: str, description: str, columns: dict, descriptions: dict = None, table_class=DynamicTable, id=None
+):
+    """
+    Build a DynamicTable (or a subclass, e.g. TimeIntervals) from whole columns instead of row by row.
+
+    Parameters
+    ----------
+    name : str
+        The name of the table.
+    description : str
+        The description of the table.
+    columns : dict
+        The values of each column by name, in order: an array-like with one value (or one fixed-size array) per row,
+        or for a ragged column a tuple of its flat data and its index, the end offset of each row in the flat data
+        (see flatten_ragged).
+    descriptions : dict, optional
+        The description of each column. Defaults to the description of the predefined columns of `table_class`, or
+        the name of the column.
+    table_class : type, default: DynamicTable
+        The class of the table.
+    id : array-like, optional
+        The ids of the rows. Defaults to 0, 1, ...
+    """
+    descriptions = {
+        **{column["name"]: column["description"] for column in getattr(table_class, "__columns__", ())},
+        **(descriptions or {}),
+    }
+    vector_columns = []
+    num_rows = None
+    for column_name, values in columns.items():
+        column_description = descriptions.get(column_name, column_name)
+        if isinstance(values, tuple):
+            data, index = values
+            column = VectorData(name=column_name, description=column_description, data=data)
+            vector_columns += [VectorIndex(name=f"{column_name}_index", data=np.asarray(index), target=column), column]
+            num_rows = len(index)
+        else:
+            vector_columns.append(VectorData(name=column_name, description=column_description, data=values))
+            num_rows = len(values)
+    return table_class(
+        name=name,
+        description=description,
+        id=np.arange(num_rows or 0) if id is None else id,
+        columns=vector_columns,
+        colnames=list(columns),
+    )
+
+
+def add_epochs(nwbfile, num_epochs: int, duration: float):
+    """Add `num_epochs` consecutive epochs covering `duration` seconds, each with its own task table."""
+    tasks_module = nwbfile.create_processing_module(name="tasks", description="tasks module")
+    epochs = np.arange(1, num_epochs + 1)
+    for epoch in epochs:
+        task_table = build_table(
+            name=f"task_table_{epoch}",
+            description="my task table",
+            columns=dict(
+                task_name=[f"task{epoch}"],
+                task_description=[f"task{epoch} description"],
+                camera_id=[[1]],
+                task_epochs=[[epoch]],
+            ),
+            descriptions=TASK_COLUMN_DESCRIPTIONS,
+        )
+        tasks_module.add(task_table)
+    epoch_duration = duration / num_epochs
+    nwbfile.epochs = build_table(
+        name="epochs",
+        description="experimental epochs",
+        columns=dict(
+            start_time=(epochs - 1) * epoch_duration,
+            stop_time=epochs * epoch_duration,
+            tags=([f"{epoch:02d}" for epoch in epochs], epochs),
+            custom_data_string=[f"custom_value{epoch}" for epoch in epochs],
+        ),
+        descriptions=dict(custom_data_string="Custom epoch column"),
+        table_class=TimeIntervals,
+    )
+
+
+def generate_nwbfile(
+    nwbfile_path: Path,
+    num_shanks: int = 1,
+    channels_per_shank: int = 4,
+    duration: float = 60.0,
+    sampling_rate: float = 30_000.0,
+    lfp_sampling_rate: float = 1_000.0,
+    raw: bool = True,
+    lfp: bool = True,
+    num_units: int = 0,
+    spikes_per_unit: int = 100,
+    num_epochs: int = 0,
+    seed: int = 0,
+    buffer_gb: float = None,
+    compression: str = None,
+):
+    """
+    Write a spyglass-compatible NWB file of the given scale.
+
+    Parameters
+    ----------
+    nwbfile_path : Path
+        The path of the NWB file to write. An existing file is overwritten.
+    num_shanks : int, default: 1
+        The number of shanks of the probe.
+    channels_per_shank : int, default: 4
+        The number of electrodes on each shank.
+    duration : float, default: 60.0
+        The duration of the recording in seconds.
+    sampling_rate : float, default: 30_000.0
+        The sampling rate of the raw ephys data in Hz.
+    lfp_sampling_rate : float, default: 1_000.0
+        The sampling rate of the LFP data in Hz.
+    raw : bool, default: True
+        Whether to add a raw ElectricalSeries to the acquisition.
+    lfp : bool, default: True
+        Whether to add an "ElectricalSeriesLFP" series to processing/ecephys/LFP.
+    num_units : int, default: 0
+        The number of units of the units table. No units table is added if 0.
+    spikes_per_unit : int, default: 100
+        The number of spikes of each unit.
+    num_epochs : int, default: 0
+        The number of epochs (and task tables). No epochs are added if 0.
+    seed : int, default: 0
+        The seed of the generated data.
+    buffer_gb : float, optional
+        The size of the buffers used to generate and write large arrays. Defaults to the hdmf default (1 GB).
+    compression : str, optional
+        The HDF5 compression filter of the ephys data.
+    """
+    nwbfile_path = Path(nwbfile_path)
+    nwbfile = mock_NWBFile(identifier="my_identifier", session_description="my_session_description")
+    add_probe(nwbfile, num_shanks=num_shanks, channels_per_shank=channels_per_shank)
+    series_kwargs = dict(seed=seed, buffer_gb=buffer_gb, compression=compression)
+    if raw:
+        raw_eseries = create_electrical_series(
+            nwbfile,
+            name="ElectricalSeries",
+            num_samples=int(duration * sampling_rate),
+            sampling_rate=sampling_rate,
+            **series_kwargs,
+        )
+        nwbfile.add_acquisition(raw_eseries)
+    if lfp:
+        lfp_eseries = create_electrical_series(
+            nwbfile,
+            name="ElectricalSeriesLFP",
+            num_samples=int(duration * lfp_sampling_rate),
+            sampling_rate=lfp_sampling_rate,
+            **series_kwargs,
+        )
+        ecephys_module = nwbfile.create_processing_module(name="ecephys", description="ecephys module")
+        ecephys_module.add(LFP(electrical_series=lfp_eseries))
+    if num_units:
+        add_units(nwbfile, num_units=num_units, spikes_per_unit=spikes_per_unit, duration=duration, seed=seed)
+    if num_epochs:
+        add_epochs(nwbfile, num_epochs=num_epochs, duration=duration)
+
+    # add processing module to make spyglass happy
+    nwbfile.create_processing_module(name="behavior", description="dummy behavior module")
+
+    if nwbfile_path.exists():
+        nwbfile_path.unlink()
+    with NWBHDF5IO(nwbfile_path, "w") as io:
+        io.write(nwbfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a spyglass-compatible NWB file of arbitrary size.")
+    parser.add_argument("nwbfile_path", type=Path)
+    parser.add_argument("--num-shanks", type=int, default=1)
+    parser.add_argument("--channels-per-shank", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=60.0, help="Duration of the recording in seconds.")
+    parser.add_argument("--sampling-rate", type=float, default=30_000.0)
+    parser.add_argument("--lfp-sampling-rate", type=float, default=1_000.0)
+    parser.add_argument("--no-raw", action="store_true", help="Do not add raw ephys data.")
+    parser.add_argument("--no-lfp", action="store_true", help="Do not add LFP data.")
+    parser.add_argument("--num-units", type=int, default=0)
+    parser.add_argument("--spikes-per-unit", type=int, default=100)
+    parser.add_argument("--num-epochs", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--buffer-gb", type=float, default=None)
+    parser.add_argument("--compression", default=None)
+    args = parser.parse_args()
+
+    generate_nwbfile(
+        nwbfile_path=args.nwbfile_path,
+        num_shanks=args.num_shanks,
+        channels_per_shank=args.channels_per_shank,
+        duration=args.duration,
+        sampling_rate=args.sampling_rate,
+        lfp_sampling_rate=args.lfp_sampling_rate,
+        raw=not args.no_raw,
+        lfp=not args.no_lfp,
+        num_units=args.num_units,
+        spikes_per_unit=args.spikes_per_unit,
+        num_epochs=args.num_epochs,
+        seed=args.seed,
+        buffer_gb=args.buffer_gb,
+        compression=args.compression,
+    )
+    print(f"synthetic NWB file successfully written at {args.nwbfile_path}")
+
+
+if __name__ == "__main__":
+    main()
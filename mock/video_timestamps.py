@@ -0,0 +1,87 @@
+"""
+Read the frame timestamps of SpikeGadgets camera module .videoTimeStamps files.
+
+A .videoTimeStamps file is an optional text header, from "<Start settings>" to "<End settings>" with one
+"Key: value" setting per line (e.g. "Clock rate: 30000"), followed by the frame timestamps as little-endian uint32
+ticks of the Trodes clock. The payload is read with a single memmap and converted to seconds in one vectorized
+operation, and the result is cached per file path, size and modification time, so reading the timestamps of the same
+file again (e.g. when building several mock files from one session) costs a stat.
+"""
+
+import functools
+import os
+from pathlib import Path
+
+import numpy as np
+
+HEADER_START = b"<Start settings>"
+HEADER_END = b"<End settings>"
+DEFAULT_CLOCK_RATE = 30_000
+
+
+def read_header(file_path: Path, max_header_bytes: int = 65_536) -> tuple:
+    """
+    Read the settings header of a .videoTimeStamps file.
+
+    Returns
+    -------
+    settings : dict
+        The settings of the header by name, as strings. Empty if the file has no header.
+    payload_offset : int
+        The offset in bytes of the first timestamp.
+    """
+    with open(file_path, "rb") as file:
+        head = file.read(max_header_bytes)
+    if not head.startswith(HEADER_START):
+        return {}, 0
+    end = head.find(HEADER_END)
+    if end == -1:
+        raise ValueError(f"{file_path} has no '<End settings>' in its first {max_header_bytes} bytes.")
+    payload_offset = end + len(HEADER_END)
+    # skip the one line terminator of the header: the payload itself may start with CR or LF bytes
+    for terminator in (b"\r\n", b"\n"):
+        if head.startswith(terminator, payload_offset):
+            payload_offset += len(terminator)
+            break
+    settings = {}
+    for line in head[len(HEADER_START) : end].decode("utf-8", errors="replace").splitlines():
+        key, separator, value = line.partition(":")
+        if separator:
+            settings[key.strip()] = value.strip()
+    return settings, payload_offset
+
+
+def read_video_timestamps(file_path: Path) -> tuple:
+    """
+    Read the frame timestamps of a .videoTimeStamps file, replacing Trodes' readCameraModuleTimeStamps.
+
+    Parameters
+    ----------
+    file_path : Path
+        The path to the .videoTimeStamps file.
+
+    Returns
+    -------
+    timestamps : np.ndarray
+        The read-only timestamps of the frames in seconds. The array is shared by the callers reading the same
+        unchanged file; copy it before modifying it.
+    clock_rate : int
+        The rate of the Trodes clock in Hz, from the header (30 kHz if the file has no header).
+    """
+    file_path = Path(file_path).resolve()
+    stat = os.stat(file_path)
+    return _read_video_timestamps(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_video_timestamps(file_path: str, size: int, mtime_ns: int) -> tuple:
+    # the size and modification time are only part of the cache key
+    settings, payload_offset = read_header(file_path)
+    clock_rate = int(settings.get("Clock rate", DEFAULT_CLOCK_RATE))
+    num_frames = (size - payload_offset) // 4  # ignore a truncated last timestamp
+    if num_frames <= 0:
+        return np.empty(0, dtype="float64"), clock_rate
+    ticks = np.memmap(file_path, dtype="<u4", mode="r", offset=payload_offset, shape=(num_frames,))
+    timestamps = ticks / float(clock_rate)
+    timestamps.setflags(write=False)
+    return timestamps, clock_rate